@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+"""
+Micro-benchmark of the parsing of the supplier pages
+
+Each supplier page is parsed with every parser installed, building either
+the whole page or only the elements its extractor reads (the page filters
+of find_sds.py), and the parse time per page is printed.
+
+The pages are synthetic: they have the elements the extractors read, in the
+middle of the navigation, result rows and scripts of a real result page.
+
+Usage (from the root of the repository):
+    python benchmarks/parse_pages.py [--repeat N] [--rows N]
+"""
+
+
+import argparse
+import importlib.util
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from oe_find_sds.find_sds import page_filters
+from oe_find_sds.html_parsing import make_soup
+
+
+def navigation(links: int = 150) -> str:
+    """Header, menus and footer of a page"""
+    items = ''.join(f'<li class="nav-item"><a class="nav-link" href="/category/{i}">Category {i}</a></li>'
+                    for i in range(links))
+    return f'<header class="site-header"><nav><ul class="menu">{items}</ul></nav></header>'
+
+
+def scripts(count: int = 10) -> str:
+    """Inline scripts of a page"""
+    return ''.join(f'<script>window.dataLayer = window.dataLayer || []; dataLayer.push({{"event": "load{i}"}});</script>'
+                   for i in range(count))
+
+
+def page(head: str, body: str) -> str:
+    """Whole page around the given head and body"""
+    return (f'<!DOCTYPE html><html><head><title>Search</title>{scripts()}{head}</head>'
+            f'<body>{navigation()}{body}<footer>{navigation(50)}</footer></body></html>')
+
+
+def vwr_page(rows: int) -> str:
+    result_rows = ''.join(
+        f'<tr><td data-title="Name"><span>Product {i}</span></td><td data-title="Catalog Number">{i}</td>'
+        f'<td data-title="Manufacturer"> Manufacturer {i} </td>'
+        f'<td data-title="SDS"><a href="https://us.vwr.com/assetsvc/asset/en_US/id/{i}/contents">SDS</a></td></tr>'
+        for i in range(rows))
+    return page('', f'<div class="search-header clearfix"><span class="pull-left">{rows} results were found</span></div>'
+                    f'<table class="table">{result_rows}</table>')
+
+
+def fisher_page(rows: int) -> str:
+    items = ''.join(f'<li class="catlog_items"><a href="/store/msds?partNumber=P{i}">P{i}</a>'
+                    f'<span class="description">Product {i}, 500 g</span></li>' for i in range(rows))
+    return page('', f'<div class="catalog_num"><ul>{items}</ul></div>')
+
+
+def chemblink_page(rows: int) -> str:
+    properties = ''.join(f'<tr><td class="label">Property {i}</td><td>Value {i}</td></tr>' for i in range(rows))
+    links = ''.join(f'<tr><td><a href="/MSDS/MSDSFiles/64-19-7_Source{i}.pdf" class="blue">View / download</a></td></tr>'
+                    for i in range(3))
+    return page('', f'<table>{properties}</table><table>{links}</table>')
+
+
+def fluorochem_page(rows: int) -> str:
+    result_rows = ''.join(f'<tr><td>F{i:06}</td><td>Product {i}</td><td>64-19-7</td>'
+                          f'<td><a class="textLink prodDetailLink" prodcode="F{i:06}" href="#">Details</a></td></tr>'
+                          for i in range(rows))
+    return f'<div class="results"><table>{result_rows}</table></div>'
+
+
+def tci_page(rows: int) -> str:
+    head = "<script>var ACC = {config: {}}; ACC.config.encodedContextPath = '\\/US\\/en';</script>"
+    products = ''.join(f'<div class="prductlist" data-casno="64-19-7" data-id="A{i:04}">'
+                       f'<h3>Product {i}</h3><p>Purity: &gt;98.0%</p></div>' for i in range(rows))
+    return page(head, '<form><input type="hidden" name="CSRFToken" value="token"></form>'
+                      '<div id="contentSearchFacet"><span class="facet__text"><a href="#">Products</a>'
+                      f'<span class="facet__value__count">({rows})</span></span></div>{products}')
+
+
+supplier_pages = {
+    'vwr': vwr_page,
+    'fisher': fisher_page,
+    'chemblink': chemblink_page,
+    'fluorochem': fluorochem_page,
+    'tci': tci_page,
+}
+
+
+def main(repeat: int, rows: int) -> None:
+    backends = [backend for backend in ('html.parser', 'lxml')
+                if backend == 'html.parser' or importlib.util.find_spec(backend) is not None]
+    print(f'{"supplier":12}{"page KB":>8}  ' + ''.join(f'{backend + " " + mode:>25}'
+                                                     for backend in backends for mode in ('full', 'partial')))
+    for supplier, make_page in supplier_pages.items():
+        markup = make_page(rows)
+        timings = []
+        for backend in backends:
+            for page_filter in (None, page_filters[supplier]):
+                seconds = min(timeit.repeat(lambda: make_soup(markup, page_filter, backend=backend),
+                                            number=1, repeat=repeat))
+                timings.append(seconds)
+        # Speed up compared to the whole page built by html.parser, the parsing before this change
+        print(f'{supplier:12}{len(markup) / 1024:8.0f}  '
+              + ''.join(f'{seconds * 1000:14.2f} ms ({timings[0] / seconds:4.1f}x)' for seconds in timings))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the parsing of the supplier pages')
+    parser.add_argument('--repeat', type=int, default=20, help='number of times each page is parsed (default: 20)')
+    parser.add_argument('--rows', type=int, default=100, help='number of results on each page (default: 100)')
+    args = parser.parse_args()
+    main(args.repeat, args.rows)
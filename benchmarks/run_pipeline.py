@@ -0,0 +1,301 @@
+#!/usr/bin/python
+
+"""
+Offline end-to-end benchmark of the SDS pipeline
+
+A generated list of CAS numbers goes through the same pipeline as main():
+supplier searches, SDS downloads and SQL updates. The suppliers are replaced
+by a local stand-in server (see supplier_server.py) with a configurable
+latency, jitter and error rate, and the database by an SQLite copy of the
+`molecule` table, so the run needs no network and no MySQL server.
+
+The throughput (CAS/s), the per-CAS latency (p50/p99), the peak memory
+(RSS) and the time spent in the SQL updates are printed and written to a
+JSON file, to compare versions of the program.
+
+Usage (from the root of the repository):
+    python benchmarks/run_pipeline.py [--cas N] [--latency S] [--output FILE] ...
+"""
+
+
+import argparse
+import json
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+sys.path.append(str(Path(__file__).resolve().parent))
+
+from oe_find_sds import find_sds, http_sessions, metrics, rate_limit
+from oe_find_sds.rate_limit import RateLimit
+from oe_find_sds.sds_cache import SdsCache
+from supplier_server import SupplierServer
+
+try:
+    import resource
+except ImportError:    # not available on Windows
+    resource = None
+
+
+class SqliteCursor:
+    """Cursor running the mysql.connector queries of find_sds on SQLite"""
+    def __init__(self, connection: sqlite3.Connection):
+        self._cursor = connection.cursor()
+
+    def execute(self, query, params=()):
+        # File objects are read like mysql.connector sends them as long data
+        params = [param.read() if hasattr(param, 'read') else param for param in params]
+        self._cursor.execute(query.replace('%s', '?'), params)
+
+    def executemany(self, query, seq_params):
+        for params in seq_params:
+            self.execute(query, params)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    def close(self):
+        self._cursor.close()
+
+
+class SqliteDatabase:
+    """SQLite stand-in for the Open Enventory database, with the methods of a
+    mysql.connector connection used by find_sds
+
+    The `molecule` table has one molecule missing its SDS for each CAS number.
+    """
+    def __init__(self, cas_list: List[str]):
+        self.connection = sqlite3.connect(':memory:', check_same_thread=False)
+        # The server side file reading of the default 'server' upload mode
+        self.connection.create_function('LOAD_FILE', 1, lambda path: Path(path).read_bytes())
+        self.connection.execute(
+            'CREATE TABLE molecule (molecule_id INTEGER PRIMARY KEY, cas_nr TEXT,'
+            ' default_safety_sheet_blob BLOB, default_safety_sheet_by TEXT,'
+            ' default_safety_sheet_url TEXT, default_safety_sheet_mime TEXT)')
+        self.connection.execute('CREATE INDEX molecule_cas_nr ON molecule (cas_nr)')
+        self.connection.executemany('INSERT INTO molecule (cas_nr) VALUES (?)', [(cas_nr, ) for cas_nr in cas_list])
+        self.connection.commit()
+
+    def cursor(self, buffered=False, prepared=False):
+        return SqliteCursor(self.connection)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+    def count_sds(self) -> int:
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM molecule WHERE default_safety_sheet_blob IS NOT NULL').fetchone()[0]
+
+
+def make_cas_list(count: int, start: int = 100000) -> List[str]:
+    """Make count CAS numbers with a valid check digit
+
+    Examples
+    --------
+    >>> make_cas_list(1, start=6419)
+    ['64-19-7']
+    """
+    cas_list = []
+    for number in range(start, start + count):
+        digits = str(number)
+        check_digit = sum(int(digit) * weight for weight, digit in enumerate(reversed(digits), 1)) % 10
+        cas_list.append(f'{digits[:-2]}-{digits[-2:]}-{check_digit}')
+    return cas_list
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of values, 0 for no value"""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def peak_rss_mb() -> float:
+    """Peak memory used by this process, in MB (0 if unknown)"""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KB on Linux
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def program_version() -> Dict[str, str]:
+    """Version of the program being benchmarked: last VERSION.md title and git commit"""
+    root = Path(__file__).resolve().parents[1]
+    version = {'version': '', 'commit': ''}
+    try:
+        version['version'] = next(line.lstrip('# ').strip()
+                                  for line in (root / 'VERSION.md').read_text().splitlines() if line.startswith('## '))
+        version['commit'] = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(root),
+                                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                           universal_newlines=True).stdout.strip()
+    except (OSError, StopIteration):
+        pass
+    return version
+
+
+def run_benchmark(cas_count: int = 500, concurrency: int = 100, batch_size: int = 100,
+                  latency: float = 0.05, jitter: float = 0.02, error_rate: float = 0, hit_rate: float = 0.5,
+                  pdf_size: int = 200 * 1024, race: bool = False, upload_mode: str = 'server',
+                  limit: RateLimit = None) -> Dict:
+    """Run the pipeline on cas_count generated CAS numbers against the stand-in suppliers
+
+    Parameters
+    ----------
+    limit : RateLimit, optional
+        the rate limit of every supplier, by default None (no limit, to measure the pipeline)
+    others
+        see the command line options
+
+    Returns
+    -------
+    Dict
+        the benchmark configuration and results
+    """
+    config = {key: value for key, value in locals().items() if key != 'limit'}
+    config['rate_limit'] = list(limit) if limit else None
+    cas_list = make_cas_list(cas_count)
+    latencies = []
+    db_seconds = []
+
+    download_sds = find_sds.download_sds
+    update_sql_sds_batch = find_sds.update_sql_sds_batch
+
+    def timed_download_sds(cas_nr):
+        start = time.monotonic()
+        try:
+            return download_sds(cas_nr)
+        finally:
+            latencies.append(time.monotonic() - start)
+
+    def timed_update_sql_sds_batch(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            return update_sql_sds_batch(*args, **kwargs)
+        finally:
+            db_seconds.append(time.monotonic() - start)
+
+    server = SupplierServer(latency=latency, jitter=jitter, error_rate=error_rate,
+                            hit_rate=hit_rate, pdf_size=pdf_size).start()
+    hosts = [host for supplier_hosts in find_sds.supplier_hosts.values() for host in supplier_hosts]
+    database = SqliteDatabase(cas_list)
+    saved = {name: getattr(find_sds, name) for name in
+             ('download_sds', 'update_sql_sds_batch', 'download_path', 'missing_sds', 'search_cache',
+              'race_suppliers', 'upload_mode', 'status_interval', 'concurrency', 'max_allowed_packet')}
+    saved_default_limit = rate_limit.default_limit
+    with tempfile.TemporaryDirectory() as download_path:
+        try:
+            http_sessions.host_overrides = server.overrides(hosts)
+            rate_limit.default_limit = limit or RateLimit(rate=1e9, burst=10**9, max_concurrency=10**6)
+            find_sds.download_sds = timed_download_sds
+            find_sds.update_sql_sds_batch = timed_update_sql_sds_batch
+            find_sds.download_path = download_path
+            find_sds.missing_sds = set()
+            find_sds.search_cache = SdsCache.in_folder(download_path)
+            find_sds.race_suppliers = race
+            find_sds.upload_mode = upload_mode
+            find_sds.max_allowed_packet = None
+            find_sds.status_interval = 0
+            find_sds.concurrency = concurrency
+
+            http_sessions.warm_up_sessions(find_sds.supplier_urls)
+            metrics.reset()
+            start = time.monotonic()
+            updated = find_sds.download_and_update_sds(database, cas_list, max_concurrency=concurrency,
+                                                       batch_size=batch_size)
+            seconds = time.monotonic() - start
+            stored = database.count_sds()
+            missing = len(find_sds.missing_sds)
+        finally:
+            find_sds.search_cache.close()
+            for name, value in saved.items():
+                setattr(find_sds, name, value)
+            rate_limit.default_limit = saved_default_limit
+            http_sessions.host_overrides = {}
+            http_sessions.close_sessions()
+            rate_limit.reset_limiters()
+            database.close()
+            server.stop()
+
+    return {
+        **program_version(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'config': config,
+        'results': {
+            'cas': cas_count,
+            'updated': updated,
+            'stored': stored,
+            'missing': missing,
+            'seconds': round(seconds, 3),
+            'cas_per_second': round(cas_count / seconds, 2) if seconds else 0,
+            'latency_p50': round(percentile(latencies, 0.5), 4),
+            'latency_p99': round(percentile(latencies, 0.99), 4),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'db_update_seconds': round(sum(db_seconds), 3),
+            'requests': dict(server.requests),
+            'suppliers': metrics.supplier_summary(),
+        },
+    }
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark the SDS pipeline against local stand-in suppliers')
+    parser.add_argument('--cas', type=int, default=500, help='number of CAS numbers (default: %(default)s)')
+    parser.add_argument('-c', '--concurrency', type=int, default=100,
+                        help='maximum number of CAS in flight (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='number of CAS updated in each SQL transaction (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='time taken by each supplier answer, in seconds (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.02,
+                        help='random change of the latency, in seconds (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of supplier answers that are 500 errors (default: %(default)s)')
+    parser.add_argument('--hit-rate', type=float, default=0.5,
+                        help='fraction of CAS each supplier has the SDS of (default: %(default)s)')
+    parser.add_argument('--pdf-size', type=int, default=200,
+                        help='size of the SDS files, in KB (default: %(default)s)')
+    parser.add_argument('--race', action='store_true', help='query all suppliers at the same time')
+    parser.add_argument('--upload-mode', choices=['server', 'client'], default='server',
+                        help='how the SDS files get into the database (default: %(default)s)')
+    parser.add_argument('--rate-limit', metavar='RATE[/MAX_CONCURRENCY]',
+                        help='rate limit of every supplier (default: no limit)')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='JSON file the results are written to (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    limit = find_sds.parse_rate_limit(f'default={args.rate_limit}')[1] if args.rate_limit else None
+    report = run_benchmark(cas_count=args.cas, concurrency=args.concurrency, batch_size=args.batch_size,
+                           latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                           hit_rate=args.hit_rate, pdf_size=args.pdf_size * 1024, race=args.race,
+                           upload_mode=args.upload_mode, limit=limit)
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(json.dumps(report['results'], indent=2))
+    print(f'Results written to {args.output}')
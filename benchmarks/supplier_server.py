@@ -0,0 +1,217 @@
+"""
+Local stand-in for the supplier websites, used by the offline benchmarks
+
+One HTTP server answers for every supplier host: the requests for
+'https://www.fishersci.com/store/msds' are sent (see
+`http_sessions.host_overrides`) to '<server url>/www.fishersci.com/store/msds'.
+The search pages have the elements the extractors read, every SDS url gives
+the same small PDF file.
+
+Whether a supplier has the SDS of a CAS number is decided from a hash of
+both, so the same CAS list gives the same hits on every run. The latency,
+jitter and error rate of the answers are set on the server.
+"""
+
+
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict, Iterable
+from urllib.parse import parse_qs, urlsplit
+
+from parse_pages import page
+
+
+def make_pdf(size: int = 200 * 1024) -> bytes:
+    """Make a PDF file of about size bytes, passing `find_sds.is_valid_pdf()`"""
+    header = b'%PDF-1.4\n'
+    trailer = b'\n%%EOF\n'
+    return header + b'%' + b'0' * max(0, size - len(header) - len(trailer) - 1) + trailer
+
+
+class SupplierServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server answering for all the supplier hosts
+
+    Parameters
+    ----------
+    latency : float, optional
+        the time taken by each answer, in seconds, by default 0.05
+    jitter : float, optional
+        the latency is randomly changed by up to +/- jitter seconds, by default 0.02
+    error_rate : float, optional
+        the fraction of requests answered with a 500 error, by default 0
+    hit_rate : float, optional
+        the fraction of CAS numbers each supplier has the SDS of, by default 0.5
+    pdf_size : int, optional
+        the size of the SDS files, in bytes, by default 200 KB
+    """
+    daemon_threads = True
+    # Many CAS numbers in flight open many connections at once
+    request_queue_size = 256
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, error_rate: float = 0,
+                 hit_rate: float = 0.5, pdf_size: int = 200 * 1024):
+        super().__init__(('127.0.0.1', 0), SupplierHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.hit_rate = hit_rate
+        self.pdf = make_pdf(pdf_size)
+        # Number of requests received by each host
+        self.requests = Counter()
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def overrides(self, hosts: Iterable[str]) -> Dict[str, str]:
+        """Get the `http_sessions.host_overrides` sending the requests for hosts to this server"""
+        return {f'{scheme}://{host}': f'{self.base_url}/{host}' for host in hosts for scheme in ('http', 'https')}
+
+    def has_sds(self, host: str, cas_nr: str) -> bool:
+        """Check if the supplier at host has the SDS of cas_nr"""
+        return zlib.crc32(f'{host}:{cas_nr}'.encode()) % 1000 < self.hit_rate * 1000
+
+    def start(self) -> 'SupplierServer':
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class SupplierHandler(BaseHTTPRequestHandler):
+    """Answer the requests of the extractors and of the SDS downloads
+
+    The first part of the path is the supplier host, e.g. '/www.fishersci.com/store/msds'.
+    """
+    # Keep-alive connections, like the supplier websites
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.answer(b'')
+
+    def do_HEAD(self):
+        self.send(200, b'', 'text/html')
+
+    def do_POST(self):
+        self.answer(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+
+    def answer(self, body: bytes):
+        server = self.server
+        _, host, path = self.path.split('/', 2)
+        path = '/' + path
+        url = urlsplit(path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        server.requests[host] += 1
+
+        delay = server.latency + random.uniform(-server.jitter, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < server.error_rate:
+            return self.send(500, b'Internal Server Error', 'text/html')
+
+        route = getattr(self, 'answer_' + host.replace('.', '_').replace('-', '_'), None)
+        if route is None:
+            return self.send(404, b'', 'text/html')
+        route(url.path, query, body)
+
+    def send(self, status: int, content: bytes, content_type: str, headers: Dict[str, str] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    def send_page(self, html: str):
+        self.send(200, html.encode(), 'text/html; charset=utf-8')
+
+    def send_pdf(self):
+        self.send(200, self.server.pdf, 'application/pdf')
+
+    def answer_www_chemblink_com(self, path, query, body):
+        if path.startswith('/MSDS/MSDSFiles/'):
+            return self.send_pdf()
+        cas_nr = path.rsplit('/', 1)[-1].replace('_MSDS.htm', '')
+        if not self.server.has_sds('www.chemblink.com', cas_nr):
+            return self.send(404, b'', 'text/html')
+        self.send_page(page('', f'<table><tr><td>{cas_nr}</td></tr><tr><td>'
+                                f'<a href="/MSDS/MSDSFiles/{cas_nr}_Matrix.pdf" class="blue">View / download</a>'
+                                '</td></tr></table>'))
+
+    def answer_us_vwr_com(self, path, query, body):
+        if path.startswith('/assetsvc/'):
+            return self.send_pdf()
+        cas_nr = query.get('keyword', '')
+        if not self.server.has_sds('us.vwr.com', cas_nr):
+            return self.send_page(page('', '<div class="clearfix"><span class="pull-left">0 results were found</span></div>'))
+        self.send_page(page('', '<div class="clearfix"><span class="pull-left">1 results were found</span></div>'
+                                '<table><tr><td data-title="Manufacturer"> TCI America </td><td data-title="SDS">'
+                                f'<a href="https://us.vwr.com/assetsvc/asset/en_US/id/{cas_nr}/contents">SDS</a>'
+                                '</td></tr></table>'))
+
+    def answer_www_fishersci_com(self, path, query, body):
+        if path.startswith('/store/msds'):
+            return self.send_pdf()
+        cas_nr = query.get('msdsKeyword', '')
+        if not self.server.has_sds('www.fishersci.com', cas_nr):
+            return self.send_page(page('', '<div class="errormessage search_results_error_message">No results</div>'))
+        self.send_page(page('', '<div class="catalog_num"><ul><li class="catlog_items">'
+                                f'<a href="/store/msds?partNumber={cas_nr}">{cas_nr}</a></li></ul></div>'))
+
+    def answer_www_tcichemicals_com(self, path, query, body):
+        if '/sds/' in path:
+            return self.send_pdf()
+        if path.endswith('/productSDSSearchDoc'):
+            product_code = parse_qs(body.decode()).get('productCode', [''])[0]
+            return self.send(200, b'', 'text/html',
+                             {'Content-Disposition': f'attachment; filename={product_code}_US_EN.pdf'})
+        cas_nr = query.get('text', '')
+        hit = self.server.has_sds('www.tcichemicals.com', cas_nr)
+        self.send_page(page("<script>var ACC = {config: {}}; ACC.config.encodedContextPath = '\\/US\\/en';</script>",
+                            '<form><input type="hidden" name="CSRFToken" value="token"></form>'
+                            '<div id="contentSearchFacet"><span class="facet__text">'
+                            f'<a href="#">{"Products" if hit else "Documents"}</a>'
+                            '<span class="facet__value__count">(1)</span></span></div>'
+                            f'<div class="prductlist" data-casno="{cas_nr}" data-id="T{zlib.crc32(cas_nr.encode())}"></div>'))
+
+    def answer_chemicalsafety_com(self, path, query, body):
+        form = json.loads(body or b'{}')
+        action = form.get('action')
+        if action == 'search':
+            cas_nr = form.get('p3', '').split('|')[-1]
+            rows = [[f'id-{cas_nr}', '', '', cas_nr]] if self.server.has_sds('chemicalsafety.com', cas_nr) else []
+            answer = {'rows': rows}
+        elif action == 'msdsdetail':
+            cas_nr = form.get('p1', '')[len('id-'):]
+            answer = {'rows': [[f'id-{cas_nr}', '', '', cas_nr, '', '', '', '', '', '', f'{cas_nr}.pdf,']]}
+        else:
+            answer = {'url': f'http://sds.chemicalsafety.com/sds/pda/msds/getpdf.ashx?name={form.get("p1")}'}
+        self.send(200, json.dumps(answer).encode(), 'application/json')
+
+    def answer_sds_chemicalsafety_com(self, path, query, body):
+        self.send_pdf()
+
+    def answer_www_fluorochem_co_uk(self, path, query, body):
+        cas_nr = json.loads(body or b'{}').get('txtSearchText', '')
+        if not self.server.has_sds('www.fluorochem.co.uk', cas_nr):
+            return self.send_page('<div class="results">No products found</div>')
+        self.send_page(f'<table><tr><td>F{cas_nr}</td><td>{cas_nr}</td>'
+                       f'<td><a class="textLink prodDetailLink" prodcode="F{cas_nr}">Details</a></td></tr></table>')
+
+    def answer_www_cheminfo_org(self, path, query, body):
+        self.send_pdf()
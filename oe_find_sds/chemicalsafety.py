@@ -0,0 +1,208 @@
+"""
+Resolver of the SDS urls of chemicalsafety.com, shared by all the CAS numbers of a run
+
+Getting the SDS url of a CAS number from chemicalsafety takes three
+requests to `retriever.php`: 'search' (the msds ids of the CAS number),
+'msdsdetail' (the PDF file of an msds id, confirming it is the CAS number
+looked for) and 'getpdfurl' (the url of a PDF file). The resolver keeps
+the answers, so the requests already answered for a CAS number in flight
+are not sent again for the others:
+
+- each row of a 'search' answer gives the msds id of its CAS number,
+  whichever CAS number was searched. The 'msdsdetail' answer is asked for
+  every CAS number, and the PDF file only taken from it once it confirms
+  the msds id and CAS number. A CAS number whose msds id, taken
+  from the search of another CAS number, is not confirmed is searched
+- the url of each PDF file is kept for `url_ttl` seconds, the same PDF
+  file is shared by several msds ids
+- the same request wanted by several threads at once is sent once, the
+  other threads wait for its answer
+
+Everything kept is forgotten every `answer_ttl` seconds, so a long-running
+process (e.g. the daemon mode) searches again the CAS numbers not found,
+and does not keep growing.
+
+`retriever.php` has no request for several CAS numbers at once: the
+lookups of the CAS numbers in flight only share their answers.
+"""
+
+
+import json
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Set, Tuple
+
+import requests
+
+
+retriever_url = 'https://chemicalsafety.com/sds1/retriever.php'
+headers = {
+    'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/53.0.2785.143 Safari/537.36',
+    'accept-encoding': 'gzip, deflate, br',
+    'content-type': 'application/json'}
+# Number of seconds the url of a PDF file is kept, the urls are signed
+url_ttl = 3600
+# Number of seconds the answers are kept, the same as the suppliers misses (`sds_cache.negative_ttl`)
+answer_ttl = 7 * 24 * 3600
+# Columns of the rows of the 'search' and 'msdsdetail' answers, the PDF file is taken from 'msdsdetail'
+id_column = 0
+cas_column = 3
+pdf_file_column = 10
+
+Post = Callable[..., requests.Response]
+
+
+class ChemicalSafetyResolver:
+    """Resolver of the chemicalsafety SDS urls, safe to share between threads"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Time the answers kept were started to be kept
+        self._since = time.time()
+        # msds id of each CAS number seen in an answer
+        self.msds_ids: Dict[str, str] = {}
+        # PDF file of each CAS number, confirmed by the 'msdsdetail' answer of its msds id
+        self.pdf_files: Dict[str, str] = {}
+        # url of each PDF file, with the time it was given
+        self.pdf_urls: Dict[str, Tuple[str, float]] = {}
+        # CAS numbers searched
+        self.searched: Set[str] = set()
+        # Requests sent and not answered yet
+        self._in_flight: Dict[str, Future] = {}
+        # Number of requests sent for each action
+        self.requests: Dict[str, int] = {'search': 0, 'msdsdetail': 0, 'getpdfurl': 0}
+
+    def resolve(self, cas_nr: str, post: Post) -> Optional[str]:
+        """Get the SDS url of cas_nr
+
+        Parameters
+        ----------
+        cas_nr : str
+            CAS# for chemical of interest
+        post : Post
+            the function sending the POST requests, e.g. `http_sessions.http_post`
+
+        Returns
+        -------
+        Optional[str]
+            the url of the SDS file, None if chemicalsafety does not have it
+        """
+        self._expire()
+        # A second time if the msds id taken from the search of another CAS number is not confirmed
+        for _ in range(2):
+            msds_id = self._msds_id(cas_nr, post)
+            if msds_id is None:
+                return None
+            pdf_file = self._pdf_file(msds_id, cas_nr, post)
+            if pdf_file is not None:
+                return self.pdf_url(pdf_file, post)
+            if cas_nr in self.msds_ids:
+                return None
+        return None
+
+    def pdf_url(self, pdf_file: str, post: Post) -> Optional[str]:
+        """Get the url of a PDF file, asked once every `url_ttl` seconds"""
+        cached = self.pdf_urls.get(pdf_file)
+        if cached and time.time() - cached[1] < url_ttl:
+            return cached[0]
+        def record(answer: dict) -> None:
+            if answer.get('url'):
+                self.pdf_urls[pdf_file] = (answer['url'], time.time())
+
+        answer = self._retrieve(post, {"action": "getpdfurl", "p1": pdf_file, "p2": "", "p3": "", "isContains": ""},
+                                record)
+        return answer.get('url') if answer else None
+
+    def forget(self, cas_nr: str) -> None:
+        """Forget what was kept for cas_nr, e.g. when the url it gave does not give the SDS anymore"""
+        with self._lock:
+            self.searched.discard(cas_nr)
+            self.msds_ids.pop(cas_nr, None)
+            pdf_file = self.pdf_files.pop(cas_nr, None)
+            self.pdf_urls.pop(pdf_file, None)
+
+    def _expire(self) -> None:
+        """Forget everything kept once older than `answer_ttl` seconds"""
+        with self._lock:
+            if time.time() - self._since < answer_ttl:
+                return
+            self.msds_ids.clear()
+            self.pdf_files.clear()
+            self.pdf_urls.clear()
+            self.searched.clear()
+            self._since = time.time()
+
+    def _msds_id(self, cas_nr: str, post: Post) -> Optional[str]:
+        """Get the msds id of cas_nr, searched unless seen in the answer of another search"""
+        if cas_nr not in self.msds_ids and cas_nr not in self.searched:
+            def record(answer: dict) -> None:
+                for row in answer['rows']:
+                    self.msds_ids.setdefault(row[cas_column], row[id_column])
+                self.searched.add(cas_nr)
+
+            form = {"action": "search", "p1": "MSMSDS.COMMON|", "p2": "MSMSDS.MANUFACT|", "p3": "MSCHEM.CAS|" + cas_nr,
+                    "hostName": "chemicalsafety.com", "isContains": "0"}
+            if self._retrieve(post, form, record) is None:
+                return None
+        return self.msds_ids.get(cas_nr)
+
+    def _pdf_file(self, msds_id: str, cas_nr: str, post: Post) -> Optional[str]:
+        """Get the PDF file of cas_nr from the 'msdsdetail' answer of its msds id, once confirmed
+
+        The msds id taken from the search of another CAS number is forgotten
+        if not confirmed, for cas_nr to be searched.
+        """
+        if cas_nr not in self.pdf_files:
+            form = {"action": "msdsdetail", "p1": msds_id, "p2": "", "p3": "", "isContains": ""}
+            answer = self._retrieve(post, form, lambda answer: self._confirm(answer, msds_id, cas_nr))
+            if answer is not None:
+                # Again for the threads waiting for the answer asked by another one, maybe for another CAS number
+                with self._lock:
+                    self._confirm(answer, msds_id, cas_nr)
+        return self.pdf_files.get(cas_nr)
+
+    def _confirm(self, answer: dict, msds_id: str, cas_nr: str) -> None:
+        """Keep the PDF file of cas_nr if the 'msdsdetail' answer confirms the msds_id and cas_nr (holding the lock)"""
+        result = answer['rows'][0] if answer['rows'] else None
+        if result is not None and result[id_column] == msds_id and result[cas_column] == cas_nr:
+            if len(result) > pdf_file_column and result[pdf_file_column]:
+                self.pdf_files[cas_nr] = result[pdf_file_column].rstrip(',')
+        elif cas_nr not in self.searched and self.msds_ids.get(cas_nr) == msds_id:
+            del self.msds_ids[cas_nr]
+
+    def _retrieve(self, post: Post, form: Dict[str, str],
+                  record: Optional[Callable[[dict], None]] = None) -> Optional[dict]:
+        """Send form to `retriever_url`, or wait for the answer of the same form sent by another thread
+
+        The answer is given to record (holding the lock) before the form is
+        sent again by another thread, so what it tells is never asked twice.
+
+        Returns
+        -------
+        Optional[dict]
+            the JSON answer, None if not answered with 200 (or redirected)
+        """
+        key = json.dumps(form, sort_keys=True)
+        with self._lock:
+            future = self._in_flight.get(key)
+            sender = future is None
+            if sender:
+                future = self._in_flight[key] = Future()
+                self.requests[form['action']] += 1
+        if not sender:
+            return future.result()
+        try:
+            r = post(retriever_url, headers=headers, data=json.dumps(form), timeout=20)
+            # Check to see if give OK status (200) and not redirect
+            answer = r.json() if r.status_code == 200 and len(r.history) == 0 else None
+            with self._lock:
+                if answer is not None and record is not None:
+                    record(answer)
+                del self._in_flight[key]
+            future.set_result(answer)
+            return answer
+        except Exception as error:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            future.set_exception(error)
+            raise
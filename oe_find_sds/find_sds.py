@@ -14,208 +14,2049 @@ of specific database and find those molecule with missing sds
 """
 
 
+import argparse
+import asyncio
+import configparser
 import getpass
+import itertools
 import json
 import os
+import random
 import re
-import sys
+import signal
+import socket
+import tempfile
+import threading
+import time
 import traceback
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
 
 import mysql.connector as mariadb
-import requests
-from bs4 import BeautifulSoup
+
+try:
+    from oe_find_sds import (chemicalsafety, html_parsing, http_cache, http_sessions, metrics, rate_limit, sds_cache,
+                             sds_store)
+    from oe_find_sds.chemicalsafety import ChemicalSafetyResolver
+    from oe_find_sds.job_queue import JobQueue
+    from oe_find_sds.journal import Journal
+    from oe_find_sds.html_parsing import PageFilter, has_class, make_soup
+    from oe_find_sds.http_sessions import (bypassing_cache, close_sessions, http_get, http_post, request_failures,
+                                           warm_up_sessions)
+    from oe_find_sds.rate_limit import RateLimit, format_limiter_status
+    from oe_find_sds.sds_cache import SdsCache
+except ImportError:    # running as a script: `python oe_find_sds/find_sds.py`
+    import chemicalsafety
+    import html_parsing
+    import http_cache
+    import http_sessions
+    import metrics
+    import rate_limit
+    import sds_cache
+    import sds_store
+    from html_parsing import PageFilter, has_class, make_soup
+    from chemicalsafety import ChemicalSafetyResolver
+    from http_sessions import bypassing_cache, close_sessions, http_get, http_post, request_failures, warm_up_sessions
+    from job_queue import JobQueue
+    from journal import Journal
+    from rate_limit import RateLimit, format_limiter_status
+    from sds_cache import SdsCache
 
 
 download_path = r'/var/lib/mysql/missing_sds'
 missing_sds = set()
 debug = False
-# print out extra info in debug mode in case SDS is not found
-if len(sys.argv) == 2 and sys.argv[1] in ['--debug=True', '--debug=true', '--debug', '-d']:
-    debug = True
+# Maximum number of CAS being searched/downloaded at the same time
+concurrency = 100
+# One url on each supplier host, used to open the shared HTTP connections ahead of time
+supplier_urls = [
+    'https://www.chemblink.com',
+    'https://us.vwr.com',
+    'https://www.fishersci.com',
+    'https://www.tcichemicals.com',
+    'https://chemicalsafety.com',
+    'http://www.fluorochem.co.uk',
+]
+# Suppliers searched for SDS, in order of priority.
+# Each name maps to the function `extract_download_url_from_<name>()`
+supplier_order = ['chemblink', 'vwr', 'fisher', 'tci', 'chemicalsafety', 'fluorochem']
+# Query all suppliers at the same time instead of one after the other
+race_suppliers = False
+# Order the suppliers of each search by their chance to give the SDS quickly, learned from
+# the previous searches (see `order_suppliers()`). False to always use `supplier_order`
+adaptive_order = True
+# Use the statistics of the CAS numbers with the same prefix (see `sds_cache.cas_prefix()`)
+stats_by_prefix = False
+# Suppliers with a hit rate below `min_hit_rate` after `min_searches` searches are skipped,
+# except for a fraction `explore_rate` of the CAS numbers, which keeps their statistics up to date
+min_hit_rate = 0.02
+min_searches = 50
+explore_rate = 0.05
+# Search time assumed for the suppliers not searched yet, in seconds
+default_search_seconds = 1.0
+# Hosts contacted by each supplier, for its search pages and its SDS files
+supplier_hosts = {
+    'chemblink': ['www.chemblink.com'],
+    'vwr': ['us.vwr.com'],
+    'fisher': ['www.fishersci.com'],
+    'tci': ['www.tcichemicals.com'],
+    'chemicalsafety': ['chemicalsafety.com', 'sds.chemicalsafety.com'],
+    'fluorochem': ['www.fluorochem.co.uk', 'www.cheminfo.org'],
+}
+# Answer the supplier searches from the on-disk cache of their responses (see http_cache.py)
+use_http_cache = True
+# Number of seconds the search responses of each supplier are kept in the HTTP cache,
+# the suppliers not listed here are always searched again
+supplier_cache_ttls: Dict[str, float] = {
+    'chemblink': 30 * 24 * 3600,
+    'vwr': 7 * 24 * 3600,
+    'fisher': 7 * 24 * 3600,
+    # The urls given by chemicalsafety (the 'getpdfurl' answers) are signed, they are kept
+    # as long as the resolver keeps them in memory
+    'chemicalsafety': chemicalsafety.url_ttl,
+    'fluorochem': 7 * 24 * 3600,
+    # The search page of tci gives the CSRF token (and its cookies) of the SDS request: not cached
+}
+# Answers of chemicalsafety shared between the CAS numbers of the run (see chemicalsafety.py)
+chemicalsafety_resolver = ChemicalSafetyResolver()
+# Rate limit of each supplier, the suppliers not listed here use `rate_limit.default_limit`
+supplier_limits: Dict[str, RateLimit] = {}
+# Print the request rate of each supplier host every `status_interval` seconds (0: never)
+status_interval = 60
+# Cache of the supplier searches, opened in the download folder by main()
+search_cache: Optional[SdsCache] = None
+# Search all suppliers again, ignoring the cached urls and misses
+revalidate = False
+# Maximum size of an SDS file, in bytes
+max_sds_size = 50 * 1024 * 1024
+# Headers of the SDS file downloads
+download_headers = {
+    'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/53.0.2785.143 Safari/537.36'}
+# Refresh mode: the SDS downloaded (or checked) more than `refresh_interval` seconds ago are
+# checked with conditional requests, at most `refresh_limit` of them in each run (see refresh_sds())
+refresh_interval = 30 * 24 * 3600
+refresh_limit = 1000
+# Number of molecules updated in each SQL transaction
+batch_size = 100
+# Numbers of the SQL update batches, printed with their timings
+_batch_numbers = itertools.count(1)
+# Condition on the molecules missing SDS.
+# SDS found by OE that are marked as 'Acros' are corrupted, hence the last condition
+missing_sds_condition = ("(default_safety_sheet_blob is NULL or default_safety_sheet_by is NULL "
+                         "or default_safety_sheet_by='Acros')")
+# Query updating the SDS of all the molecules with a CAS number still missing SDS: an SDS
+# added in Open Enventory since the molecules were selected is not overwritten
+update_sds_query = ("UPDATE molecule SET default_safety_sheet_blob=LOAD_FILE(%s), default_safety_sheet_by=%s, "
+                    "default_safety_sheet_url=NULL, default_safety_sheet_mime='application/pdf' "
+                    "WHERE cas_nr=%s AND " + missing_sds_condition)
+# Same query, the SDS file being sent by this program instead of read by the database server
+update_sds_blob_query = ("UPDATE molecule SET default_safety_sheet_blob=%s, default_safety_sheet_by=%s, "
+                         "default_safety_sheet_url=NULL, default_safety_sheet_mime='application/pdf' "
+                         "WHERE cas_nr=%s AND " + missing_sds_condition)
+# Same query, the SDS being copied from a molecule already having the same SDS file (same size and
+# hash), so the file is not sent again. The subqueries are wrapped in a derived table, which MySQL needs
+# to read the table being updated. No row is updated if the source molecule does not have the SDS anymore
+copy_sds_query = ("UPDATE molecule SET default_safety_sheet_blob=(SELECT sds_blob FROM ("
+                  "SELECT default_safety_sheet_blob AS sds_blob FROM molecule "
+                  "WHERE cas_nr=%s AND LENGTH(default_safety_sheet_blob)=%s LIMIT 1) AS source), "
+                  "default_safety_sheet_by=%s, default_safety_sheet_url=NULL, "
+                  "default_safety_sheet_mime='application/pdf' WHERE EXISTS (SELECT 1 FROM ("
+                  "SELECT 1 FROM molecule WHERE cas_nr=%s AND LENGTH(default_safety_sheet_blob)=%s LIMIT 1) AS present) "
+                  "AND cas_nr=%s AND " + missing_sds_condition)
+# Update the molecules already having an SDS too, set by the refresh mode to replace the SDS that changed
+replace_sds = False
+# Query selecting the CAS numbers of the molecules missing SDS
+select_missing_query = "SELECT distinct cas_nr FROM molecule WHERE cas_nr!='' AND " + missing_sds_condition
+# Same query, for the molecules added after a molecule_id (see `incremental`)
+select_missing_since_query = select_missing_query + " AND molecule_id > %s"
+max_molecule_id_query = "SELECT MAX(molecule_id) FROM molecule"
+# Only look at the molecules added since the previous run, the molecules missing SDS that
+# no supplier had are not searched again on every run
+incremental = False
+# Look at all the molecules again if the last full sweep is older than this, in seconds
+full_sweep_interval = 7 * 24 * 3600
+# Look at all the molecules in this run, even in `incremental` mode
+full_sweep = False
+# Journal of the states of the CAS numbers of the run (see journal.py)
+journal: Optional[Journal] = None
+# Resume the previous run from its journal, instead of starting a new journal
+resume = False
+# Keep the SDS status of each molecule in a side table of the database, indexed, and find the
+# molecules missing SDS there instead of in the molecule table, whose rows hold the SDS files
+use_status_table = False
+status_table = 'oe_find_sds_status'
+create_status_table_query = (f"CREATE TABLE IF NOT EXISTS {status_table} ("
+                             "molecule_id INT NOT NULL PRIMARY KEY, "
+                             "cas_nr VARCHAR(80) NOT NULL, "
+                             "has_sds TINYINT NOT NULL, "
+                             "sds_by VARCHAR(100) NULL, "
+                             "sha256 CHAR(64) NULL, "
+                             "size INT NULL, "
+                             "checked_at TIMESTAMP NULL, "
+                             "KEY missing_sds (has_sds, cas_nr))")
+# Copy the status of the molecules after a molecule_id from the molecule table: the only
+# query reading the SDS column, for the molecules added since the previous run
+sync_status_query = (f"INSERT INTO {status_table} (molecule_id, cas_nr, has_sds, sds_by, size) "
+                     "SELECT molecule_id, COALESCE(cas_nr, ''), (default_safety_sheet_blob IS NOT NULL "
+                     "AND default_safety_sheet_by IS NOT NULL AND default_safety_sheet_by!='Acros'), "
+                     "default_safety_sheet_by, LENGTH(default_safety_sheet_blob) FROM molecule WHERE molecule_id > %s "
+                     "ON DUPLICATE KEY UPDATE cas_nr=VALUES(cas_nr), has_sds=VALUES(has_sds), "
+                     "sds_by=VALUES(sds_by), size=VALUES(size)")
+max_status_id_query = f"SELECT MAX(molecule_id) FROM {status_table}"
+select_missing_status_query = f"SELECT DISTINCT cas_nr FROM {status_table} WHERE has_sds=0 AND cas_nr!=''"
+select_missing_status_since_query = select_missing_status_query + " AND molecule_id > %s"
+# Status of the molecules updated by this program, and of the ones it found no SDS for or did not update
+update_status_query = (f"UPDATE {status_table} SET has_sds=1, sds_by=%s, sha256=%s, size=%s, "
+                       "checked_at=CURRENT_TIMESTAMP WHERE cas_nr=%s")
+check_status_query = f"UPDATE {status_table} SET checked_at=CURRENT_TIMESTAMP WHERE cas_nr=%s AND has_sds=0"
+# Distributed mode: the coordinator puts the CAS numbers in a job table and applies the
+# SDS found by the workers (see job_queue.py). None to download and update in this process
+distributed_role: Optional[str] = None
+# SQLite file of the job table, None to keep it in the database
+job_queue_file: Optional[str] = None
+# Number of seconds between two looks at the job table (or at the database in daemon mode)
+# when there is nothing to do
+poll_interval = 5.0
+# Long-running mode polling the database every `poll_interval` seconds (see run_daemon())
+daemon_mode = False
+# Section of the configuration file, and prefix of the environment variables, holding the settings
+config_section = 'oe_find_sds'
+env_prefix = 'OE_FIND_SDS_'
+# Number of CAS numbers read at a time from the SELECT of the molecules missing SDS
+scan_chunk_size = 1000
+# Watermarks of the databases selected in this run: highest molecule_id and if all molecules were selected
+_pending_watermarks: Dict[str, Tuple[int, bool]] = {}
+# Query finding the Open Enventory databases of the server: the ones with a molecule table keeping SDS
+discover_databases_query = ("SELECT DISTINCT table_schema FROM information_schema.columns WHERE table_name='molecule' "
+                            "AND column_name='default_safety_sheet_blob' ORDER BY table_schema")
+# Store each SDS file once, named by its hash, and upload each one once (see sds_store.py)
+deduplicate = True
+# How the SDS files get into the database:
+#   'server': the database server reads them with LOAD_FILE(), so this program runs on
+#             the database host, as root, with `download_path` allowed by `secure_file_priv`
+#   'client': they are streamed over the SQL connection, so this program can run on any host
+upload_mode = 'server'
+# SQL connection settings
+db_host = 'localhost'
+db_user = 'root'
+# Compress the SQL protocol, worth it when the database is on another host
+db_compress = False
+# Largest SDS file the database server accepts (`@@max_allowed_packet`), read by main() in 'client' mode
+max_allowed_packet: Optional[int] = None
+_race_executor = None
+_race_executor_lock = threading.Lock()
+# Elements of the supplier pages read by each extractor, the rest of the pages is not built
+page_filters = {
+    'vwr': PageFilter(lambda name, attrs: has_class(attrs, 'clearfix')
+                      or (name == 'td' and attrs.get('data-title') in ('SDS', 'Manufacturer'))),
+    'chemblink': PageFilter(lambda name, attrs: name == 'a'),
+    'fisher': PageFilter(lambda name, attrs: has_class(attrs, 'errormessage') or has_class(attrs, 'catlog_items')),
+    'fluorochem': PageFilter(lambda name, attrs: name == 'td' or has_class(attrs, 'prodDetailLink')),
+    'tci': PageFilter(lambda name, attrs: name == 'script'
+                      or (name == 'input' and attrs.get('name') == 'CSRFToken')
+                      or (name == 'div' and (attrs.get('id') == 'contentSearchFacet' or has_class(attrs, 'prductlist')))),
+}
+
+
+def main(database, password):
+    global download_path, debug, concurrency, search_cache, batch_size, upload_mode, max_allowed_packet
+
+    """
+    Info for mysql connection and query can be found here:
+     https://mariadb.com/resources/blog/how-connect-python-programs-mariadb
+     https://dev.mysql.com/doc/connector-python/en/connector-python-tutorial-cursorbuffered.html
+
+    Handling error in password or database not exists:
+    https://dev.mysql.com/doc/connector-python/en/connector-python-example-connecting.html
+    https://dev.mysql.com/doc/connector-python/en/connector-python-api-errorcode.html
+    """
+
+    # Open a connection to mysql
+    try:
+        mariadb_connection = connect_database(database, password)
+        if upload_mode == 'client':
+            max_allowed_packet = get_max_allowed_packet(mariadb_connection)
+
+        # Check if download path with the missing_sds directory exists. If not, create it
+        # https://stackoverflow.com/questions/12517451/automatically-creating-directories-with-file-output
+        # https://docs.python.org/3/library/os.html#os.makedirs
+        os.makedirs(download_path, exist_ok=True)
+        # The cache also keeps the watermark of the incremental runs
+        search_cache = SdsCache.in_folder(download_path)
+
+        # Step1: run SELECT query to find CAS#
+        print(f'Database: {database.upper()}')
+        print('Getting molecules with missing SDS. Please wait!')
+        # The CAS numbers for molecule missing sds in the database of interest are read on a
+        # second connection as the server sends them, and downloaded while the scan goes on
+        scan_connection = connect_database(database, password)
+        to_be_downloaded = iter_missing_cas(scan_connection, database)
+        first_cas_nr = next(to_be_downloaded, None)
+        # Exit out of the script if all SDS exist
+        if first_cas_nr is None:
+            save_watermarks()
+            search_cache.close()
+            search_cache = None
+            scan_connection.close()
+            print('Nothing to download. Exiting!')
+            exit()
+
+        open_journal()
+        to_be_downloaded = queue_in_journal(itertools.chain([first_cas_nr], to_be_downloaded), database)
+
+        # Step 2: downloading sds file
+        print('Downloading missing SDS files. Please wait!')
+        apply_supplier_limits()
+        # Open the connections to the suppliers ahead of time, they are reused by all CAS
+        open_http_cache()
+        warm_up_sessions(supplier_urls)
+
+        count_file_updated = 0
+        start = time.monotonic()
+        # Using asyncio: each CAS is a coroutine, `concurrency` of them in flight at once
+        # Step 3 (run UPDATE query to upload) runs at the same time: the SDS are
+        # uploaded in small batches as soon as they are downloaded
+        try:
+            # download_and_update_sds() return the count of successful update
+            if distributed_role == 'coordinator':
+                count_file_updated = run_coordinator(mariadb_connection, open_job_queue(database, password),
+                                                     to_be_downloaded, batch_size=batch_size)
+            else:
+                count_file_updated = download_and_update_sds(mariadb_connection, to_be_downloaded,
+                                                             max_concurrency=concurrency, batch_size=batch_size)
+            # The next incremental run starts after the molecules looked at by this one
+            save_watermarks()
+
+        except Exception as error:
+            if debug:
+                traceback_str = ''.join(traceback.format_exception(etype=type(error), value=error, tb=error.__traceback__))
+                print(traceback_str)
+
+        # # Not using multithreading
+        # # to_be_downloaded = ['9012-36-6']   # for testing only
+        # try:
+        #     for cas in to_be_downloaded:
+        #         download_sds(cas)
+        # except Exception as error:
+        #     print(error)
+
+        finally:
+            close_sessions()
+            close_http_cache()
+            search_cache.close()
+            search_cache = None
+            close_journal()
+
+            _close_quietly(scan_connection)
+            mariadb_connection.close()
+
+            metrics.phase_seconds.set(time.monotonic() - start, phase='download_and_update')
+            print('\nSupplier searches:')
+            print(metrics.format_supplier_summary())
+            metrics.write_metrics()
+
+            print('\nMolecules with missing SDS:')
+            print(missing_sds)
+            print(f'\nSummary for database {database.upper()}: ')
+            print('\t{} SDS files are missing.'.format(len(missing_sds)))
+            print('\t{} SDS files updated! '.format(count_file_updated))
+
+            # Advice user about turning on debug mode for more error printing
+            print('\n\n(Optional): you can turn on debug mode (more error printing during structure search) using the following command:')
+            print('python oe_find_sds/find_sds.py  --debug\n')
+
+    except mariadb.Error as error:
+        if error.errno == mariadb.errorcode.ER_ACCESS_DENIED_ERROR:
+            print("Wrong password!")
+        elif error.errno == mariadb.errorcode.ER_BAD_DB_ERROR:
+            print("Database does not exist")
+        else:
+            traceback_str = ''.join(traceback.format_exception(etype=type(error), value=error, tb=error.__traceback__))
+            print(traceback_str)
+    else:
+        mariadb_connection.close()
+
+
+def main_databases(databases: Optional[List[str]], password: str) -> Dict[str, int]:
+    """Update the molecules missing SDS of several databases in one run
+
+    The CAS numbers missing SDS in all the databases are put together: each
+    CAS number is searched and downloaded once, and its SDS uploaded into
+    every database missing it. Each database has its own connection and
+    database writer.
+
+    Parameters
+    ----------
+    databases : Optional[List[str]]
+        the names of the databases, None to update every Open Enventory database of the server
+    password : str
+        the password of `db_user`
+
+    Returns
+    -------
+    Dict[str, int]
+        the number of CAS numbers updated in each database
+    """
+    global download_path, debug, concurrency, search_cache, batch_size, upload_mode, max_allowed_packet, missing_sds
+
+    connections = {}
+    missing = {}
+    count_file_updated = {}
+    try:
+        if not databases:
+            server_connection = connect_database(None, password)
+            try:
+                databases = discover_databases(server_connection)
+            finally:
+                server_connection.close()
+            print(f'Databases found: {", ".join(databases) or "none"}')
+
+        os.makedirs(download_path, exist_ok=True)
+        search_cache = SdsCache.in_folder(download_path)
+        print('Getting molecules with missing SDS. Please wait!')
+        for database in databases:
+            try:
+                connections[database] = connect_database(database, password)
+                missing[database] = select_missing_cas(connections[database], database)
+            except mariadb.Error as error:
+                print(f'Database {database.upper()}: skipped, {error}')
+                continue
+            print(f'\tDatabase {database.upper()}: {len(missing[database])} CAS numbers with missing SDS')
+        if upload_mode == 'client' and connections:
+            # The databases are on the same server, the smallest limit is the safe one
+            max_allowed_packet = min(get_max_allowed_packet(connection) for connection in connections.values())
+
+        to_be_downloaded = set().union(*missing.values())
+        print(f'{len(to_be_downloaded)} different CAS numbers with missing SDS in {len(missing)} databases')
+        if not to_be_downloaded:
+            save_watermarks()
+            print('Nothing to download. Exiting!')
+            return count_file_updated
+        missing = start_journal(missing)
+
+        print('Downloading missing SDS files. Please wait!')
+        apply_supplier_limits()
+        open_http_cache()
+        warm_up_sessions(supplier_urls)
+
+        start = time.monotonic()
+        try:
+            count_file_updated = download_and_update_databases({database: connections[database] for database in missing},
+                                                               missing, max_concurrency=concurrency, batch_size=batch_size)
+            save_watermarks()
+        except Exception as error:
+            if debug:
+                traceback_str = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+                print(traceback_str)
+        finally:
+            close_sessions()
+            close_http_cache()
+            search_cache.close()
+            search_cache = None
+
+            metrics.phase_seconds.set(time.monotonic() - start, phase='download_and_update')
+            print('\nSupplier searches:')
+            print(metrics.format_supplier_summary())
+            metrics.write_metrics()
+
+            print('\nMolecules with missing SDS:')
+            print(missing_sds)
+            for database, cas_list in missing.items():
+                print(f'\nSummary for database {database.upper()}: ')
+                print('\t{} SDS files are missing.'.format(len(cas_list & missing_sds)))
+                print('\t{} SDS files updated! '.format(count_file_updated.get(database, 0)))
+        return count_file_updated
+
+    except mariadb.Error as error:
+        if error.errno == mariadb.errorcode.ER_ACCESS_DENIED_ERROR:
+            print("Wrong password!")
+        else:
+            traceback_str = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+            print(traceback_str)
+        return count_file_updated
+    finally:
+        if search_cache is not None:
+            search_cache.close()
+            search_cache = None
+        close_journal()
+        for connection in connections.values():
+            connection.close()
+
+
+def run_daemon(database: str, password: str) -> int:
+    """Keep the SDS of a database filled in: look for new molecules missing SDS every `poll_interval` seconds
+
+    Each poll reads the molecules added since the previous one (see
+    `incremental`, with a full sweep every `full_sweep_interval` seconds)
+    and sends their CAS numbers through the search, the download and the
+    upload at once. The connections to the database and to the suppliers
+    are kept open between polls, and opened again after an error.
+
+    SIGTERM (or Ctrl-C) stops the daemon cleanly: no new CAS number is
+    started, the ones in flight are downloaded and uploaded, and the
+    molecules not looked at are left for the next start.
+
+    Parameters
+    ----------
+    database : str
+        the name of the database
+    password : str
+        the password of `db_user`
+
+    Returns
+    -------
+    int
+        the number of CAS numbers updated
+    """
+    global download_path, debug, search_cache, upload_mode, max_allowed_packet, poll_interval, incremental, daemon_mode
+
+    stop = threading.Event()
+    handlers = {signum: signal.signal(signum, lambda signum, frame: stop.set())
+                for signum in (signal.SIGTERM, signal.SIGINT)}
+    daemon_mode = True
+    incremental = True
+    os.makedirs(download_path, exist_ok=True)
+    search_cache = SdsCache.in_folder(download_path)
+    apply_supplier_limits()
+    open_http_cache()
+    warm_up_sessions(supplier_urls)
+    connections = []
+    count_file_updated = 0
+    print(f'Daemon: looking for molecules missing SDS in database {database.upper()} every {poll_interval} s '
+          '(stop with SIGTERM or Ctrl-C)')
+    try:
+        while not stop.is_set():
+            try:
+                if not connections:
+                    # One connection for the uploads, one for reading the molecules missing SDS
+                    connections = [connect_database(database, password), connect_database(database, password)]
+                    if upload_mode == 'client':
+                        max_allowed_packet = get_max_allowed_packet(connections[0])
+                count_file_updated += _poll_database(*connections, database, stop)
+            except Exception as error:
+                print(f'Error: {error}, trying again in {poll_interval} s')
+                if debug:
+                    print(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+                _pending_watermarks.clear()
+                for connection in connections:
+                    _close_quietly(connection)
+                connections = []
+            stop.wait(poll_interval)
+    finally:
+        for connection in connections:
+            _close_quietly(connection)
+        close_sessions()
+        close_http_cache()
+        search_cache.close()
+        search_cache = None
+        daemon_mode = False
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+        metrics.write_metrics()
+        print(f'\nDaemon stopped: {count_file_updated} SDS files updated')
+    return count_file_updated
+
+
+def _poll_database(mariadb_connection, scan_connection, database: str, stop: threading.Event) -> int:
+    """Download and upload the SDS of the molecules missing SDS found by one poll of `run_daemon()`"""
+    global concurrency, batch_size, missing_sds
+
+    to_be_downloaded = iter_missing_cas(scan_connection, database)
+    first_cas_nr = next(to_be_downloaded, None)
+    if first_cas_nr is None:
+        save_watermarks()
+        return 0
+    missing_sds.clear()
+    start = time.monotonic()
+    try:
+        count_file_updated = download_and_update_sds(
+            mariadb_connection, _until_stopped(itertools.chain([first_cas_nr], to_be_downloaded), stop),
+            max_concurrency=concurrency, batch_size=batch_size, stop=stop)
+    finally:
+        to_be_downloaded.close()
+    if stop.is_set():
+        # The molecules not read yet are looked at after the restart
+        _pending_watermarks.clear()
+    else:
+        save_watermarks()
+    print(f'{time.strftime("%Y-%m-%d %H:%M:%S")}: {count_file_updated} SDS files updated, '
+          f'{len(missing_sds)} missing, in {time.monotonic() - start:.1f} s')
+    metrics.write_metrics()
+    return count_file_updated
+
+
+def _until_stopped(cas_list: Iterable[str], stop: threading.Event) -> Iterator[str]:
+    """Yield the CAS numbers of cas_list until stop is set"""
+    for cas_nr in cas_list:
+        if stop.is_set():
+            return
+        yield cas_nr
+
+
+def main_refresh(database: str, password: str) -> Tuple[int, int]:
+    """Check that the SDS downloaded before did not change, and update the ones that did, see `refresh_sds()`"""
+    global download_path, debug, search_cache, upload_mode, max_allowed_packet
+
+    checked = updated = 0
+    try:
+        mariadb_connection = connect_database(database, password)
+    except mariadb.Error as error:
+        print(f'Database error: {error}')
+        return checked, updated
+    try:
+        if upload_mode == 'client':
+            max_allowed_packet = get_max_allowed_packet(mariadb_connection)
+        os.makedirs(download_path, exist_ok=True)
+        search_cache = SdsCache.in_folder(download_path)
+        apply_supplier_limits()
+        open_http_cache()
+        checked, updated = refresh_sds(mariadb_connection)
+    except Exception as error:
+        print('Error: {}'.format(error))
+        if debug:
+            print(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+    finally:
+        close_sessions()
+        close_http_cache()
+        if search_cache is not None:
+            search_cache.close()
+            search_cache = None
+        mariadb_connection.close()
+        metrics.write_metrics()
+        print(f'\nSummary for database {database.upper()}: ')
+        print(f'\t{checked} SDS files checked.')
+        print(f'\t{updated} SDS files changed and updated!')
+    return checked, updated
+
+
+def refresh_sds(mariadb_connection, limit: Optional[int] = None) -> Tuple[int, int]:
+    """Check the SDS downloaded longest ago with conditional requests, and update the ones that changed
+
+    The SDS downloaded or checked more than `refresh_interval` seconds ago
+    are checked, oldest first, `concurrency` at a time within the rate
+    limit of their host. An SDS is only downloaded again, and updated in
+    the database, if its supplier answers that it changed (see
+    `check_sds()`).
+
+    Parameters
+    ----------
+    mariadb_connection : mysql.connector Object
+        an established connection to the SQL database
+    limit : Optional[int], optional
+        the maximum number of SDS checked, by default `refresh_limit`
+
+    Returns
+    -------
+    Tuple[int, int]
+        the number of SDS checked, and the number of them updated
+    """
+    global search_cache, refresh_interval, refresh_limit, concurrency, batch_size, replace_sds
+
+    stale = search_cache.stale_validators(refresh_interval, refresh_limit if limit is None else limit)
+    if not stale:
+        print('No SDS to check. Exiting!')
+        return 0, 0
+    print(f'Checking {len(stale)} SDS files downloaded more than {refresh_interval / 86400:g} days ago. Please wait!')
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(stale))) as executor:
+        checks = list(executor.map(check_sds, stale))
+    changed = [(cas_nr, True, sds_source) for cas_nr, sds_source, old_sha256 in checks if sds_source]
+    database = _database_name(mariadb_connection)
+    for cas_nr, sds_source, old_sha256 in checks:
+        if sds_source and old_sha256:
+            # The molecules with the old SDS must not be copied from this CAS number anymore
+            search_cache.forget_blob(database, old_sha256)
+    print(f'{len(changed)} of {len(stale)} SDS files changed')
+    if not changed:
+        return len(stale), 0
+    # The SDS that changed replace the ones uploaded before
+    replace_sds = True
+    try:
+        updated = update_sql_sds_batch(mariadb_connection, changed, batch_size=batch_size)
+    finally:
+        replace_sds = False
+    return len(stale), updated
+
+
+def check_sds(cas_nr: str) -> Tuple[str, Optional[str], Optional[str]]:
+    """Check if the SDS of cas_nr changed since it was downloaded, and download it again if it did
+
+    The url of the SDS is requested with the ETag and Last-Modified of the
+    SDS file as If-None-Match and If-Modified-Since. If the url does not
+    give the SDS anymore (e.g. the signed urls of chemicalsafety), the SDS
+    is searched again. A new SDS file is only kept if its content differs.
+
+    Returns
+    -------
+    Tuple[str, Optional[str], Optional[str]]
+        cas_nr, the SDS source if a new SDS file was downloaded (None if not
+        changed or if it could not be checked), and the SHA-256 hash of the
+        previous SDS file
+    """
+    global search_cache, download_path, debug
+
+    sds_source, full_url, etag, last_modified, content_length = search_cache.validators(cas_nr)
+    download_file = Path(download_path) / f'{cas_nr}.pdf'
+    new_file = download_file.with_name(f'.{download_file.name}.refresh')
+    try:
+        status = _conditional_check(full_url, etag, last_modified, content_length)
+        if status == 'gone':
+            # The cached search responses may still give the url that is gone
+            sds_source, full_url = resolve_sds_url(cas_nr, refresh=True) or (sds_source, None)
+        if status == 'unchanged' or not full_url:
+            search_cache.mark_checked(cas_nr)
+            return cas_nr, None, None
+        validators = {}
+        if not fetch_sds(full_url, new_file, validators):
+            search_cache.mark_checked(cas_nr)
+            return cas_nr, None, None
+        old_sha256 = sds_store.file_sha256(download_file) if download_file.exists() else None
+        if old_sha256 == sds_store.file_sha256(new_file):
+            # The supplier could not tell, the content is the same
+            new_file.unlink()
+            search_cache.record_validators(cas_nr, sds_source, full_url, **validators)
+            return cas_nr, None, None
+        os.replace(str(new_file), str(download_file))
+        search_cache.record_validators(cas_nr, sds_source, full_url, **validators)
+        print(f'{cas_nr}: new SDS from {sds_source}')
+        return cas_nr, sds_source, old_sha256
+    except Exception as error:
+        # Checked again by the next run
+        if debug:
+            print(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+        if new_file.exists():
+            new_file.unlink()
+        return cas_nr, None, None
+
+
+def _conditional_check(full_url: str, etag: Optional[str], last_modified: Optional[str],
+                       content_length: Optional[int]) -> str:
+    """Ask the supplier if the SDS file at full_url changed since it was downloaded, without downloading it
+
+    Returns
+    -------
+    str
+        'unchanged', 'changed' (or cannot be told without downloading it),
+        or 'gone' if the url does not give an SDS file anymore
+    """
+    global download_headers
+
+    headers = dict(download_headers)
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    # Streamed: the body of a changed SDS file is not read
+    with http_get(full_url, headers=headers, timeout=20, stream=True) as r:
+        if r.status_code == 304:
+            return 'unchanged'
+        if r.status_code != 200 or len(r.history) != 0 or not is_pdf_content_type(r.headers.get('Content-Type')):
+            return 'gone'
+        # Servers ignoring the conditional headers: compare the validators
+        if etag and r.headers.get('ETag'):
+            return 'unchanged' if r.headers['ETag'] == etag else 'changed'
+        if last_modified and r.headers.get('Last-Modified'):
+            return 'unchanged' if r.headers['Last-Modified'] == last_modified else 'changed'
+        # Without ETag or Last-Modified, a revised SDS is taken to have another size
+        if content_length and r.headers.get('Content-Length'):
+            return 'unchanged' if int(r.headers['Content-Length']) == content_length else 'changed'
+        return 'changed'
+
+
+def open_job_queue(database: str, password: str) -> JobQueue:
+    """Open the job table of the distributed mode: in `job_queue_file`, or in the database"""
+    global job_queue_file
+
+    if job_queue_file:
+        return JobQueue.sqlite(job_queue_file)
+    return JobQueue(connect_database(database, password))
+
+
+def run_coordinator(mariadb_connection, queue: JobQueue, to_be_downloaded: Iterable[str],
+                    batch_size: int = 100) -> int:
+    """Put the CAS numbers in the job table, and update the database with the SDS found by the workers
+
+    The SDS files sent by the workers are saved in the download folder, then
+    uploaded like the ones downloaded by this process. A job is removed from
+    the table once its SDS is in the database: a coordinator restarted after
+    a crash applies the results it had not applied yet.
+
+    Parameters
+    ----------
+    mariadb_connection : mysql.connector Object
+        an established connection to the SQL database
+    queue : JobQueue
+        the job table
+    to_be_downloaded : Iterable[str]
+        the CAS numbers of the molecules missing SDS
+    batch_size : int, optional
+        the number of jobs applied in each transaction, by default 100
+
+    Returns
+    -------
+    int
+        the number of CAS numbers updated
+    """
+    global poll_interval, status_interval
+
+    print(f'Coordinator: {queue.enqueue(to_be_downloaded)} CAS numbers queued for the workers')
+    count_file_updated = 0
+    last_status = time.monotonic()
+    try:
+        while True:
+            queue.give_up_expired()
+            jobs = queue.done_jobs(batch_size)
+            if jobs:
+                results = [_save_job_result(*job) for job in jobs]
+                count_file_updated += update_sql_sds_batch(mariadb_connection, results, batch_size=batch_size)
+                queue.remove(cas_nr for cas_nr, found, sds_source, sds_file in jobs)
+                continue
+            if queue.is_drained():
+                return count_file_updated
+            if status_interval > 0 and time.monotonic() - last_status >= status_interval:
+                last_status = time.monotonic()
+                print(f'\nJobs: {queue.counts()}, {count_file_updated} SDS updated')
+            time.sleep(poll_interval)
+    finally:
+        queue.close()
+
+
+def _save_job_result(cas_nr: str, found: bool, sds_source: Optional[str],
+                     sds_file: Optional[bytes]) -> Tuple[str, bool, Optional[str]]:
+    """Save the SDS file sent by a worker in the download folder, and get the `download_sds()` result of the job"""
+    global download_path, deduplicate
+
+    download_file = Path(download_path) / f'{cas_nr}.pdf'
+    if not found or not sds_file:
+        return cas_nr, False, None
+    if not (download_file.exists() and is_valid_pdf(download_file)):
+        fd, temp_file = tempfile.mkstemp(dir=str(download_file.parent), prefix=f'.{download_file.name}.', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(sds_file)
+            os.replace(temp_file, str(download_file))
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        if deduplicate:
+            sds_store.store_file(download_file)
+    return cas_nr, True, sds_source
+
+
+def run_worker(queue: JobQueue, worker: Optional[str] = None, lease_size: Optional[int] = None) -> int:
+    """Search and download the SDS of the jobs of the job table until none is left
+
+    The jobs are leased `lease_size` at a time, as the downloads of the
+    previous ones finish, and each result (with its SDS file) is put back in
+    the job table as soon as it is known.
+
+    Parameters
+    ----------
+    queue : JobQueue
+        the job table
+    worker : Optional[str], optional
+        the name of this worker, by default '<host>:<pid>'
+    lease_size : Optional[int], optional
+        the number of jobs leased at a time, by default `concurrency`
+
+    Returns
+    -------
+    int
+        the number of jobs done
+    """
+    global concurrency
+
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_run_worker(queue, worker, lease_size or concurrency))
+    finally:
+        loop.close()
+
+
+async def _run_worker(queue: JobQueue, worker: str, lease_size: int) -> int:
+    """Run the downloads of the leased jobs and give back their results, see `run_worker()`"""
+    global concurrency, poll_interval, download_path
+
+    # Lease token of each CAS number leased
+    tokens: Dict[str, str] = {}
+
+    def leased_cas() -> Iterator[str]:
+        while True:
+            token, cas_list = queue.lease(worker, lease_size)
+            if not cas_list:
+                if queue.is_drained():
+                    return
+                # The jobs left are leased by other workers, they come back if a worker dies
+                time.sleep(poll_interval)
+                continue
+            for cas_nr in cas_list:
+                tokens[cas_nr] = token
+                yield cas_nr
+
+    def complete(result: Tuple[str, bool, Optional[str]]) -> None:
+        cas_nr, downloaded, sds_source = result
+        sds_file = None
+        if downloaded:
+            sds_file = (Path(download_path) / f'{cas_nr}.pdf').read_bytes()
+        if not queue.complete(cas_nr, tokens.pop(cas_nr), downloaded, sds_source, sds_file):
+            print(f'{cas_nr}: lease expired, the job was given to another worker')
+
+    results = asyncio.Queue()
+    loop = asyncio.get_event_loop()
+    count = 0
+    with ThreadPoolExecutor(max_workers=1) as db_executor:
+        async def give_back() -> None:
+            nonlocal count
+            while True:
+                result = await results.get()
+                if result is None:
+                    return
+                try:
+                    await loop.run_in_executor(db_executor, complete, result)
+                    count += 1
+                except Exception as error:
+                    print('Error: {}'.format(error))
+
+        giver = loop.create_task(give_back())
+        try:
+            # One CAS at a time: a chunk waiting for the next lease would hold back the end of the previous one
+            await _download_all_sds(leased_cas(), concurrency, results, chunk_size=1)
+        finally:
+            await results.put(None)
+            await giver
+    return count
+
+
+def main_worker(database: str, password: str) -> int:
+    """Run as a worker of the distributed mode, see `run_worker()`"""
+    global download_path, search_cache
+
+    os.makedirs(download_path, exist_ok=True)
+    search_cache = SdsCache.in_folder(download_path)
+    apply_supplier_limits()
+    open_http_cache()
+    warm_up_sessions(supplier_urls)
+    count = 0
+    start = time.monotonic()
+    try:
+        count = run_worker(open_job_queue(database, password))
+    finally:
+        close_sessions()
+        close_http_cache()
+        search_cache.close()
+        search_cache = None
+        print('\nSupplier searches:')
+        print(metrics.format_supplier_summary())
+        metrics.write_metrics()
+        print(f'\nWorker: {count} jobs done in {time.monotonic() - start:.1f} s')
+    return count
+
+
+def start_journal(missing: Dict[str, Set[str]]) -> Dict[str, Set[str]]:
+    """Open the journal of the run in the download folder, and record the CAS numbers queued
+
+    With `resume`, the journal of the previous run is read and the CAS numbers
+    it finished (see `Journal.is_finished()`) are left out.
+
+    Parameters
+    ----------
+    missing : Dict[str, Set[str]]
+        the CAS numbers of the molecules missing SDS in each database
+
+    Returns
+    -------
+    Dict[str, Set[str]]
+        the CAS numbers left to do in each database
+    """
+    global journal, resume
+
+    open_journal()
+    if resume:
+        left = {database: {cas_nr for cas_nr in cas_list if not journal.is_finished(cas_nr, database)}
+                for database, cas_list in missing.items()}
+        for database, cas_list in missing.items():
+            print(f'Database {database.upper()}: resuming, {len(cas_list) - len(left[database])} CAS numbers '
+                  f'already done, {len(left[database])} left')
+        missing = left
+    # The CAS numbers already in the journal keep their state, e.g. 'resolved'
+    journal.record_many(sorted(cas_nr for cas_nr in set().union(*missing.values()) if journal.state(cas_nr) is None),
+                        'queued')
+    return missing
+
+
+def open_journal() -> None:
+    """Open the journal of the run in the download folder, the one of the previous run with `resume`"""
+    global journal, resume, download_path
+
+    journal = Journal.in_folder(download_path, resume=resume)
+
+
+def queue_in_journal(to_be_downloaded: Iterable[str], database: str = '') -> Iterator[str]:
+    """Record the CAS numbers queued in the journal as they are read, see `start_journal()`
+
+    With `resume`, the CAS numbers finished by the previous run are left out.
+    """
+    global journal, resume
+
+    skipped = 0
+    for cas_nr in to_be_downloaded:
+        if resume and journal.is_finished(cas_nr, database):
+            skipped += 1
+            continue
+        if journal.state(cas_nr) is None:
+            journal.record(cas_nr, 'queued')
+        yield cas_nr
+    if resume:
+        print(f'\nDatabase {database.upper()}: resumed, {skipped} CAS numbers were already done')
+
+
+def _close_quietly(mariadb_connection) -> None:
+    """Close a connection, whose last query may not be read to the end"""
+    try:
+        mariadb_connection.close()
+    except mariadb.Error:
+        pass
+
+
+def close_journal() -> None:
+    """Close the journal of the run, if open"""
+    global journal
+
+    if journal is not None:
+        journal.close()
+        journal = None
+
+
+def _journal_applied(mariadb_connection, cas_list: Iterable[str]) -> None:
+    """Record in the journal the CAS numbers whose SDS was uploaded in the database of the connection"""
+    global journal
+
+    if journal is not None:
+        database = _database_name(mariadb_connection)
+        for cas_nr in cas_list:
+            journal.record(cas_nr, 'applied', database=database)
+
+
+def connect_database(database: Optional[str], password: str):
+    """Open a connection to database on `db_host`, as `db_user`
+
+    Parameters
+    ----------
+    database : Optional[str]
+        the name of the database, None to connect to the server only
+    password : str
+        the password of `db_user`
+
+    Returns
+    -------
+    mysql.connector Object
+        the connection
+    """
+    global db_host, db_user, db_compress, upload_mode
+
+    settings = {'database': database} if database else {}
+    # Sending the SDS files as long data needs the pure Python connector. With FOUND_ROWS, the
+    # rowcount of an UPDATE is the number of molecules matched, even if the SDS did not change
+    return mariadb.connect(host=db_host, user=db_user, password=password, compress=db_compress,
+                           use_pure=(upload_mode == 'client'), client_flags=[mariadb.ClientFlag.FOUND_ROWS],
+                           **settings)
+
+
+def select_missing_cas(mariadb_connection, database: str = '') -> Set[str]:
+    """Get the CAS numbers of the molecules missing SDS in the database of the connection
+
+    With `incremental`, only the molecules added since the watermark of the
+    previous run are looked at, except for a full sweep every
+    `full_sweep_interval` seconds. The new watermark is saved by
+    `save_watermarks()`, once the SDS are downloaded.
+
+    Parameters
+    ----------
+    mariadb_connection : mysql.connector Object
+        an established connection to the SQL database
+    database : str, optional
+        the name of the database, the watermarks are kept for each database
+
+    Returns
+    -------
+    Set[str]
+        the CAS numbers to download
+    """
+    cursor_select = mariadb_connection.cursor(buffered=True)
+    start = time.monotonic()
+    try:
+        cursor_select.execute(*_select_missing_query(mariadb_connection, database))
+        return {cas_nr for (cas_nr, ) in cursor_select.fetchall()}
+    finally:
+        cursor_select.close()
+        metrics.phase_seconds.inc(time.monotonic() - start, phase='select')
+
+
+def iter_missing_cas(mariadb_connection, database: str = '') -> Iterator[str]:
+    """Read the CAS numbers of the molecules missing SDS as the database server sends them
+
+    Same as `select_missing_cas()`, through an unbuffered cursor read
+    `scan_chunk_size` rows at a time: the rows are not all held in memory,
+    and the downloads start while the server is still sending them. The
+    connection cannot run other queries until the generator is exhausted
+    or closed, it must not be the one the SDS are uploaded with.
+
+    Yields
+    ------
+    str
+        the CAS numbers to download
+    """
+    global scan_chunk_size
+
+    query = _select_missing_query(mariadb_connection, database)
+    start = time.monotonic()
+    cursor_select = mariadb_connection.cursor(buffered=False)
+    try:
+        cursor_select.execute(*query)
+        while True:
+            rows = cursor_select.fetchmany(scan_chunk_size)
+            if not rows:
+                break
+            for (cas_nr, ) in rows:
+                yield cas_nr
+    finally:
+        try:
+            cursor_select.close()
+        except mariadb.Error:
+            # Rows left unread if the downloads stopped early, the connection is closed anyway
+            pass
+        metrics.phase_seconds.inc(time.monotonic() - start, phase='select')
+
+
+def _select_missing_query(mariadb_connection, database: str) -> Tuple[str, tuple]:
+    """Get the query (and its parameters) selecting the CAS numbers to download, see `select_missing_cas()`"""
+    global select_missing_query, select_missing_since_query, incremental, full_sweep, full_sweep_interval, search_cache
+    global use_status_table, select_missing_status_query, select_missing_status_since_query
+
+    query, since_query = select_missing_query, select_missing_since_query
+    if use_status_table:
+        query, since_query = select_missing_status_query, select_missing_status_since_query
+    if not incremental or search_cache is None:
+        if use_status_table:
+            sync_status_table(mariadb_connection, full=full_sweep, database=database)
+        return query, ()
+    cursor = mariadb_connection.cursor(buffered=True)
+    try:
+        # Taken before the SELECT: the molecules added meanwhile are looked at next time
+        cursor.execute(max_molecule_id_query)
+        (max_molecule_id, ) = cursor.fetchone()
+    finally:
+        cursor.close()
+    watermark = search_cache.watermark(database)
+    sweep = full_sweep or watermark is None or time.time() - watermark[1] >= full_sweep_interval
+    _pending_watermarks[database] = (max_molecule_id or 0, sweep)
+    if use_status_table:
+        sync_status_table(mariadb_connection, full=sweep, database=database)
+    if sweep:
+        print(f'Database {database.upper()}: full sweep of all the molecules')
+        return query, ()
+    if not daemon_mode:
+        print(f'Database {database.upper()}: molecules added after molecule_id {watermark[0]}')
+    return since_query, (watermark[0], )
+
+
+def sync_status_table(mariadb_connection, full: bool = False, database: str = '') -> None:
+    """Create the status table if needed, and add the status of the molecules it does not have yet
+
+    The status of all the molecules is copied again every
+    `full_sweep_interval` seconds, to catch the SDS added in Open Enventory
+    to the molecules already in the status table.
+
+    Parameters
+    ----------
+    mariadb_connection : mysql.connector Object
+        an established connection to the SQL database
+    full : bool, optional
+        True to copy again the status of all the molecules now, by default
+        False (only the new molecules, unless the last full copy is too old)
+    database : str, optional
+        the name of the database, the time of the last full copy is kept for each database
+    """
+    global create_status_table_query, sync_status_query, max_status_id_query, search_cache, full_sweep_interval
+
+    # Kept with the watermarks of the databases, under a name of its own
+    synced = f'{database}:{status_table}'
+    if not full and search_cache is not None:
+        watermark = search_cache.watermark(synced)
+        full = watermark is None or time.time() - watermark[1] >= full_sweep_interval
+    start = time.monotonic()
+    cursor = mariadb_connection.cursor(buffered=True)
+    try:
+        cursor.execute(create_status_table_query)
+        last_molecule_id = 0
+        if not full:
+            cursor.execute(max_status_id_query)
+            (last_molecule_id, ) = cursor.fetchone() or (None, )
+        cursor.execute(sync_status_query, (last_molecule_id or 0, ))
+        mariadb_connection.commit()
+    finally:
+        cursor.close()
+    if full and search_cache is not None:
+        search_cache.save_watermark(synced, 0, full_sweep=True)
+    if full or not daemon_mode:
+        print(f'Status table {status_table}: molecules after molecule_id {last_molecule_id or 0} synced '
+              f'in {time.monotonic() - start:.3f} s')
+
+
+def save_watermarks() -> None:
+    """Save the watermarks of the databases selected by `select_missing_cas()` in this run"""
+    global search_cache
+
+    if search_cache is not None:
+        for database, (molecule_id, sweep) in _pending_watermarks.items():
+            search_cache.save_watermark(database, molecule_id, full_sweep=sweep)
+    _pending_watermarks.clear()
+
+
+def discover_databases(mariadb_connection) -> List[str]:
+    """Get the names of the Open Enventory databases on the server of the connection"""
+    global discover_databases_query
+
+    cursor = mariadb_connection.cursor(buffered=True)
+    try:
+        cursor.execute(discover_databases_query)
+        return [database for (database, ) in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def download_sds(cas_nr: str) -> Tuple[str, bool, Optional[str]]:
+    """Download SDS from variety of sources
+
+    Parameters
+    ----------
+    cas_nr : str
+        The CAS number of the molecule of interest
+
+    Returns
+    -------
+    Tuple[str, bool, Optional[str]]
+        - str: CAS number of the input chemical
+        - bool: True if SDS file downloaded or exists
+        - Optional[str]: the name of the SDS source or None
+    """
+    global download_path, debug, search_cache, revalidate, journal
+    '''This function is used to extract a single sds file
+    See here for more info: http://stackabuse.com/download-files-with-python/'''
+
+    # Set initial return value for if SDS is downloaded (or existed)
+    downloaded = False
+
+    file_name = cas_nr + '.pdf'
+    download_file = Path(download_path) / file_name
+    # Check if the file not exists and download
+    #check file exists: https://stackoverflow.com/questions/82831/how-do-i-check-whether-a-file-exists
+    # An incomplete file (e.g. left by an interrupted run) is downloaded again
+    if download_file.exists() and not is_valid_pdf(download_file):
+        download_file.unlink()
+    if download_file.exists():
+        # print('{} already downloaded'.format(file_name))
+        # print('.', end='')
+        downloaded = True
+        if journal is not None and journal.state(cas_nr) != 'downloaded':
+            journal.record(cas_nr, 'downloaded')
+        return cas_nr, downloaded, None
+
+    else:
+        print('\nSearching for {} ...'.format(file_name))
+        try:
+            # print('CAS {} ...'.format(file_name))
+
+            # Urls that did not give the SDS
+            dead_urls = set()
+            # Try first the url found by the interrupted run or by a previous run, if any
+            cached = journal.resolved_url(cas_nr) if journal is not None else None
+            if not cached and search_cache is not None and not revalidate:
+                cached = search_cache.cached_url(cas_nr)
+            if cached:
+                sds_source, full_url = cached
+                if _fetch_and_record(cas_nr, sds_source, full_url, download_file):
+                    downloaded = True
+                    _journal_downloaded(cas_nr, sds_source)
+                    return (cas_nr, downloaded, sds_source)
+                # The cached url does not give the SDS anymore, search the suppliers again
+                dead_urls.add(full_url)
+                if search_cache is not None:
+                    search_cache.forget_url(cas_nr)
+
+            # A url that does not give the SDS may come from a search answered by the HTTP cache:
+            # the suppliers are then searched once more, without the cached responses
+            refresh = bool(dead_urls) and http_sessions.response_cache is not None
+            while True:
+                searches = {}
+                sds_source, full_url = resolve_sds_url(cas_nr, searches=searches, refresh=refresh) or (None, None)
+
+                # print('full url is: {}'.format(full_url))
+                if not full_url or full_url in dead_urls:
+                    break
+                if journal is not None:
+                    journal.record(cas_nr, 'resolved', source=sds_source, url=full_url)
+                if _fetch_and_record(cas_nr, sds_source, full_url, download_file):
+                    downloaded = True
+                    _journal_downloaded(cas_nr, sds_source)
+                    return (cas_nr, downloaded, sds_source)
+                dead_urls.add(full_url)
+                if search_cache is not None:
+                    search_cache.forget_url(cas_nr)
+                if refresh or http_sessions.response_cache is None:
+                    break
+                refresh = True
+
+            # A CAS number is only finished if all the suppliers could be searched
+            # (list(): the searches of a race still running may add their outcome meanwhile)
+            if journal is not None and all(outcome in ('hit', 'miss') for outcome in list(searches.values())):
+                journal.record(cas_nr, 'missing')
+            #     return download_sds_tci(cas_nr)    # May 5, 2020: TCI has updated to newer website, scraping currently not working
+            return (cas_nr, downloaded, None)
+
+        except Exception as error:
+            # pass
+            # raise ValueError('{}: SDS not found from Fisher, VWR, or FluoroChem/Oakwood'.format(cas_nr))
+            if debug:
+                traceback_str = ''.join(traceback.format_exception(etype=type(error), value=error, tb=error.__traceback__))
+                print(traceback_str)
+            return (cas_nr, downloaded, None)
+
+
+def _journal_downloaded(cas_nr: str, sds_source: str) -> None:
+    global journal
+
+    if journal is not None:
+        journal.record(cas_nr, 'downloaded', source=sds_source)
+
+
+def _fetch_and_record(cas_nr: str, sds_source: str, full_url: str, download_file: Path) -> bool:
+    """Download the SDS file of cas_nr with `fetch_sds()`, and remember its validators for the refresh mode"""
+    global search_cache
+
+    validators = {}
+    if not fetch_sds(full_url, download_file, validators):
+        return False
+    if search_cache is not None:
+        search_cache.record_validators(cas_nr, sds_source, full_url, **validators)
+    return True
+
+
+def fetch_sds(full_url: str, download_file: Path, validators: Optional[Dict[str, object]] = None) -> bool:
+    """Download the SDS file at full_url
+
+    The file is streamed into a temporary file next to download_file, then
+    renamed into download_file once complete, so an interrupted download
+    never leaves a truncated SDS file behind.
+
+    Parameters
+    ----------
+    full_url : str
+        the URL of the SDS file
+    download_file : Path
+        where the SDS file is saved
+    validators : Optional[Dict[str, object]], optional
+        a dictionary filled with the 'etag', 'last_modified' and
+        'content_length' of the SDS file once downloaded, by default None
+
+    Returns
+    -------
+    bool
+        True if the SDS file is downloaded,
+        False if the url redirects, fails, does not give a complete PDF file
+        (see `is_valid_pdf()`) or gives a file bigger than `max_sds_size`
+    """
+    start = time.monotonic()
+    try:
+        downloaded = _fetch_sds(full_url, download_file, validators)
+    except Exception:
+        metrics.pdf_downloads.inc(result='error')
+        raise
+    finally:
+        metrics.pdf_download_seconds.observe(time.monotonic() - start)
+    metrics.pdf_downloads.inc(result='ok' if downloaded else 'rejected')
+    if downloaded and deduplicate:
+        sds_store.store_file(download_file)
+    if downloaded:
+        size = os.path.getsize(download_file)
+        metrics.pdf_size_bytes.observe(size)
+        metrics.http_response_bytes.inc(size, host=urlsplit(full_url.strip()).hostname or '')
+    return downloaded
+
+
+def _fetch_sds(full_url: str, download_file: Path, validators: Optional[Dict[str, object]] = None) -> bool:
+    """Download the SDS file at full_url, see `fetch_sds()`"""
+    global max_sds_size, download_headers
+
+    download_file = Path(download_file)
+    with http_get(full_url, headers=download_headers, timeout=20, stream=True) as r:
+        # Check to see if give OK status (200), not redirect, and not an error page
+        # (some suppliers answer 200 with an HTML page when the SDS is not available)
+        if r.status_code != 200 or len(r.history) != 0 or not is_pdf_content_type(r.headers.get('Content-Type')):
+            return False
+        if int(r.headers.get('Content-Length') or 0) > max_sds_size:
+            return False
+
+        fd, temp_file = tempfile.mkstemp(dir=str(download_file.parent), prefix=f'.{download_file.name}.', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                size = 0
+                head = b''
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    size += len(chunk)
+                    if size > max_sds_size:
+                        return False
+                    # The PDF header is allowed anywhere in the first 1024 bytes
+                    if len(head) < 1024:
+                        head += chunk[:1024 - len(head)]
+                        if len(head) == 1024 and b'%PDF' not in head:
+                            return False
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            # The same check as for the files already downloaded, so a file accepted here is not downloaded again
+            if not is_valid_pdf(Path(temp_file)):
+                return False
+            os.replace(temp_file, str(download_file))
+            if validators is not None:
+                validators.update(etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified'),
+                                  content_length=size)
+            return True
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+
+def is_pdf_content_type(content_type: Optional[str]) -> bool:
+    """Check if a Content-Type header may be a PDF file
+
+    Parameters
+    ----------
+    content_type : Optional[str]
+        the Content-Type header
+
+    Returns
+    -------
+    bool
+        False for text types (e.g. HTML error pages) and JSON, True otherwise
+        (some suppliers send PDF files as 'application/octet-stream' or without type)
+
+    Examples
+    --------
+    >>> is_pdf_content_type('application/pdf')
+    True
+    >>> is_pdf_content_type('text/html; charset=utf-8')
+    False
+    """
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    return not (content_type.startswith('text/') or content_type.endswith('json') or content_type.endswith('xml'))
+
+
+def is_valid_pdf(sds_file: Path) -> bool:
+    """Check that a downloaded SDS file is a complete PDF file
+
+    Both the files downloaded by `fetch_sds()` and the files already in the
+    download folder are checked with it.
+
+    Parameters
+    ----------
+    sds_file : Path
+        the SDS file
+
+    Returns
+    -------
+    bool
+        True if the file starts with the PDF header and ends with the
+        end-of-file marker, False otherwise (e.g. truncated file)
+    """
+    try:
+        with open(sds_file, 'rb') as f:
+            head = f.read(1024)
+            f.seek(max(0, os.fstat(f.fileno()).st_size - 2048))
+            tail = f.read()
+    except OSError:
+        return False
+    return b'%PDF' in head and b'%%EOF' in tail
+
+
+def get_extractor(supplier: str):
+    """Get the `extract_download_url_from_<supplier>()` function of a supplier
+
+    Parameters
+    ----------
+    supplier : str
+        the name of the supplier, e.g. 'fisher'
+
+    Returns
+    -------
+    Callable[[str], Optional[Tuple[str, str]]]
+        the extractor function of this supplier
+    """
+    # Looked up at call time so that the extractors can be swapped out (e.g. in tests)
+    return globals()[f'extract_download_url_from_{supplier}']
+
+
+def resolve_sds_url(cas_nr: str, suppliers: Optional[List[str]] = None,
+                    searches: Optional[Dict[str, str]] = None, refresh: bool = False) -> Optional[Tuple[str, str]]:
+    """Search the suppliers for the url of the SDS of cas_nr
+
+    Parameters
+    ----------
+    cas_nr : str
+        The CAS number of the molecule of interest
+    suppliers : Optional[List[str]], optional
+        the suppliers to search, in order of priority, by default None (use `supplier_order`)
+    searches : Optional[Dict[str, str]], optional
+        a dictionary filled with the outcome of the search of each supplier
+        searched, see `search_supplier()`, by default None
+    refresh : bool, optional
+        True to send the searches again instead of answering them from the
+        HTTP cache, see `search_supplier()`, by default False
+
+    Returns
+    -------
+    Optional[Tuple[str, str]]
+        Tuple[str, str]:
+            the name of the SDS source
+            the URL for SDS file
+        None: if URL cannot be found
+    """
+    global supplier_order, race_suppliers, search_cache, revalidate
+
+    suppliers = order_suppliers(cas_nr) if suppliers is None else suppliers
+    # Skip the suppliers known not to have this SDS
+    if search_cache is not None and not revalidate:
+        known_misses = search_cache.known_misses(cas_nr)
+        suppliers = [supplier for supplier in suppliers if supplier not in known_misses]
+
+    if race_suppliers:
+        return race_sds_url(cas_nr, suppliers, searches, refresh)
+
+    # Stop at the first supplier having the SDS
+    for supplier in suppliers:
+        result = search_supplier(supplier, cas_nr, searches, refresh)
+        if result:
+            _record_url(cas_nr, supplier, result)
+            return result
+    return None
+
+
+def order_suppliers(cas_nr: str) -> List[str]:
+    """Order the suppliers by their expected time to give the SDS of cas_nr
+
+    A supplier with a hit rate p and a mean search time t is expected to take
+    t / p seconds to give an SDS: searching the suppliers by increasing t / p
+    minimizes the expected time until the SDS is found. The hit rates are
+    smoothed with one hit in two searches, so the suppliers not searched yet
+    are tried early, and the suppliers that almost never have the SDS are skipped.
+
+    Parameters
+    ----------
+    cas_nr : str
+        The CAS number of the molecule of interest
+
+    Returns
+    -------
+    List[str]
+        the suppliers to search, `supplier_order` if `adaptive_order` is False or
+        no statistics are kept
+    """
+    global supplier_order, adaptive_order, search_cache, stats_by_prefix, revalidate
+    global min_hit_rate, min_searches, explore_rate, default_search_seconds
+
+    if not adaptive_order or search_cache is None:
+        return list(supplier_order)
+
+    stats = search_cache.supplier_stats()
+    if stats_by_prefix:
+        # The statistics of the prefix are used once there are enough of them
+        prefix_stats = search_cache.supplier_stats(sds_cache.cas_prefix(cas_nr))
+        stats.update({supplier: value for supplier, value in prefix_stats.items() if value[0] >= min_searches})
+
+    def expected_seconds(supplier):
+        searches, hits, seconds = stats.get(supplier, (0, 0, 0.0))
+        mean_seconds = seconds / searches if searches else default_search_seconds
+        return mean_seconds / ((hits + 1) / (searches + 2))
+
+    def skipped(supplier):
+        searches, hits, _ = stats.get(supplier, (0, 0, 0.0))
+        return (not revalidate and searches >= min_searches and hits / searches < min_hit_rate
+                and random.random() >= explore_rate)
+
+    # sorted() is stable: suppliers with the same statistics stay in `supplier_order`
+    return [supplier for supplier in sorted(supplier_order, key=expected_seconds) if not skipped(supplier)]
+
+
+def search_supplier(supplier: str, cas_nr: str, searches: Optional[Dict[str, str]] = None,
+                    refresh: bool = False) -> Optional[Tuple[str, str]]:
+    """Search one supplier for the url of the SDS of cas_nr, and record in
+    the cache when the supplier does not have it
+
+    Parameters
+    ----------
+    supplier : str
+        the name of the supplier, e.g. 'fisher'
+    cas_nr : str
+        The CAS number of the molecule of interest
+    searches : Optional[Dict[str, str]], optional
+        a dictionary where the outcome of the search is set for supplier:
+        'hit', 'miss', 'unreachable' (a request failed) or 'error' (the
+        search raised an error), by default None
+    refresh : bool, optional
+        True to send the requests of the search again instead of answering
+        them from the HTTP cache, and to replace their cached responses, by
+        default False
+
+    Returns
+    -------
+    Optional[Tuple[str, str]]
+        same as `resolve_sds_url()`
+    """
+    global search_cache
+
+    failures = request_failures()
+    start = time.monotonic()
+    try:
+        if refresh:
+            # The requests are sent by this thread, also when racing the suppliers
+            with bypassing_cache():
+                result = get_extractor(supplier)(cas_nr)
+        else:
+            result = get_extractor(supplier)(cas_nr)
+    except Exception:
+        metrics.extractor_searches.inc(supplier=supplier, result='error')
+        if searches is not None:
+            searches[supplier] = 'error'
+        raise
+    finally:
+        seconds = time.monotonic() - start
+        metrics.extractor_seconds.observe(seconds, supplier=supplier)
+    # A supplier that could not be reached is not a miss, it is searched again next time.
+    # The failures are counted by the thread sending the requests, i.e. this one
+    reached = request_failures() == failures
+    outcome = 'hit' if result else 'miss' if reached else 'unreachable'
+    metrics.extractor_searches.inc(supplier=supplier, result=outcome)
+    if searches is not None:
+        searches[supplier] = outcome
+    if search_cache is not None:
+        # Unreachable suppliers are counted as well, their timeouts are part of the cost of searching them
+        search_cache.record_search(cas_nr, supplier, bool(result), seconds)
+    if not result and search_cache is not None and reached:
+        search_cache.record_miss(cas_nr, supplier)
+    return result
+
+
+def _record_url(cas_nr: str, supplier: str, result: Tuple[str, str]) -> None:
+    """Record in the cache the url of the SDS of cas_nr chosen from supplier"""
+    global search_cache
+
+    if search_cache is not None:
+        search_cache.record_url(cas_nr, supplier, *result)
+
+
+def race_sds_url(cas_nr: str, suppliers: List[str], searches: Optional[Dict[str, str]] = None,
+                 refresh: bool = False) -> Optional[Tuple[str, str]]:
+    """Query all suppliers at the same time for the url of the SDS of cas_nr
+
+    The result of the highest priority supplier is taken as soon as it and every
+    supplier with a higher priority have answered. The other queries are then cancelled.
+
+    Parameters
+    ----------
+    cas_nr : str
+        The CAS number of the molecule of interest
+    suppliers : List[str]
+        the suppliers to search, in order of priority
+    searches : Optional[Dict[str, str]], optional
+        a dictionary filled with the outcome of the search of each supplier
+        answering, see `search_supplier()`, by default None
+    refresh : bool, optional
+        True to send the searches again instead of answering them from the
+        HTTP cache, by default False
+
+    Returns
+    -------
+    Optional[Tuple[str, str]]
+        same as `resolve_sds_url()`
+    """
+    global _race_executor, concurrency, debug
+
+    if _race_executor is None:
+        with _race_executor_lock:
+            if _race_executor is None:
+                # Every CAS in flight may query all suppliers at the same time
+                _race_executor = ThreadPoolExecutor(max_workers=max(concurrency, 1) * len(supplier_order))
+
+    futures = [_race_executor.submit(search_supplier, supplier, cas_nr, searches, refresh) for supplier in suppliers]
+    try:
+        # Wait for the answers in order of priority
+        for supplier, future in zip(suppliers, futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                # A failing supplier must not hide the answer of the others
+                if debug:
+                    traceback_str = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+                    print(traceback_str)
+                continue
+            if result:
+                _record_url(cas_nr, supplier, result)
+                return result
+        return None
+    finally:
+        # Queries already running cannot be interrupted, their answers are ignored
+        for future in futures:
+            future.cancel()
+
+
+def apply_supplier_limits() -> None:
+    """Set the rate limit of the hosts of every supplier listed in `supplier_limits`"""
+    global supplier_limits, supplier_hosts
+
+    for supplier, limit in supplier_limits.items():
+        for host in supplier_hosts[supplier]:
+            rate_limit.set_host_limit(host, limit)
+
+
+def open_http_cache() -> None:
+    """Open the cache of the supplier responses in the download folder, unless `use_http_cache` is off
+
+    With `revalidate`, the suppliers are searched again and the cache only
+    takes their new responses.
+    """
+    global use_http_cache, supplier_cache_ttls, supplier_hosts, download_path, revalidate
+
+    if not use_http_cache or http_sessions.response_cache is not None:
+        return
+    for supplier, ttl in supplier_cache_ttls.items():
+        for host in supplier_hosts[supplier]:
+            http_cache.host_ttls[host] = ttl
+    http_sessions.response_cache = http_cache.HttpCache.in_folder(download_path, refresh=revalidate)
+
+
+def close_http_cache() -> None:
+    """Close the cache of the supplier responses, if open"""
+    if http_sessions.response_cache is not None:
+        http_sessions.response_cache.close()
+        http_sessions.response_cache = None
+
+
+def parse_rate_limit(value: str) -> Tuple[str, RateLimit]:
+    """Parse a rate limit given on the command line
+
+    Parameters
+    ----------
+    value : str
+        'SUPPLIER=RATE[/MAX_CONCURRENCY]', SUPPLIER being a name from
+        `supplier_order` or 'default'
+
+    Returns
+    -------
+    Tuple[str, RateLimit]
+        the supplier name and its rate limit
+
+    Examples
+    --------
+    >>> parse_rate_limit('fisher=2/8')
+    ('fisher', RateLimit(rate=2.0, burst=2, max_concurrency=8))
+    """
+    try:
+        supplier, limit = value.split('=')
+        rate, _, max_concurrency = limit.partition('/')
+        rate = float(rate)
+        max_concurrency = int(max_concurrency) if max_concurrency else RateLimit().max_concurrency
+        if rate <= 0 or max_concurrency <= 0:
+            raise ValueError
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid rate limit "{value}", expected SUPPLIER=RATE[/MAX_CONCURRENCY]')
+    if supplier != 'default' and supplier not in supplier_hosts:
+        raise argparse.ArgumentTypeError(f'unknown supplier "{supplier}", expected one of: {", ".join(supplier_hosts)}')
+    return supplier, RateLimit(rate=rate, burst=max(1, round(rate)), max_concurrency=max_concurrency)
+
+
+def download_all_sds(to_be_downloaded: Iterable[str],
+                     max_concurrency: int = 100) -> List[Tuple[str, bool, Optional[str]]]:
+    """Download SDS for many CAS numbers concurrently using an asyncio event loop
+
+    Parameters
+    ----------
+    to_be_downloaded : Iterable[str]
+        the CAS numbers of the molecules missing SDS
+    max_concurrency : int, optional
+        the maximum number of CAS being searched/downloaded at the same time, by default 100
+
+    Returns
+    -------
+    List[Tuple[str, bool, Optional[str]]]
+        the list of `download_sds()` results, one tuple for each CAS number
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_download_all_sds(to_be_downloaded, max_concurrency))
+    finally:
+        loop.close()
 
 
-def main(database, password):
-    global download_path, debug
+def download_and_update_sds(mariadb_connection, to_be_downloaded: Iterable[str],
+                            max_concurrency: int = 100, batch_size: int = 100,
+                            stop: Optional[threading.Event] = None) -> int:
+    """Download SDS for many CAS numbers concurrently, and update the SQL
+    database with the SDS as soon as they are downloaded
 
-    """
-    Info for mysql connection and query can be found here:
-     https://mariadb.com/resources/blog/how-connect-python-programs-mariadb
-     https://dev.mysql.com/doc/connector-python/en/connector-python-tutorial-cursorbuffered.html
+    The results stream from the downloads into a single database writer,
+    which applies them in batches of up to `batch_size` CAS numbers. The
+    updates overlap the downloads, and the SDS downloaded before a failure
+    are already in the database.
 
-    Handling error in password or database not exists:
-    https://dev.mysql.com/doc/connector-python/en/connector-python-example-connecting.html
-    https://dev.mysql.com/doc/connector-python/en/connector-python-api-errorcode.html
-    """
+    Parameters
+    ----------
+    mariadb_connection : mysql.connector Object
+        an established connection to the SQL database
+    to_be_downloaded : Iterable[str]
+        the CAS numbers of the molecules missing SDS
+    max_concurrency : int, optional
+        the maximum number of CAS being searched/downloaded at the same time, by default 100
+    batch_size : int, optional
+        the maximum number of CAS numbers updated in each transaction, by default 100
+    stop : Optional[threading.Event], optional
+        once set, no new CAS number is started and only the ones in flight
+        are downloaded and updated, by default None
 
-    # Open a connection to mysql
+    Returns
+    -------
+    int
+        the number of CAS numbers updated
+    """
+    loop = asyncio.new_event_loop()
     try:
-        mariadb_connection = mariadb.connect(user='root', password=password, database=database)
-        # Create a cursor in the sql table using the open connection
-        cursor_select = mariadb_connection.cursor(buffered=True)
-
-        # Step1: run SELECT query to find CAS#
-        print(f'Database: {database.upper()}')
-        print('Getting molecules with missing SDS. Please wait!')
-        # SDS found by OE that are marked as 'Acros' are corrupted, hence the query below
-        query = ("SELECT distinct cas_nr FROM molecule WHERE cas_nr!='' AND (default_safety_sheet_blob is NULL or default_safety_sheet_by is NULL or default_safety_sheet_by='Acros')")
-        try:
-            cursor_select.execute(query)
-        except mariadb.Error as error:
-            print('Error: {}'.format(error))
-
-        # Get the set of CAS for molecule missing sds in the database of interest:
-        # https://stackoverflow.com/questions/7558908/unpacking-a-list-tuple-of-pairs-into-two-lists-tuples
-        select_query_result = cursor_select.fetchall()
-        # Exit out of the script if all SDS exist
-        if not select_query_result:
-            print('Nothing to download. Exiting!')
-            exit()
-            
-        (to_be_downloaded, ) = zip(*select_query_result)
-        # Get the unique CAS number set
-        to_be_downloaded = set(to_be_downloaded)
+        return loop.run_until_complete(
+            _download_and_update_sds(mariadb_connection, to_be_downloaded, max_concurrency, batch_size, stop))
+    finally:
+        loop.close()
 
-        # Step 2: downloading sds file
-        # Check if download path with the missing_sds directory exists. If not, create it
-        # https://stackoverflow.com/questions/12517451/automatically-creating-directories-with-file-output
-        # https://docs.python.org/3/library/os.html#os.makedirs
-        os.makedirs(download_path, exist_ok=True)
 
-        print('Downloading missing SDS files. Please wait!')
+async def _download_and_update_sds(mariadb_connection, to_be_downloaded: Iterable[str],
+                                   max_concurrency: int, batch_size: int,
+                                   stop: Optional[threading.Event] = None) -> int:
+    """Run the downloads and the database writer, see `download_and_update_sds()`"""
+    counts = await _download_and_update_databases({'': mariadb_connection}, None, to_be_downloaded,
+                                                  max_concurrency, batch_size, stop)
+    return counts['']
 
-        download_result = []
-        # # Using multithreading
-        try:
-            with Pool(10) as p:
-                download_result = p.map(download_sds, to_be_downloaded)
 
-        except Exception as error:
-            if debug:
-                traceback_str = ''.join(traceback.format_exception(etype=type(error), value=error, tb=error.__traceback__))
-                print(traceback_str)
+def download_and_update_databases(connections: Dict[str, object], missing: Dict[str, Set[str]],
+                                  max_concurrency: int = 100, batch_size: int = 100) -> Dict[str, int]:
+    """Download the SDS missing in several databases, each CAS number once, and
+    update each database with the SDS it misses as soon as they are downloaded
 
-        # # Not using multithreading
-        # # to_be_downloaded = ['9012-36-6']   # for testing only
-        # try:
-        #     for cas in to_be_downloaded:
-        #         download_sds(cas)
-        # except Exception as error:
-        #     print(error)
+    Parameters
+    ----------
+    connections : Dict[str, mysql.connector Object]
+        an established connection to each database, by database name
+    missing : Dict[str, Set[str]]
+        the CAS numbers of the molecules missing SDS in each database
+    max_concurrency : int, optional
+        the maximum number of CAS being searched/downloaded at the same time, by default 100
+    batch_size : int, optional
+        the maximum number of CAS numbers updated in each transaction, by default 100
 
-        # Step 3: run UPDATE query to upload
-        finally:
-            # Sometimes Pool worker return 'None', remove 'None' as the following
-            download_result = [x for x in download_result if x]
+    Returns
+    -------
+    Dict[str, int]
+        the number of CAS numbers updated in each database
+    """
+    to_be_downloaded = set().union(*missing.values())
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            _download_and_update_databases(connections, missing, to_be_downloaded, max_concurrency, batch_size))
+    finally:
+        loop.close()
 
-            print('Updating SQL table!')
-            count_file_updated = 0
-            # for cas in to_be_downloaded:
-            for cas, downloaded, sds_source in download_result:
-                try:
-                    # run update_sql() and also increment the count for successful update
-                    # update_sql() return 1 if success, otherwise return 0
-                    count_file_updated += update_sql_sds(mariadb_connection, cas_nr=cas, sds_source=sds_source)
-                except mariadb.Error as error:
-                    print('Error: {}'.format(error))
 
-            mariadb_connection.close()
+class _DatabaseQueues:
+    """Queue-like fan-out putting each `download_sds()` result in the queue of
+    every database missing the SDS of its CAS number (None in all of them)
 
-            print('\nMolecules with missing SDS:')
-            print(missing_sds)
-            print(f'\nSummary for database {database.upper()}: ')
-            print('\t{} SDS files are missing.'.format(len(missing_sds)))
-            print('\t{} SDS files updated! '.format(count_file_updated))
+    Parameters
+    ----------
+    queues : Dict[str, asyncio.Queue]
+        the queue of each database writer
+    missing : Optional[Dict[str, Set[str]]]
+        the CAS numbers missing SDS in each database, None if all databases miss all of them
+    """
+    def __init__(self, queues: Dict[str, asyncio.Queue], missing: Optional[Dict[str, Set[str]]]):
+        self.queues = queues
+        self.missing = missing
+
+    async def put(self, result: Optional[Tuple[str, bool, Optional[str]]]) -> None:
+        for database, queue in self.queues.items():
+            if result is None or self.missing is None or result[0] in self.missing[database]:
+                await queue.put(result)
+
+
+async def _download_and_update_databases(connections: Dict[str, object], missing: Optional[Dict[str, Set[str]]],
+                                         to_be_downloaded: Iterable[str], max_concurrency: int,
+                                         batch_size: int, stop: Optional[threading.Event] = None) -> Dict[str, int]:
+    """Run the downloads and one database writer for each database, see `download_and_update_databases()`"""
+    loop = asyncio.get_event_loop()
+    queues = {database: asyncio.Queue() for database in connections}
+    results = _DatabaseQueues(queues, missing)
+    # Each SQL connection is only ever used by its own thread
+    db_executors = {database: ThreadPoolExecutor(max_workers=1) for database in connections}
+    writers = {database: loop.create_task(_update_sql_sds_from_queue(
+                   connection, queues[database], batch_size, db_executors[database],
+                   label=database if len(connections) > 1 else None))
+               for database, connection in connections.items()}
+    try:
+        await _download_all_sds(to_be_downloaded, max_concurrency, results, stop=stop)
+    finally:
+        # Apply whatever was downloaded, even if the downloads failed
+        await results.put(None)
+        counts = {database: await writer for database, writer in writers.items()}
+        for db_executor in db_executors.values():
+            db_executor.shutdown()
+    return counts
 
-            # Advice user about turning on debug mode for more error printing
-            print('\n\n(Optional): you can turn on debug mode (more error printing during structure search) using the following command:')
-            print('python oe_find_sds/find_sds.py  --debug\n')
 
-    except mariadb.Error as error:
-        if error.errno == mariadb.errorcode.ER_ACCESS_DENIED_ERROR:
-            print("Wrong password!")
-        elif error.errno == mariadb.errorcode.ER_BAD_DB_ERROR:
-            print("Database does not exist")
-        else:
-            traceback_str = ''.join(traceback.format_exception(etype=type(error), value=error, tb=error.__traceback__))
-            print(traceback_str)
-    else:
-        mariadb_connection.close()
+async def _update_sql_sds_from_queue(mariadb_connection, results: asyncio.Queue, batch_size: int,
+                                     db_executor: ThreadPoolExecutor, flush_interval: float = 5.0,
+                                     label: Optional[str] = None) -> int:
+    """Apply the `download_sds()` results put in the queue until None is put
 
+    A batch is applied when it reaches `batch_size` results, or when no new
+    result arrived for `flush_interval` seconds. If label (the database name)
+    is given, the progress is printed after each batch.
 
-def download_sds(cas_nr: str) -> Tuple[str, bool, Optional[str]]:
-    """Download SDS from variety of sources
+    Returns
+    -------
+    int
+        the number of CAS numbers updated
+    """
+    loop = asyncio.get_event_loop()
+    count_file_updated = 0
+    batch = []
+    while True:
+        try:
+            result = await asyncio.wait_for(results.get(), flush_interval)
+        except asyncio.TimeoutError:
+            # Nothing new for a while, apply the results waiting
+            result = False
+        if result:
+            batch.append(result)
+        if batch and (len(batch) >= batch_size or not result):
+            try:
+                count_file_updated += await loop.run_in_executor(
+                    db_executor, update_sql_sds_batch, mariadb_connection, batch, batch_size)
+            except Exception as error:
+                print('Error: {}'.format(error))
+            if label is not None:
+                print(f'Database {label.upper()}: {count_file_updated} SDS updated so far')
+            batch = []
+        if result is None:
+            return count_file_updated
+
+
+async def _download_all_sds(to_be_downloaded: Iterable[str], max_concurrency: int,
+                            results: Optional[asyncio.Queue] = None,
+                            chunk_size: Optional[int] = None,
+                            stop: Optional[threading.Event] = None) -> List[Tuple[str, bool, Optional[str]]]:
+    """Run `download_sds_async()` for every CAS number, at most `max_concurrency` at a time
+
+    to_be_downloaded may be a generator reading the database (see
+    `iter_missing_cas()`): it is read in chunks on its own thread, and the
+    downloads start with the first CAS numbers. Only the CAS numbers in
+    flight are held in memory, the results are only kept (and returned)
+    if no results queue is given. chunk_size is the number of CAS numbers
+    read at a time, by default `scan_chunk_size`. Once stop is set, no
+    more CAS numbers are read or started, and only the downloads in flight
+    are waited for.
+    """
+    global status_interval, scan_chunk_size
+
+    # Number of CAS numbers taken from to_be_downloaded and not done yet
+    slots = asyncio.Semaphore(max_concurrency)
+    loop = asyncio.get_event_loop()
+    reporter = loop.create_task(_report_status(status_interval)) if status_interval > 0 else None
+    cas_iterator = iter(to_be_downloaded)
+    tasks = []
+    running = set()
+    # The extractors are blocking network calls, they are run on a thread pool
+    # big enough to keep `max_concurrency` CAS in flight
+    try:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor, \
+                ThreadPoolExecutor(max_workers=1) as reader:
+            try:
+                while stop is None or not stop.is_set():
+                    chunk = await loop.run_in_executor(reader, list, itertools.islice(cas_iterator,
+                                                                                      chunk_size or scan_chunk_size))
+                    if not chunk:
+                        break
+                    for cas_nr in chunk:
+                        if stop is not None and stop.is_set():
+                            break
+                        await slots.acquire()
+                        if stop is not None and stop.is_set():
+                            # Set while waiting for a download to finish
+                            slots.release()
+                            break
+                        task = asyncio.ensure_future(download_sds_async(cas_nr, executor, results))
+                        task.add_done_callback(lambda task: slots.release())
+                        if results is None:
+                            tasks.append(task)
+                        else:
+                            running.add(task)
+                            task.add_done_callback(running.discard)
+            finally:
+                # The downloads started finish, also if reading to_be_downloaded failed
+                done = await asyncio.gather(*(tasks if results is None else list(running)))
+        return done if results is None else []
+    finally:
+        if reporter:
+            reporter.cancel()
+
+
+async def _report_status(interval: float) -> None:
+    """Print the request rate of each supplier host every `interval` seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        print('\nSupplier request rates:')
+        print(format_limiter_status())
+        print(metrics.format_supplier_summary())
+        metrics.write_metrics()
+
+
+async def download_sds_async(cas_nr: str, executor: ThreadPoolExecutor,
+                             results: Optional[asyncio.Queue] = None) -> Tuple[str, bool, Optional[str]]:
+    """Coroutine version of `download_sds()`, the caller limits the number of CAS in flight
 
     Parameters
     ----------
     cas_nr : str
         The CAS number of the molecule of interest
+    executor : ThreadPoolExecutor
+        the executor running the blocking network calls
+    results : Optional[asyncio.Queue], optional
+        a queue the result is also put in, by default None
 
     Returns
     -------
     Tuple[str, bool, Optional[str]]
-        - str: CAS number of the input chemical
-        - bool: True if SDS file downloaded or exists
-        - Optional[str]: the name of the SDS source or None
+        same as `download_sds()`
     """
-    global download_path, debug
-    '''This function is used to extract a single sds file
-    See here for more info: http://stackabuse.com/download-files-with-python/'''
-
-    headers = {
-        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/53.0.2785.143 Safari/537.36'}
-
-    # Set initial return value for if SDS is downloaded (or existed)
-    downloaded = False
-
-    file_name = cas_nr + '.pdf'
-    download_file = Path(download_path) / file_name
-    # Check if the file not exists and download
-    #check file exists: https://stackoverflow.com/questions/82831/how-do-i-check-whether-a-file-exists
-    if download_file.exists():
-        # print('{} already downloaded'.format(file_name))
-        # print('.', end='')
-        downloaded = True
-        return cas_nr, downloaded, None
-
-    else:
-        print('\nSearching for {} ...'.format(file_name))
-        try:
-            # print('CAS {} ...'.format(file_name))
-
-            sds_source, full_url = extract_download_url_from_chemblink(cas_nr) or \
-                extract_download_url_from_vwr(cas_nr) or \
-                extract_download_url_from_fisher(cas_nr) or \
-                extract_download_url_from_tci(cas_nr) or \
-                extract_download_url_from_chemicalsafety(cas_nr) or \
-                extract_download_url_from_fluorochem(cas_nr) or \
-                (None, None)
-
-            # print('full url is: {}'.format(full_url))
-            if full_url:    # extract with chemicalsafety
-                r = requests.get(full_url, headers=headers, timeout=20)
-                # Check to see if give OK status (200) and not redirect
-                if r.status_code == 200 and len(r.history) == 0:
-                    # print('\nDownloading {} ...'.format(file_name))
-                    open(download_file, 'wb').write(r.content)
-                    # print()
-                    # return (0, sds_source)
-                    downloaded = True
-                    return (cas_nr, downloaded, sds_source)
-
-            else:
-            #     return download_sds_tci(cas_nr)    # May 5, 2020: TCI has updated to newer website, scraping currently not working
-                return (cas_nr, downloaded, None)
-
-        except Exception as error:
-            # pass
-            # raise ValueError('{}: SDS not found from Fisher, VWR, or FluoroChem/Oakwood'.format(cas_nr))
-            if debug:
-                traceback_str = ''.join(traceback.format_exception(etype=type(error), value=error, tb=error.__traceback__))
-                print(traceback_str)
-            return (cas_nr, downloaded, None)
+    loop = asyncio.get_event_loop()
+    try:
+        result = await loop.run_in_executor(executor, download_sds, cas_nr)
+    except Exception as error:
+        if debug:
+            traceback_str = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+            print(traceback_str)
+        result = (cas_nr, False, None)
+    if results is not None:
+        await results.put(result)
+    return result
 
 
 def extract_download_url_from_vwr(cas_nr: str) -> Optional[Tuple[str, str]]:
@@ -254,42 +2095,42 @@ def extract_download_url_from_vwr(cas_nr: str) -> Optional[Tuple[str, str]]:
         print('Searching on https://us.vwr.com/store')
 
     try:
-        with requests.Session() as s1:
-            get_id = s1.get(adv_search_url, headers=headers, params=params, timeout=10)
+        get_id = http_get(adv_search_url, headers=headers, params=params, timeout=10)
 
-            if get_id.status_code == 200 and len(get_id.history) == 0:
-                html = BeautifulSoup(get_id.text, 'html.parser')
-                # print(html.prettify())
+        if get_id.status_code == 200 and len(get_id.history) == 0:
+            html = make_soup(get_id.text, page_filters['vwr'])
+            # print(html.prettify())
 
-                result_count_css = '.clearfix .pull-left'
-                result_count = re.search(r'(\d+).*results were found', html.select(result_count_css)[0].text)[1]
-                # print(result_count)
+            result_count_css = '.clearfix .pull-left'
+            result_count = re.search(r'(\d+).*results were found', html.select(result_count_css)[0].text)[1]
+            # print(result_count)
 
-                # Check to make sure that there is at least 1 hit
-                if result_count:
-                    # Find first product
-                    sds_link_css = 'td[data-title="SDS"] a'
-                    sds_links = html.select(sds_link_css)
-                    # print(sds_links[0]['href'])
-                    full_url = sds_links[0]['href']
+            # Check to make sure that there is at least 1 hit
+            if result_count:
+                # Find first product
+                sds_link_css = 'td[data-title="SDS"] a'
+                sds_links = html.select(sds_link_css)
+                # print(sds_links[0]['href'])
+                full_url = sds_links[0]['href']
 
-                    sds_manufacturer_css = 'td[data-title="Manufacturer"]'
-                    sds_manufacturers = html.select(sds_manufacturer_css)
-                    # print(sds_manufacturers[0].text)
-                    sds_source = sds_manufacturers[0].text.strip()
+                sds_manufacturer_css = 'td[data-title="Manufacturer"]'
+                sds_manufacturers = html.select(sds_manufacturer_css)
+                # print(sds_manufacturers[0].text)
+                sds_source = sds_manufacturers[0].text.strip()
 
-                    return sds_source, full_url
+                return sds_source, full_url
 
-                #     full_url = sds_links[0]['href']
-                #     sds = s1.get(full_url)
-                #     # print(sds.content)
+            #     full_url = sds_links[0]['href']
+            #     sds = http_get(full_url)
+            #     # print(sds.content)
 
-                #     # Check to see if give OK status (200) and not redirect
-                #     if sds.status_code == 200 and len(sds.history) == 0:
-                #         # print('\nDownloading {} ...'.format(file_name))
-                #         open('vwr0.pdf', 'wb').write(sds.content)
+            #     # Check to see if give OK status (200) and not redirect
+            #     if sds.status_code == 200 and len(sds.history) == 0:
+            #         # print('\nDownloading {} ...'.format(file_name))
+            #         open('vwr0.pdf', 'wb').write(sds.content)
 
     except Exception as error:
+        metrics.extractor_exceptions.inc(supplier='vwr', error=type(error).__name__)
         if debug:
             traceback_str = ''.join(traceback.format_exception(etype=type(error), value=error, tb=error.__traceback__))
             print(traceback_str)
@@ -332,12 +2173,12 @@ def extract_download_url_from_chemblink(cas_nr: str) -> Optional[Tuple[str, str]
         print('Searching on https://www.chemblink.com')
 
     try:
-        r1 = requests.get(extract_info_url, headers=headers, timeout=20)
+        r1 = http_get(extract_info_url, headers=headers, timeout=20)
         # print(r1)
 
         # Check to see if give OK status (200) and not redirect
         if r1.status_code == 200 and len(r1.history) == 0:
-            soup = BeautifulSoup(r1.text, 'html.parser')
+            soup = make_soup(r1.text, page_filters['chemblink'])
             if soup:
                 # Find all <a> tags with content "View / download", example: https://www.chemblink.com/MSDS/64-19-7_MSDS.htm
                 # Example of a correct <a> tag for SDS download: '<a href="/MSDS/MSDSFiles/64-19-7_Alfa-Aesar.pdf" class="blue" onclick="blur()" target="_blank">View / download</a>'
@@ -351,6 +2192,7 @@ def extract_download_url_from_chemblink(cas_nr: str) -> Optional[Tuple[str, str]
                     return source, full_url
 
     except Exception as error:
+        metrics.extractor_exceptions.inc(supplier='chemblink', error=type(error).__name__)
         # print('.', end='')
         if debug:
             traceback_str = ''.join(traceback.format_exception(etype=type(error), value=error, tb=error.__traceback__))
@@ -387,12 +2229,12 @@ def extract_download_url_from_fisher(cas_nr: str) -> Optional[Tuple[str, str]]:
         print('Searching on https://www.fishersci.com/us/en/catalog/search/sdshome.html')
 
     try:
-        r = requests.get(extract_info_url, headers=headers, timeout=10, params=payload)
+        r = http_get(extract_info_url, headers=headers, timeout=10, params=payload)
         # Check to see if give OK status (200) and not redirect
         if r.status_code == 200 and len(r.history) == 0:
             # BeautifulSoup ref: https://www.digitalocean.com/community/tutorials/how-to-scrape-web-pages-with-beautiful-soup-and-python-3
             # Using BeautifulSoup to scrap text
-            html = BeautifulSoup(r.text, 'html.parser')
+            html = make_soup(r.text, page_filters['fisher'])
             # The list of found sds is in class 'catalog_num', with each item in class 'catlog_items'
             # cat_no_list = html.find(class_='catalog_num')    # This is to find all of the sds
 
@@ -410,6 +2252,7 @@ def extract_download_url_from_fisher(cas_nr: str) -> Optional[Tuple[str, str]]:
                 return 'Fisher', full_url
 
     except Exception as error:
+        metrics.extractor_exceptions.inc(supplier='fisher', error=type(error).__name__)
         # print('.', end='')
         if debug:
             traceback_str = ''.join(traceback.format_exception(etype=type(error), value=error, tb=error.__traceback__))
@@ -421,6 +2264,9 @@ def extract_download_url_from_chemicalsafety(cas_nr: str) -> Optional[Tuple[str,
     """Search for url to download SDS for chemical with cas_nr
     from https://chemicalsafety.com/sds-search/
 
+    The requests already answered for other CAS numbers of the run are not
+    sent again, see `chemicalsafety.ChemicalSafetyResolver`.
+
     Parameters
     ----------
     cas_nr : str
@@ -434,55 +2280,20 @@ def extract_download_url_from_chemicalsafety(cas_nr: str) -> Optional[Tuple[str,
             the URL from Fisher for SDS file
         None: if URL cannot be found
     """
-    headers = {
-        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/53.0.2785.143 Safari/537.36',
-        'accept-encoding': 'gzip, deflate, br',
-        'content-type': 'application/json'}
-    # get url from chemicalsafety.com to get url to download sds file
-    extract_info_url = 'https://chemicalsafety.com/sds1/retriever.php'
-    form1 = {
-        "action": "search",
-        "p1": "MSMSDS.COMMON|",
-        "p2": "MSMSDS.MANUFACT|",
-        "p3": "MSCHEM.CAS|" + cas_nr,
-        "hostName": "chemicalsafety.com",
-        "isContains": "0"
-        }
+    global chemicalsafety_resolver
 
     if debug:
         print('Searching on https://chemicalsafety.com/sds-search/')
 
     try:
-        r1 = requests.post(extract_info_url, headers=headers,
-                data=json.dumps(form1), timeout=20)
-        # Check to see if give OK status (200) and not redirect
-        if r1.status_code == 200 and len(r1.history) == 0:
-            id_list = r1.json()['rows']
-            msds_id = ''
-            for item in id_list:
-                if item[3] == cas_nr:
-                    msds_id = item[0]
-                    break
-            if msds_id != '':
-                form2 = {"action": "msdsdetail",
-                        "p1": msds_id,
-                        "p2": "",
-                        "p3": "",
-                        "isContains": ""}
-                r2 = requests.post(extract_info_url, headers=headers,
-                        data=json.dumps(form2), timeout=20)
-                result = r2.json()['rows'][0]
-                #Confirm the msds_id and cas_nr:
-                if msds_id == result[0] and cas_nr == result[3]:
-                    sds_pdf_file = result[10].rstrip(',')
-                    form3 = {"action":"getpdfurl","p1":sds_pdf_file,"p2":"","p3":"","isContains":""}
-                    r3 = requests.post(extract_info_url, headers=headers, data=json.dumps(form3), timeout=20)
-                    #Get the url
-                    # Translate curl to python https://curl.trillworks.com/
-                    # urllib.parse doc: https://docs.python.org/3.6/library/urllib.parse.html
-                    full_url = r3.json()['url']
-                    return 'ChemicalSafety', full_url
+        if http_sessions.cache_bypassed():
+            # Searched again: the answers kept gave a url that does not give the SDS
+            chemicalsafety_resolver.forget(cas_nr)
+        full_url = chemicalsafety_resolver.resolve(cas_nr, http_post)
+        if full_url:
+            return 'ChemicalSafety', full_url
     except Exception as error:
+        metrics.extractor_exceptions.inc(supplier='chemicalsafety', error=type(error).__name__)
         # print('.', end='')
         if debug:
             traceback_str = ''.join(traceback.format_exception(etype=type(error), value=error, tb=error.__traceback__))
@@ -523,13 +2334,13 @@ def extract_download_url_from_fluorochem(cas_nr: str) -> Optional[Tuple[str, str
         print('Searching on fluorochem.co.uk')
 
     try:
-        r = requests.post(url, headers=headers, timeout=20, data=json.dumps(payload))
+        r = http_post(url, headers=headers, timeout=20, data=json.dumps(payload))
         # No need to check if requests give OK status (200) and not redirect because
         # fluorochem return code 200 without redirect with error
 
         # BeautifulSoup ref: https://www.digitalocean.com/community/tutorials/how-to-scrape-web-pages-with-beautiful-soup-and-python-3
         # Using BeautifulSoup to scrap text
-        html = BeautifulSoup(r.text, 'html.parser')
+        html = make_soup(r.text, page_filters['fluorochem'])
         if html:
             result = html.find_all('td')
             if result:
@@ -544,6 +2355,7 @@ def extract_download_url_from_fluorochem(cas_nr: str) -> Optional[Tuple[str, str
                 full_url = download_url.format(cat_no_2)
                 return 'Fluorochem', full_url
     except Exception as error:
+        metrics.extractor_exceptions.inc(supplier='fluorochem', error=type(error).__name__)
         #     print('.', end='')
         if debug:
             traceback_str = ''.join(traceback.format_exception(etype=type(error), value=error, tb=error.__traceback__))
@@ -584,75 +2396,76 @@ def extract_download_url_from_tci(cas_nr: str) -> Optional[Tuple[str, str]]:
         print('Searching on https://www.tcichemicals.com')
 
     try:
-        with requests.Session() as s:
-            get_id = s.get(adv_search_url, headers=headers, timeout=10)
-
-            if get_id.status_code == 200 and len(get_id.history) == 0:
-                # get_id.text
-                html = BeautifulSoup(get_id.text, 'html.parser')
-                # print(html.prettify()); exit(1)
-
-                # Get the token, required for POST request for SDS file name later
-                csrf_token = html.find('input', attrs={'name': 'CSRFToken'})['value']
-                # print(csrf_token)
-
-                region_code = html.find_all(string=re.compile(r'(encodedContextPath[^;]+?;)'))
-                # print(region_code[0])
-                encodedContextPath = re.search(r'(encodedContextPath[^;]+?\'(\S+)\';)', region_code[0])[2].replace('\\' ,'')
-                # print(encodedContextPath)
-
-                product_cat_css = 'div#contentSearchFacet > span.facet__text:first-child > a:first-child'
-                product_category = html.select(product_cat_css)[0]
-                # print(product_category)
-
-                hit_count = 0
-                if product_category.text == 'Products':
-                    hit_count = re.search(r'\((\d+)\)',
-                                        html.select(f'{product_cat_css} + span.facet__value__count')[0].text)[1]
-                # print(hit_count)
-
-                # Check to make sure that there is at least 1 hit
-                if hit_count:
-                    # Find the first hit
-                    first_hit_div = html.find('div', class_='prductlist')
-                    # print(first_hit_form)
-
-                    # Find the CAS# for the first hit
-                    returned_cas = first_hit_div['data-casno']
-                    # print(returned_cas)
-
-                    # Confirm the first hit has the same CAS# as search chemical
-                    if returned_cas == cas_nr:
-                        # Get this TCI product number as follow:
-                        prd_id = first_hit_div['data-id']
-                        # print(prd_id)
-
-                        # Check if TCI product number is found:
-                        if prd_id:
-                            sds_url = ' https://www.tcichemicals.com/US/en/documentSearch/productSDSSearchDoc'
-
-                            data = {
-                                'productCode': f'{prd_id}',
-                                'langSelector': 'en',
-                                'selectedCountry': 'US',
-                                'CSRFToken': f'{csrf_token}'
-                            }
-                            file_name_res = s.post(sds_url, timeout=15, data=data)
-                            # print(file_name_res)
-                            # print(file_name_res.headers)
-                            # print(file_name_res.headers.get('content-disposition'))
-
-                            # Get the SDS file name using the return header, in "content-disposition"
-                            res_file = re.search(r'filename=(\S+)$', file_name_res.headers.get('content-disposition'))[1]
-
-                            # url = f'https://www.tcichemicals.com/US/en/sds/{prd_id.upper()}_US_EN.pdf'
-                            # An example of an sds url: 'https://www.tcichemicals.com/US/en/sds/B3296_US_EN.pdf'
-                            url = f'https://www.tcichemicals.com{encodedContextPath}/sds/{res_file}'
-                            # print(url)
-
-                            return 'TCI', url
+        get_id = http_get(adv_search_url, headers=headers, timeout=10)
+
+        if get_id.status_code == 200 and len(get_id.history) == 0:
+            # get_id.text
+            html = make_soup(get_id.text, page_filters['tci'])
+            # print(html.prettify()); exit(1)
+
+            # Get the token, required for POST request for SDS file name later
+            csrf_token = html.find('input', attrs={'name': 'CSRFToken'})['value']
+            # print(csrf_token)
+
+            region_code = html.find_all(string=re.compile(r'(encodedContextPath[^;]+?;)'))
+            # print(region_code[0])
+            encodedContextPath = re.search(r'(encodedContextPath[^;]+?\'(\S+)\';)', region_code[0])[2].replace('\\' ,'')
+            # print(encodedContextPath)
+
+            product_cat_css = 'div#contentSearchFacet > span.facet__text:first-child > a:first-child'
+            product_category = html.select(product_cat_css)[0]
+            # print(product_category)
+
+            hit_count = 0
+            if product_category.text == 'Products':
+                hit_count = re.search(r'\((\d+)\)',
+                                    html.select(f'{product_cat_css} + span.facet__value__count')[0].text)[1]
+            # print(hit_count)
+
+            # Check to make sure that there is at least 1 hit
+            if hit_count:
+                # Find the first hit
+                first_hit_div = html.find('div', class_='prductlist')
+                # print(first_hit_form)
+
+                # Find the CAS# for the first hit
+                returned_cas = first_hit_div['data-casno']
+                # print(returned_cas)
+
+                # Confirm the first hit has the same CAS# as search chemical
+                if returned_cas == cas_nr:
+                    # Get this TCI product number as follow:
+                    prd_id = first_hit_div['data-id']
+                    # print(prd_id)
+
+                    # Check if TCI product number is found:
+                    if prd_id:
+                        sds_url = 'https://www.tcichemicals.com/US/en/documentSearch/productSDSSearchDoc'
+
+                        data = {
+                            'productCode': f'{prd_id}',
+                            'langSelector': 'en',
+                            'selectedCountry': 'US',
+                            'CSRFToken': f'{csrf_token}'
+                        }
+                        # The CSRF token is bound to the cookies of the search page
+                        file_name_res = http_post(sds_url, timeout=15, data=data, cookies=get_id.cookies)
+                        # print(file_name_res)
+                        # print(file_name_res.headers)
+                        # print(file_name_res.headers.get('content-disposition'))
+
+                        # Get the SDS file name using the return header, in "content-disposition"
+                        res_file = re.search(r'filename=(\S+)$', file_name_res.headers.get('content-disposition'))[1]
+
+                        # url = f'https://www.tcichemicals.com/US/en/sds/{prd_id.upper()}_US_EN.pdf'
+                        # An example of an sds url: 'https://www.tcichemicals.com/US/en/sds/B3296_US_EN.pdf'
+                        url = f'https://www.tcichemicals.com{encodedContextPath}/sds/{res_file}'
+                        # print(url)
+
+                        return 'TCI', url
 
     except Exception as error:
+        metrics.extractor_exceptions.inc(supplier='tci', error=type(error).__name__)
         if debug:
             traceback_str = ''.join(traceback.format_exception(etype=type(error), value=error, tb=error.__traceback__))
             print(traceback_str)
@@ -674,20 +2487,27 @@ def update_sql_sds(mariadb_connection, cas_nr: str, sds_source: str = 'SDS') ->
     -------
     int
         1: if success
-        0: if not, the cas_nr will also be added into global missing_sds set
+        0: if not, the cas_nr will also be added into global missing_sds set if the SDS file is missing
     """
-    global download_path, missing_sds
-    cursor_update = mariadb_connection.cursor(buffered=True)
+    global download_path, missing_sds, use_status_table
+    cursor_update = _update_cursor(mariadb_connection)
     sds_file = Path(download_path) / '{}.pdf'.format(cas_nr)
     # print(file_path)
 
     # if molfile exists or downloaded
-    if sds_file.exists():
+    if sds_file.exists() and is_uploadable(sds_file):
         sds_source = 'SDS' if sds_source is None else sds_source
         print('CAS# {:20}: '.format(cas_nr), end='')
-        query = ("UPDATE molecule SET default_safety_sheet_blob=LOAD_FILE('{}'), default_safety_sheet_by='{}', default_safety_sheet_url=NULL, default_safety_sheet_mime='application/pdf' WHERE cas_nr='{}'".format(sds_file, sds_source, cas_nr))
-        cursor_update.execute(query)
+        written = _execute_sds_update(cursor_update, sds_file, sds_source, cas_nr)
+        if use_status_table and written > 0:
+            cursor_update.execute(update_status_query, _status_params(sds_file, sds_source, cas_nr))
+        elif use_status_table:
+            cursor_update.execute(check_status_query, (cas_nr, ))
         mariadb_connection.commit()
+        if written == 0:
+            print('\tno molecule missing this SDS anymore')
+            return 0
+        _journal_applied(mariadb_connection, [cas_nr])
         # cursor_update.execute("flush table molecule")
         print('\tSDS uploaded successfully!')
         return 1
@@ -699,21 +2519,587 @@ def update_sql_sds(mariadb_connection, cas_nr: str, sds_source: str = 'SDS') ->
         return 0
 
 
-if __name__ == '__main__':
-    # Require user running this python as root for creating download_path
-    is_root = input('Are you login as root user? (y/n): ')
-    if (is_root not in ['y', 'yes']):
-        print('You need to convert to root user before running this program (or run with `sudo`) ')
-        exit(1)    # Comment this line out if you have change the download_path to a location that you have read and write permissions.
+def update_sql_sds_batch(mariadb_connection, download_result: Iterable[Tuple[str, bool, Optional[str]]],
+                         batch_size: int = 100) -> int:
+    """Update SQL database with the downloaded SDS pdf files, `batch_size`
+    molecules in each transaction
 
-    # Get user input for root password and the database needs to be updated
-    # to hide password input: https://stackoverflow.com/questions/9202224/getting-command-line-password-input-in-python
-    password = getpass.getpass('Please type in the password for MySQL "root" user: ')
-    database = input('Please type in the name of the database needs updating: ')
-    # Ask user to retype the database name and if it does NOT match, exit the programs
-    database2 = input('Please re-type the name of the database to confirm: ')
-    if (database != database2):
-        print('Database names do NOT match!')
-        exit(2)
+    Parameters
+    ----------
+    mariadb_connection : mysql.connector Object
+        an established connection to the SQL database
+    download_result : Iterable[Tuple[str, bool, Optional[str]]]
+        the results of `download_sds()`
+    batch_size : int, optional
+        the number of CAS numbers updated in each transaction, by default 100
+
+    Returns
+    -------
+    int
+        the number of CAS numbers updated, the CAS numbers without SDS file
+        are added into global missing_sds set
+    """
+    global download_path, missing_sds, use_status_table
+
+    batch = []
+    not_found = []
+    count_file_updated = 0
+    for cas_nr, downloaded, sds_source in download_result:
+        sds_file = Path(download_path) / '{}.pdf'.format(cas_nr)
+        if not sds_file.exists() or not is_uploadable(sds_file):
+            missing_sds.add(cas_nr)
+            not_found.append((cas_nr, ))
+            continue
+        batch.append((str(sds_file), 'SDS' if sds_source is None else sds_source, cas_nr))
+        if len(batch) >= batch_size:
+            count_file_updated += _update_sql_sds_batch(mariadb_connection, batch)
+            batch = []
+    if batch:
+        count_file_updated += _update_sql_sds_batch(mariadb_connection, batch)
+    if use_status_table and not_found:
+        # Remember when the molecules without SDS were last looked for
+        cursor_update = _update_cursor(mariadb_connection)
+        try:
+            cursor_update.executemany(check_status_query, not_found)
+            mariadb_connection.commit()
+        except mariadb.Error as error:
+            mariadb_connection.rollback()
+            print('Error: {}'.format(error))
+        finally:
+            cursor_update.close()
+    metrics.sql_updated.inc(count_file_updated)
+    return count_file_updated
+
+
+def _update_sql_sds_batch(mariadb_connection, batch: List[Tuple[str, str, str]]) -> int:
+    """Run the UPDATE query for a batch of (sds_file, sds_source, cas_nr) in one transaction
+
+    If the batch fails, each CAS number is updated on its own so that one
+    bad row does not lose the whole batch.
+    """
+    global update_sds_query, copy_sds_query, upload_mode, deduplicate, search_cache, use_status_table
+
+    batch_number = next(_batch_numbers)
+    start = time.monotonic()
+    uploads, copies, blobs = _plan_sds_uploads(mariadb_connection, batch) if deduplicate else (batch, [], [])
+    sds_files = {cas_nr: sds_file for sds_file, sds_source, cas_nr in batch}
+    # The CAS numbers of the molecules updated, the others got an SDS since they were selected
+    written = set()
+    copied = 0
+    cursor_update = _update_cursor(mariadb_connection)
+    try:
+        # In the 'client' mode, one SDS file is open at a time, each one streamed to the server
+        for sds_file, sds_source, cas_nr in uploads:
+            if _execute_sds_update(cursor_update, sds_file, sds_source, cas_nr) > 0:
+                written.add(cas_nr)
+        for params in copies:
+            sds_source, cas_nr = params[2], params[-1]
+            cursor_update.execute(_sds_query(copy_sds_query), params)
+            if cursor_update.rowcount > 0:
+                written.add(cas_nr)
+                copied += 1
+            elif _execute_sds_update(cursor_update, sds_files[cas_nr], sds_source, cas_nr) > 0:
+                # The source molecule lost its SDS since the batch was planned: the file is uploaded
+                written.add(cas_nr)
+                blobs.append((*sds_store.file_digest(sds_files[cas_nr]), cas_nr))
+        if use_status_table:
+            # The status of the molecules not updated is left to the next sync of the status table
+            cursor_update.executemany(update_status_query, [_status_params(sds_file, sds_source, cas_nr)
+                                                            for sds_file, sds_source, cas_nr in batch
+                                                            if cas_nr in written])
+            cursor_update.executemany(check_status_query, [(cas_nr, ) for sds_file, sds_source, cas_nr in batch
+                                                           if cas_nr not in written])
+        mariadb_connection.commit()
+    except mariadb.Error as error:
+        mariadb_connection.rollback()
+        print('Error: {}'.format(error))
+        print(f'Batch {batch_number}: updating the {len(batch)} CAS one by one')
+        count_file_updated = 0
+        for sds_file, sds_source, cas_nr in batch:
+            try:
+                count_file_updated += update_sql_sds(mariadb_connection, cas_nr=cas_nr, sds_source=sds_source)
+            except mariadb.Error as error:
+                print('Error: {}'.format(error))
+        return count_file_updated
+    finally:
+        cursor_update.close()
+        seconds = time.monotonic() - start
+        metrics.sql_update_batch_seconds.observe(seconds)
+        metrics.phase_seconds.inc(seconds, phase='update')
+
+    _journal_applied(mariadb_connection, [cas_nr for sds_file, sds_source, cas_nr in batch if cas_nr in written])
+    if search_cache is not None:
+        database = _database_name(mariadb_connection)
+        for sha256, size, cas_nr in blobs:
+            if cas_nr in written:
+                search_cache.record_blob(database, sha256, size, cas_nr)
+    for sds_file, sds_source, cas_nr in batch:
+        if cas_nr in written:
+            print('CAS# {:20}: \tSDS uploaded successfully!'.format(cas_nr))
+        else:
+            print('CAS# {:20}: \tno molecule missing this SDS anymore'.format(cas_nr))
+    print(f'Batch {batch_number}: {len(written)} SDS updated in {time.monotonic() - start:.3f} s'
+          + (f', {copied} copied from identical SDS' if copied else ''))
+    return len(written)
+
+
+def _plan_sds_uploads(mariadb_connection, batch: List[Tuple[str, str, str]]) \
+        -> Tuple[List[Tuple[str, str, str]], List[Tuple[str, int, str, str, int, str]], List[Tuple[str, int, str]]]:
+    """Split a batch of (sds_file, sds_source, cas_nr) into the SDS files to upload and
+    the ones already in the database, to copy from another molecule
+
+    An SDS file is copied if the same file (same SHA-256 hash) is uploaded earlier
+    in the batch, or was uploaded by a previous batch or run (see
+    `SdsCache.stored_blob()`) and is still in the database.
+
+    Returns
+    -------
+    Tuple[List[Tuple[str, str, str]], List[Tuple[str, int, str, str, int, str]], List[Tuple[str, int, str]]]
+        - the parameters of `update_sds_query` for the SDS files to upload
+        - the parameters of `copy_sds_query` for the SDS files to copy
+        - the (sha256, size, cas_nr) of the SDS files uploaded
+    """
+    global search_cache
+
+    database = _database_name(mariadb_connection) if search_cache is not None else ''
+    uploads, copies, blobs = [], [], []
+    # CAS number and size of the SDS files in the database, by hash
+    sources: Dict[str, Optional[Tuple[str, int]]] = {}
+    for sds_file, sds_source, cas_nr in batch:
+        sha256, size = sds_store.file_digest(sds_file)
+        if sha256 not in sources:
+            sources[sha256] = search_cache.stored_blob(database, sha256) if search_cache is not None else None
+            if sources[sha256] is not None and not _has_sds_blob(mariadb_connection, *sources[sha256]):
+                # The molecule does not have this SDS anymore
+                search_cache.forget_blob(database, sha256)
+                sources[sha256] = None
+        source = sources[sha256]
+        if source is not None and source[1] == size and source[0] != cas_nr:
+            copies.append((source[0], size, sds_source, source[0], size, cas_nr))
+        else:
+            uploads.append((sds_file, sds_source, cas_nr))
+            blobs.append((sha256, size, cas_nr))
+            sources[sha256] = (cas_nr, size)
+    return uploads, copies, blobs
+
+
+def _has_sds_blob(mariadb_connection, cas_nr: str, size: int) -> bool:
+    """Check that the molecules with cas_nr have an SDS of this size in the database"""
+    cursor = mariadb_connection.cursor(buffered=True)
+    try:
+        cursor.execute('SELECT 1 FROM molecule WHERE cas_nr=%s AND LENGTH(default_safety_sheet_blob)=%s LIMIT 1',
+                       (cas_nr, size))
+        return cursor.fetchone() is not None
+    finally:
+        cursor.close()
+
+
+def _database_name(mariadb_connection) -> str:
+    """Get the name of the database of the connection, the SDS uploaded are remembered for each database"""
+    return getattr(mariadb_connection, 'database', None) or ''
+
+
+def _status_params(sds_file, sds_source: str, cas_nr: str) -> Tuple[str, str, int, str]:
+    """Get the parameters of `update_status_query` for the SDS file of cas_nr"""
+    sha256, size = sds_store.file_digest(sds_file)
+    return sds_source, sha256, size, cas_nr
+
+
+def _update_cursor(mariadb_connection):
+    """Get a cursor for the UPDATE queries of the current `upload_mode`"""
+    global upload_mode
+
+    if upload_mode == 'client':
+        # Prepared statements send the file parameters as long data, in chunks
+        return mariadb_connection.cursor(prepared=True)
+    return mariadb_connection.cursor(buffered=True)
+
+
+def _sds_query(query: str) -> str:
+    """Get the UPDATE query setting the SDS, without its condition on the molecules missing SDS if `replace_sds`"""
+    global replace_sds, missing_sds_condition
+
+    return query.replace(' AND ' + missing_sds_condition, '') if replace_sds else query
+
+
+def _execute_sds_update(cursor_update, sds_file, sds_source: str, cas_nr: str) -> int:
+    """Run the UPDATE query setting the SDS of cas_nr, in the current `upload_mode`
+
+    Returns
+    -------
+    int
+        the number of molecules updated
+    """
+    global update_sds_query, update_sds_blob_query, upload_mode
+
+    if upload_mode == 'client':
+        # A file object is not read into memory: the connector streams it
+        # to the server in 128 KB packets (COM_STMT_SEND_LONG_DATA)
+        with open(sds_file, 'rb') as f:
+            cursor_update.execute(_sds_query(update_sds_blob_query), (f, sds_source, cas_nr))
+    else:
+        cursor_update.execute(_sds_query(update_sds_query), (str(sds_file), sds_source, cas_nr))
+    return cursor_update.rowcount
 
+
+def is_uploadable(sds_file: Path) -> bool:
+    """Check that the database server accepts an SDS file of this size
+
+    Parameters
+    ----------
+    sds_file : Path
+        the SDS file
+
+    Returns
+    -------
+    bool
+        False if the file is bigger than `max_allowed_packet` (the server
+        would refuse it or store NULL), True otherwise or if the limit is unknown
+    """
+    global max_allowed_packet
+
+    if max_allowed_packet is None:
+        return True
+    size = os.path.getsize(sds_file)
+    if size > max_allowed_packet:
+        print(f'{Path(sds_file).name}: {size} bytes, bigger than the max_allowed_packet '
+              f'of the database server ({max_allowed_packet} bytes), not uploaded')
+        return False
+    return True
+
+
+def get_max_allowed_packet(mariadb_connection) -> int:
+    """Get the largest value the database server accepts, in bytes
+
+    Parameters
+    ----------
+    mariadb_connection : mysql.connector Object
+        an established connection to the SQL database
+
+    Returns
+    -------
+    int
+        the `max_allowed_packet` of the server
+    """
+    cursor = mariadb_connection.cursor(buffered=True)
+    try:
+        cursor.execute('SELECT @@max_allowed_packet')
+        (value, ) = cursor.fetchone()
+        return int(value)
+    finally:
+        cursor.close()
+
+
+def parse_supplier_order(value: str) -> List[str]:
+    """Parse a supplier order given on the command line
+
+    Parameters
+    ----------
+    value : str
+        supplier names separated by commas, e.g. 'fisher,vwr'
+
+    Returns
+    -------
+    List[str]
+        the supplier names, in order
+
+    Examples
+    --------
+    >>> parse_supplier_order('fisher, vwr')
+    ['fisher', 'vwr']
+    """
+    suppliers = [supplier.strip() for supplier in value.split(',') if supplier.strip()]
+    unknown = [supplier for supplier in suppliers if supplier not in supplier_hosts]
+    if not suppliers or unknown:
+        raise argparse.ArgumentTypeError(f'invalid supplier order "{value}", expected names from: {", ".join(supplier_hosts)}')
+    return suppliers
+
+
+def parse_databases(value: str) -> List[str]:
+    """Parse a list of database names given on the command line
+
+    Examples
+    --------
+    >>> parse_databases('group_a, group_b')
+    ['group_a', 'group_b']
+    """
+    databases = [database.strip() for database in value.split(',') if database.strip()]
+    if not databases:
+        raise argparse.ArgumentTypeError(f'invalid database list "{value}"')
+    return databases
+
+
+def read_settings(config_file: Optional[str] = None, environ: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Read the settings of the configuration file and of the environment variables
+
+    The settings are the long command line options, without '--' and with
+    '_' for '-' (e.g. `download_path`), plus `database` and `password`.
+    They are read from the `[oe_find_sds]` section of config_file, then
+    from the `OE_FIND_SDS_<SETTING>` environment variables, which take
+    precedence.
+
+    Examples
+    --------
+    >>> read_settings(environ={'OE_FIND_SDS_DATABASE': 'group_a', 'OE_FIND_SDS_CONFIG': 'oe.ini', 'HOME': '/root'})
+    {'database': 'group_a'}
+    """
+    global config_section, env_prefix
+
+    settings = {}
+    if config_file:
+        config = configparser.ConfigParser(interpolation=None)
+        if not config.read(config_file):
+            raise argparse.ArgumentTypeError(f'cannot read the configuration file "{config_file}"')
+        if config.has_section(config_section):
+            settings.update((key.replace('-', '_'), value) for key, value in config.items(config_section))
+    for name, value in (os.environ if environ is None else environ).items():
+        if name.startswith(env_prefix) and name != f'{env_prefix}CONFIG':
+            settings[name[len(env_prefix):].lower()] = value
+    return settings
+
+
+def _settings_defaults(parser: argparse.ArgumentParser, settings: Dict[str, str]) -> Dict[str, object]:
+    """Convert the settings (see `read_settings()`) into defaults of the options of parser"""
+    actions = {option[2:].replace('-', '_'): action for action in parser._actions
+               for option in action.option_strings if option.startswith('--') and action.dest != 'help'}
+    defaults = {}
+    for key, value in settings.items():
+        action = actions.get(key)
+        if action is None:
+            parser.error(f'unknown setting "{key}"')
+        if action.nargs == 0:
+            # Flags, e.g. race = true
+            if value.strip().lower() in ('1', 'true', 'yes', 'on'):
+                defaults[action.dest] = action.const
+            continue
+        values = value.split() if isinstance(action, argparse._AppendAction) else [value]
+        try:
+            values = [action.type(value) if action.type else value for value in values]
+        except (ValueError, argparse.ArgumentTypeError) as error:
+            parser.error(f'invalid setting {key}={value}: {error}')
+        if action.choices and any(value not in action.choices for value in values):
+            parser.error(f'invalid setting {key}={value}, choose from {", ".join(action.choices)}')
+        defaults[action.dest] = values if isinstance(action, argparse._AppendAction) else values[0]
+    return defaults
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse the command line options
+
+    The defaults of the options are taken from the configuration file
+    (`--config`) and the environment variables, see `read_settings()`.
+
+    Parameters
+    ----------
+    argv : Optional[List[str]], optional
+        the command line arguments, by default None (use `sys.argv`)
+
+    Returns
+    -------
+    argparse.Namespace
+        the parsed options, with the `password` setting (None if not set)
+    """
+    parser = argparse.ArgumentParser(description='Find and upload missing SDS for Open Enventory')
+    parser.add_argument('--config', metavar='FILE', default=os.environ.get(f'{env_prefix}CONFIG'),
+                        help=f'read the settings from the [{config_section}] section of this file: the long options, '
+                             'e.g. "download_path = /var/sds", plus "database" and "password"; the environment '
+                             f'variables {env_prefix}<SETTING> take precedence, the command line options over both')
+    parser.add_argument('--database',
+                        help='name of the database to update (default: asked)')
+    # print out extra info in debug mode in case SDS is not found
+    parser.add_argument('-d', '--debug', nargs='?', const='true', default='false',
+                        help='print out extra info in case SDS is not found')
+    parser.add_argument('-c', '--concurrency', type=int, default=concurrency,
+                        help=f'maximum number of CAS searched/downloaded at the same time (default: {concurrency})')
+    parser.add_argument('--race', action='store_true',
+                        help='query all suppliers at the same time, the SDS is still taken in order of supplier priority')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, action='append', default=[],
+                        metavar='SUPPLIER=RATE[/MAX_CONCURRENCY]',
+                        help='maximum requests per second (and requests in flight) for a supplier, '
+                             'or for every supplier with "default", can be repeated (default: default=10/20)')
+    parser.add_argument('--status-interval', type=float, default=status_interval,
+                        help=f'print the request rate of each supplier every N seconds, 0 to turn off (default: {status_interval})')
+    parser.add_argument('--revalidate', action='store_true',
+                        help='search all suppliers again, ignoring the urls and misses cached by previous runs')
+    parser.add_argument('--negative-ttl', type=float, default=sds_cache.negative_ttl / 86400,
+                        help='number of days a supplier not having an SDS is remembered (default: %(default)s)')
+    parser.add_argument('--max-sds-size', type=float, default=max_sds_size / 1024 / 1024,
+                        help='maximum size of an SDS file in MB, bigger files are not downloaded (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=batch_size,
+                        help=f'number of CAS numbers updated in each SQL transaction (default: {batch_size})')
+    parser.add_argument('--pool-size', type=int, default=http_sessions.pool_size,
+                        help=f'maximum number of keep-alive connections kept for each supplier host (default: {http_sessions.pool_size})')
+    parser.add_argument('--upload-mode', choices=['server', 'client'], default=upload_mode,
+                        help='"server": the database server reads the SDS files with LOAD_FILE() (run on the database host, as root); '
+                             '"client": the SDS files are sent over the SQL connection (run on any host) (default: %(default)s)')
+    parser.add_argument('--download-path', default=download_path,
+                        help='folder where the SDS files are downloaded (default: %(default)s)')
+    parser.add_argument('--db-host', default=db_host,
+                        help='host of the SQL database (default: %(default)s)')
+    parser.add_argument('--db-user', default=db_user,
+                        help='SQL user, it needs the FILE privilege in "server" upload mode (default: %(default)s)')
+    parser.add_argument('--compress', action='store_true',
+                        help='compress the SQL protocol, e.g. with "--upload-mode client" on another host than the database')
+    parser.add_argument('--parser', choices=['lxml', 'html.parser'], default=html_parsing.parser_backend,
+                        help='parser of the supplier pages, lxml is faster but must be installed (default: %(default)s)')
+    parser.add_argument('--metrics-json', metavar='FILE',
+                        help='write the metrics of the run (supplier searches, HTTP requests, SDS downloads, SQL phases) '
+                             'into this JSON file')
+    parser.add_argument('--metrics-prom', metavar='FILE',
+                        help='write the metrics of the run into this Prometheus textfile, '
+                             'e.g. in the textfile collector folder of node_exporter')
+    parser.add_argument('--supplier-order', type=parse_supplier_order, metavar='SUPPLIER,SUPPLIER,...',
+                        help='search the suppliers in this fixed order, instead of ordering them by their hit rate '
+                             f'and search time in previous runs (default order: {",".join(supplier_order)})')
+    parser.add_argument('--stats-by-prefix', action='store_true',
+                        help='order the suppliers using the hit rates of the CAS numbers with the same prefix')
+    parser.add_argument('--min-hit-rate', type=float, default=min_hit_rate,
+                        help=f'skip the suppliers with a lower hit rate after {min_searches} searches, 0 to never skip (default: %(default)s)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only look at the molecules added since the previous run (and at all of them once in a while, '
+                             'see --full-sweep-days)')
+    parser.add_argument('--full-sweep-days', type=float, default=full_sweep_interval / 86400,
+                        help='with --incremental, days between two runs looking at all the molecules (default: %(default)s)')
+    parser.add_argument('--full-sweep', action='store_true',
+                        help='look at all the molecules in this run, also with --incremental')
+    parser.add_argument('--status-table', action='store_true',
+                        help=f'keep the SDS status of each molecule in the indexed side table {status_table}, '
+                             'and find the molecules missing SDS there instead of reading the molecule table')
+    parser.add_argument('--coordinator', dest='distributed_role', action='store_const', const='coordinator',
+                        help='put the CAS numbers missing SDS in a job table, and update the database with the SDS '
+                             'downloaded by the workers (see --worker)')
+    parser.add_argument('--worker', dest='distributed_role', action='store_const', const='worker',
+                        help='search and download the SDS of the jobs put in the job table by a coordinator; '
+                             'start any number of workers, on any number of hosts')
+    parser.add_argument('--queue-file', metavar='FILE',
+                        help='SQLite file of the job table, for a coordinator and workers on the same host '
+                             '(default: table oe_find_sds_jobs in the database)')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume an interrupted run from its journal: the CAS numbers it finished are skipped, '
+                             'the SDS urls it found are downloaded without searching the suppliers again')
+    parser.add_argument('--databases', type=parse_databases, metavar='DATABASE,DATABASE,...',
+                        help='update these databases in one run, each CAS number being searched and downloaded once')
+    parser.add_argument('--all-databases', action='store_true',
+                        help='update every Open Enventory database of the server in one run')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='keep one file and upload one copy of each SDS per CAS number, even when the SDS files are identical')
+    parser.add_argument('--no-http-cache', action='store_true',
+                        help='send every supplier search again, instead of answering the recent ones from the on-disk '
+                             'cache of their responses')
+    parser.add_argument('--http-cache-size', type=float, default=http_cache.max_size / 1024 / 1024,
+                        help='maximum size of the on-disk cache of the supplier responses in MB, the least recently '
+                             'used responses are evicted beyond (default: %(default)s)')
+    parser.add_argument('--refresh', action='store_true',
+                        help='instead of looking for missing SDS, check with conditional requests that the SDS downloaded '
+                             'before did not change, and update the ones that did')
+    parser.add_argument('--refresh-days', type=float, default=refresh_interval / 86400,
+                        help='with --refresh, check the SDS downloaded or checked more than N days ago (default: %(default)s)')
+    parser.add_argument('--refresh-limit', type=int, default=refresh_limit,
+                        help='with --refresh, maximum number of SDS checked in the run (default: %(default)s)')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running: look for new molecules missing SDS every --poll-interval seconds and fill '
+                             'them in, until SIGTERM; the database and password must be set in --config or the environment')
+    parser.add_argument('--poll-interval', type=float, default=poll_interval,
+                        help='seconds between two looks at the database (--daemon) or at the job table (default: %(default)s)')
+
+    config_file = parser.parse_known_args(argv)[0].config
+    try:
+        settings = read_settings(config_file)
+    except argparse.ArgumentTypeError as error:
+        parser.error(str(error))
+    password = settings.pop('password', None)
+    parser.set_defaults(**_settings_defaults(parser, settings))
+    args = parser.parse_args(argv)
+    args.password = password
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    debug = args.debug.lower() == 'true'
+    concurrency = args.concurrency
+    http_sessions.pool_size = args.pool_size
+    race_suppliers = args.race
+    revalidate = args.revalidate
+    max_sds_size = int(args.max_sds_size * 1024 * 1024)
+    batch_size = args.batch_size
+    sds_cache.negative_ttl = args.negative_ttl * 86400
+    chemicalsafety.answer_ttl = sds_cache.negative_ttl
+    status_interval = args.status_interval
+    for supplier, limit in args.rate_limit:
+        if supplier == 'default':
+            rate_limit.default_limit = limit
+        else:
+            supplier_limits[supplier] = limit
+    upload_mode = args.upload_mode
+    download_path = args.download_path
+    db_host = args.db_host
+    db_user = args.db_user
+    db_compress = args.compress
+    html_parsing.parser_backend = args.parser
+    metrics.json_file = args.metrics_json
+    metrics.prometheus_file = args.metrics_prom
+    if args.supplier_order:
+        supplier_order = args.supplier_order
+        adaptive_order = False
+    stats_by_prefix = args.stats_by_prefix
+    min_hit_rate = args.min_hit_rate
+    deduplicate = not args.no_dedup
+    incremental = args.incremental
+    full_sweep_interval = args.full_sweep_days * 86400
+    full_sweep = args.full_sweep
+    resume = args.resume
+    use_status_table = args.status_table
+    distributed_role = args.distributed_role
+    job_queue_file = args.queue_file
+    poll_interval = args.poll_interval
+    use_http_cache = not args.no_http_cache
+    refresh_interval = args.refresh_days * 86400
+    refresh_limit = args.refresh_limit
+    http_cache.max_size = int(args.http_cache_size * 1024 * 1024)
+
+    if args.daemon:
+        # Nothing is asked: the daemon runs from systemd, docker, ...
+        if not args.database or args.password is None:
+            print(f'The daemon needs the database and password settings, in --config or {env_prefix}DATABASE '
+                  f'and {env_prefix}PASSWORD')
+            exit(1)
+        run_daemon(database=args.database, password=args.password)
+        exit()
+
+    # In 'server' upload mode, the database server reads the SDS files itself:
+    # require user running this python as root for creating download_path
+    if upload_mode == 'server' and distributed_role != 'worker':
+        is_root = input('Are you login as root user? (y/n): ')
+        if (is_root not in ['y', 'yes']):
+            print('You need to convert to root user before running this program (or run with `sudo`) ')
+            print('or use `--upload-mode client` with a `--download-path` that you have read and write permissions.')
+            exit(1)
+
+    # Get user input for the SQL password and the database needs to be updated
+    # to hide password input: https://stackoverflow.com/questions/9202224/getting-command-line-password-input-in-python
+    password = args.password
+    if password is None:
+        password = getpass.getpass(f'Please type in the password for MySQL "{db_user}" user: ')
+    if args.databases or args.all_databases:
+        main_databases(databases=args.databases, password=password)
+        exit()
+    if distributed_role == 'worker':
+        # The worker only needs the database for the job table
+        main_worker(database='' if job_queue_file else (args.database or
+                                                        input('Please type in the name of the database of the job table: ')),
+                    password=password)
+        exit()
+    database = args.database
+    if not database:
+        database = input('Please type in the name of the database needs updating: ')
+        # Ask user to retype the database name and if it does NOT match, exit the programs
+        database2 = input('Please re-type the name of the database to confirm: ')
+        if (database != database2):
+            print('Database names do NOT match!')
+            exit(2)
+
+    if args.refresh:
+        main_refresh(database=database, password=password)
+        exit()
     main(database=database, password=password)
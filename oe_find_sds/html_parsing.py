@@ -0,0 +1,99 @@
+"""
+Parsing of the supplier pages into BeautifulSoup trees
+
+The pages are parsed with lxml when it is installed (`pip install lxml`), it
+is several times faster than the 'html.parser' of the standard library.
+
+Each extractor only reads a few elements of a page, so it gives a
+`PageFilter` saying which elements to keep: the other elements are skipped
+while parsing, instead of being built into the tree and never read.
+"""
+
+
+import importlib.util
+from typing import Callable, Dict, Optional
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+
+# Parser used by BeautifulSoup: 'lxml' if installed, else 'html.parser'
+parser_backend = 'lxml' if importlib.util.find_spec('lxml') is not None else 'html.parser'
+# Build only the parts of the pages given by the page filters, False to build the whole pages
+partial_parsing = True
+
+
+def has_class(attrs: Dict, class_name: str) -> bool:
+    """Check if the raw attributes of a tag being parsed have a CSS class
+
+    Parameters
+    ----------
+    attrs : Dict
+        the attributes of the tag, the 'class' attribute not split yet
+    class_name : str
+        the CSS class
+
+    Returns
+    -------
+    bool
+        True if class_name is one of the classes of the tag
+
+    Examples
+    --------
+    >>> has_class({'class': 'catlog_items first'}, 'catlog_items')
+    True
+    """
+    classes = attrs.get('class') or ''
+    if isinstance(classes, str):
+        classes = classes.split()
+    return class_name in classes
+
+
+class PageFilter(SoupStrainer):
+    """SoupStrainer keeping the elements for which keep(name, attrs) is True
+
+    A kept element is built with all its content, the content of the other
+    elements is searched for more elements to keep.
+
+    Parameters
+    ----------
+    keep : Callable[[str, Dict], bool]
+        called with the name and the raw attributes of each tag being parsed
+    """
+    def __init__(self, keep: Callable[[str, Dict], bool]):
+        # Having a name rule, the strainer drops the text outside of the kept elements
+        super().__init__(name=True)
+        self.keep = keep
+
+    def allow_tag_creation(self, nsprefix, name, attrs) -> bool:
+        # Called while parsing by beautifulsoup4 >= 4.13
+        return bool(self.keep(name, attrs or {}))
+
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        # Called while parsing by beautifulsoup4 < 4.13
+        if isinstance(markup_name, str):
+            return self.keep(markup_name, markup_attrs or {})
+        return super().search_tag(markup_name, markup_attrs)
+
+
+def make_soup(markup: str, page_filter: Optional[PageFilter] = None,
+              backend: Optional[str] = None) -> BeautifulSoup:
+    """Parse a supplier page
+
+    Parameters
+    ----------
+    markup : str
+        the HTML page
+    page_filter : Optional[PageFilter], optional
+        the elements to build, by default None (build the whole page)
+    backend : Optional[str], optional
+        the parser used by BeautifulSoup, by default None (use `parser_backend`)
+
+    Returns
+    -------
+    BeautifulSoup
+        the parsed page
+    """
+    global parser_backend, partial_parsing
+
+    parse_only = page_filter if partial_parsing else None
+    return BeautifulSoup(markup, backend or parser_backend, parse_only=parse_only)
@@ -0,0 +1,173 @@
+"""
+On-disk cache of the supplier search responses, kept in a SQLite file next to the downloaded SDS
+
+The supplier search pages and lookups (e.g. the Fisher and VWR searches,
+the chemblink MSDS pages, the chemicalsafety `retriever.php` answers) seldom
+change from one run to the next. `http_sessions.http_request()` answers the
+requests to the hosts listed in `host_ttls` from this cache while their
+response is fresh, without any network round-trip or rate limit.
+
+The responses are keyed by method, url (with its query string) and body,
+and their bodies are compressed with zlib. Only complete, successful
+(200, not redirected) responses sent without cookies are kept. Once the
+cached bodies go over `max_size`, the least recently used responses are
+evicted.
+"""
+
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, Optional, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+# Name of the cache file, created in the download folder
+cache_file_name = 'oe_find_sds_http_cache.sqlite3'
+# Number of seconds the responses of each host are kept, the hosts not listed are not cached
+host_ttls: Dict[str, float] = {}
+# Maximum size of the cached bodies (compressed), in bytes
+max_size = 256 * 1024 * 1024
+# Once over max_size, the least recently used responses are evicted down to this fraction of it
+evict_to = 0.9
+# zlib compression level of the bodies
+compress_level = 6
+# Headers not kept: the body is stored decoded, and the cookies are never reused
+dropped_headers = {'content-encoding', 'content-length', 'transfer-encoding', 'set-cookie'}
+
+
+def request_key(method: str, url: str, params=None, data=None, json_data=None) -> str:
+    """Get the cache key of a request: the hash of its method, full url and body
+
+    Examples
+    --------
+    >>> request_key('GET', 'https://us.vwr.com/store/msds', params={'keyword': '64-19-7'}) == \\
+    ...     request_key('get', 'https://us.vwr.com/store/msds?keyword=64-19-7')
+    True
+    """
+    prepared = requests.Request(method.upper(), url, params=params, data=data, json=json_data).prepare()
+    body = prepared.body or b''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.sha256(f'{prepared.method}\n{prepared.url}\n'.encode('utf-8') + body).hexdigest()
+
+
+def host_ttl(url: str) -> float:
+    """Get the number of seconds the responses from the host of url are kept, 0 if not cached"""
+    return host_ttls.get((urlsplit(url).hostname or '').lower(), 0)
+
+
+class HttpCache:
+    """SQLite cache of the HTTP responses
+
+    The connection is shared between threads, every access holds a lock.
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        the cache file, created if it does not exist
+    refresh : bool, optional
+        True to send every request again and only store the responses, e.g.
+        to revalidate the searches, by default False
+    """
+    def __init__(self, path: Union[str, Path], refresh: bool = False):
+        self.path = Path(path)
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False,
+                                           isolation_level=None)
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                ' key TEXT PRIMARY KEY,'
+                ' host TEXT NOT NULL,'
+                ' url TEXT NOT NULL,'
+                ' status INTEGER NOT NULL,'
+                ' headers TEXT NOT NULL,'
+                ' encoding TEXT,'
+                ' body BLOB NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' expires_at REAL NOT NULL,'
+                ' used_at REAL NOT NULL)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)')
+            self._connection.execute('DELETE FROM responses WHERE expires_at <= ?', (time.time(), ))
+            (self.size, ) = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()
+
+    @classmethod
+    def in_folder(cls, folder: Union[str, Path], refresh: bool = False) -> 'HttpCache':
+        """Open the cache file kept in folder (usually the download folder)"""
+        return cls(Path(folder) / cache_file_name, refresh=refresh)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def get(self, key: str) -> Optional[requests.Response]:
+        """Get the fresh response cached for the request key (see `request_key()`), None if there is none"""
+        if self.refresh:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT url, status, headers, encoding, body FROM responses WHERE key = ? AND expires_at > ?',
+                (key, now)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute('UPDATE responses SET used_at = ? WHERE key = ?', (now, key))
+        url, status, headers, encoding, body = row
+        response = requests.Response()
+        response.status_code = status
+        response.reason = 'OK'
+        response.url = url
+        response.headers = CaseInsensitiveDict(json.loads(headers))
+        response.encoding = encoding
+        response._content = zlib.decompress(body)
+        return response
+
+    def put(self, key: str, response: requests.Response, ttl: float) -> None:
+        """Keep response for ttl seconds, then evict the least recently used responses if over `max_size`"""
+        body = zlib.compress(response.content, compress_level)
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in dropped_headers}
+        now = time.time()
+        with self._lock:
+            previous = self._connection.execute('SELECT size FROM responses WHERE key = ?', (key, )).fetchone()
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses (key, host, url, status, headers, encoding, body, size, expires_at, used_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, urlsplit(response.url).hostname or '', response.url, response.status_code, json.dumps(headers),
+                 response.encoding, body, len(body), now + ttl, now))
+            self.size += len(body) - (previous[0] if previous else 0)
+            if self.size > max_size:
+                self._evict(int(max_size * evict_to))
+
+    def delete(self, key: str) -> None:
+        """Evict the response cached for the request key, if any"""
+        with self._lock:
+            row = self._connection.execute('SELECT size FROM responses WHERE key = ?', (key, )).fetchone()
+            if row is not None:
+                self._connection.execute('DELETE FROM responses WHERE key = ?', (key, ))
+                self.size -= row[0]
+
+    def _evict(self, target_size: int) -> None:
+        """Delete the least recently used responses until the cached bodies are under target_size"""
+        self._connection.execute('DELETE FROM responses WHERE expires_at <= ?', (time.time(), ))
+        (self.size, ) = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()
+        if self.size <= target_size:
+            return
+        evicted = 0
+        keys = []
+        for key, size in self._connection.execute('SELECT key, size FROM responses ORDER BY used_at'):
+            keys.append((key, ))
+            evicted += size
+            if self.size - evicted <= target_size:
+                break
+        self._connection.executemany('DELETE FROM responses WHERE key = ?', keys)
+        self.size -= evicted
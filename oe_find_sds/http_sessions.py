@@ -0,0 +1,279 @@
+"""
+Long-lived keep-alive HTTP sessions shared by all SDS extractors
+
+One `requests.Session` (with its own connection pool) is kept for each
+supplier host, so DNS lookup, TCP and TLS setup are only paid once per
+connection instead of once per request. Every request also goes through
+the rate limiter of its host (see `rate_limit`), unless it is answered by
+the on-disk response cache (see `http_cache`).
+"""
+
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.cookiejar import DefaultCookiePolicy
+from typing import Dict, Iterable, Iterator, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from oe_find_sds import http_cache, metrics, rate_limit
+except ImportError:    # running as a script: `python oe_find_sds/find_sds.py`
+    import http_cache
+    import metrics
+    import rate_limit
+
+
+# Maximum number of keep-alive connections kept open for each host
+pool_size = 100
+# Stand-in servers receiving the requests sent to some hosts (e.g. for offline
+# benchmarks), as {'https://www.fishersci.com': 'http://127.0.0.1:8000/www.fishersci.com'}.
+# The rate limits still apply to the original hosts.
+host_overrides: Dict[str, str] = {}
+# On-disk cache answering the requests to the hosts of `http_cache.host_ttls`, None to send every request
+response_cache: Optional[http_cache.HttpCache] = None
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+# Number of failed requests (errors, timeouts, throttling) sent by each thread
+_failures = threading.local()
+# Threads sending their requests again instead of answering them from `response_cache`
+_bypass = threading.local()
+
+
+class _BlockAllCookies(DefaultCookiePolicy):
+    """Cookie policy rejecting every cookie"""
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+def _host_key(url: str) -> str:
+    """Return the 'scheme://host:port' part of url, used as the session key"""
+    parts = urlsplit(url.strip())
+    return f'{parts.scheme}://{parts.netloc}'.lower()
+
+
+def _override_url(url: str) -> str:
+    """Return url sent to its stand-in server if its host is in `host_overrides`"""
+    url = url.strip()
+    base_url = host_overrides.get(_host_key(url))
+    if base_url is None:
+        return url
+    parts = urlsplit(url)
+    return base_url.rstrip('/') + urlunsplit(('', '', parts.path or '/', parts.query, parts.fragment))
+
+
+def get_session(url: str) -> requests.Session:
+    """Get the shared session for the host of url, creating it if needed
+
+    Parameters
+    ----------
+    url : str
+        any url on the host of interest
+
+    Returns
+    -------
+    requests.Session
+        the keep-alive session for this host
+    """
+    key = _host_key(url)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                # The session is shared between threads (and CAS numbers), so it must not
+                # keep any cookie. Response cookies are still available in `response.cookies`
+                session.cookies.set_policy(_BlockAllCookies())
+                # Connections (and their TLS handshake) are kept alive and reused
+                # by every request to this host
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _sessions[key] = session
+    return session
+
+
+def http_request(method: str, url: str, **kwargs) -> requests.Response:
+    """Send a request using the shared session of the url host, within the
+    rate limit of this host
+
+    Requests answered with 429 (Too Many Requests) or 503 (Service Unavailable)
+    are sent again after the backoff delay, up to `rate_limit.max_retries` times.
+
+    If `response_cache` is set, the requests to the hosts with a TTL in
+    `http_cache.host_ttls` are answered from it while their response is
+    fresh. Streamed requests (the SDS downloads) and requests with cookies
+    are always sent, and so are the requests of a thread inside
+    `bypassing_cache()`.
+
+    Parameters
+    ----------
+    method : str
+        the HTTP method, e.g. 'GET'
+    url : str
+        the url of the request
+    **kwargs
+        same parameters as `requests.request()`
+
+    Returns
+    -------
+    requests.Response
+        the response of the host
+    """
+    cache_key = None
+    ttl = http_cache.host_ttl(url)
+    if response_cache is not None and ttl > 0 and not kwargs.get('stream') and not kwargs.get('cookies'):
+        cache_key = http_cache.request_key(method, url, kwargs.get('params'), kwargs.get('data'), kwargs.get('json'))
+        if cache_bypassed():
+            # The cached response gave a dead end, it must not be used again even if this request fails
+            response_cache.delete(cache_key)
+            response = None
+        else:
+            response = response_cache.get(cache_key)
+        metrics.http_cache_lookups.inc(host=(urlsplit(url.strip()).hostname or '').lower(),
+                                       result='bypass' if cache_bypassed() else 'miss' if response is None else 'hit')
+        if response is not None:
+            return response
+
+    session = get_session(url)
+    limiter = rate_limit.get_limiter(url)
+    url = _override_url(url)
+    for attempt in range(rate_limit.max_retries + 1):
+        with limiter:
+            start = time.monotonic()
+            try:
+                response = session.request(method, url, **kwargs)
+            except requests.RequestException as error:
+                _failures.count = request_failures() + 1
+                metrics.http_requests.inc(host=limiter.host)
+                metrics.http_errors.inc(host=limiter.host, error=type(error).__name__)
+                if isinstance(error, requests.Timeout):
+                    limiter.throttled()
+                raise
+        _record_response(limiter.host, response, time.monotonic() - start, kwargs.get('stream', False))
+
+        if response.status_code not in (429, 503):
+            limiter.succeeded()
+            if response.status_code >= 500:
+                _failures.count = request_failures() + 1
+            if cache_key is not None and response.status_code == 200 and not response.history:
+                response_cache.put(cache_key, response, ttl)
+            return response
+
+        limiter.throttled(response.headers.get('Retry-After'))
+        if attempt < rate_limit.max_retries:
+            response.close()
+    _failures.count = request_failures() + 1
+    return response
+
+
+def _record_response(host: str, response: requests.Response, seconds: float, stream: bool) -> None:
+    """Record a response in the HTTP metrics of host"""
+    metrics.http_requests.inc(host=host)
+    metrics.http_request_seconds.observe(seconds, host=host)
+    if response.status_code >= 400:
+        metrics.http_errors.inc(host=host, error=f'HTTP {response.status_code}')
+    # A streamed response body is not read yet, it is counted by its reader
+    if not stream:
+        metrics.http_response_bytes.inc(len(response.content), host=host)
+
+
+def request_failures() -> int:
+    """Get the number of failed requests sent by the current thread
+
+    A request failed if it raised an error, timed out or got a server error
+    (5xx, including throttling that lasted after all retries). This tells
+    an extractor answering None because the SDS was not found apart from
+    one answering None because the supplier could not be reached.
+
+    Returns
+    -------
+    int
+        the number of failed requests since the thread started
+    """
+    return getattr(_failures, 'count', 0)
+
+
+@contextmanager
+def bypassing_cache() -> Iterator[None]:
+    """Send the requests of the current thread instead of answering them from
+    `response_cache`, e.g. to search again a supplier whose cached search
+    gave a url that does not give the SDS anymore
+
+    The responses cached for these requests are evicted, and replaced by
+    the new responses if they can be cached.
+    """
+    previous = cache_bypassed()
+    _bypass.enabled = True
+    try:
+        yield
+    finally:
+        _bypass.enabled = previous
+
+
+def cache_bypassed() -> bool:
+    """Check if the current thread is inside `bypassing_cache()`"""
+    return getattr(_bypass, 'enabled', False)
+
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    """Send a GET request using the shared session of the url host,
+    same parameters as `requests.get()`"""
+    kwargs.setdefault('allow_redirects', True)
+    return http_request('GET', url, **kwargs)
+
+
+def http_post(url: str, **kwargs) -> requests.Response:
+    """Send a POST request using the shared session of the url host,
+    same parameters as `requests.post()`"""
+    return http_request('POST', url, **kwargs)
+
+
+def warm_up_sessions(urls: Iterable[str], connections: int = 1, timeout: float = 10) -> int:
+    """Open connections to the hosts of urls ahead of time
+
+    Parameters
+    ----------
+    urls : Iterable[str]
+        one url on each host of interest
+    connections : int, optional
+        the number of connections opened for each host, by default 1
+    timeout : float, optional
+        timeout for each warm-up request, by default 10
+
+    Returns
+    -------
+    int
+        the number of hosts that answered
+    """
+    def warm_up(url):
+        try:
+            get_session(url).head(_override_url(url), timeout=timeout)
+            return _host_key(url)
+        except requests.RequestException:
+            return None
+
+    urls = [url for url in urls for _ in range(connections)]
+    if not urls:
+        return 0
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        answered_hosts = set(executor.map(warm_up, urls))
+    answered_hosts.discard(None)
+    return len(answered_hosts)
+
+
+def close_sessions() -> None:
+    """Close all the shared sessions and their connections"""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
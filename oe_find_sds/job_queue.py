@@ -0,0 +1,221 @@
+"""
+Job queue shared by a coordinator and any number of workers, kept in a database table
+
+The coordinator puts the CAS numbers missing SDS in the job table, then
+applies the results of the workers to the Open Enventory database. The
+workers, on any number of hosts, lease a few jobs at a time, search and
+download their SDS, and put the SDS files back in the job table.
+
+A leased job is only hidden from the other workers until its lease
+expires (`lease_timeout`): the jobs of a worker that died are leased again
+by the others, up to `max_attempts` times.
+
+The table is in MariaDB (the Open Enventory database itself) or, for
+local runs and tests, in an SQLite file.
+"""
+
+
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+
+# Name of the job table
+job_table = 'oe_find_sds_jobs'
+# Number of seconds a job is hidden from the other workers once leased
+lease_timeout = 600
+# Number of times a job is leased before it is given up
+max_attempts = 3
+# Number of CAS numbers inserted in each query
+enqueue_chunk_size = 1000
+
+create_table_queries = {
+    'mysql': [f"CREATE TABLE IF NOT EXISTS {job_table} ("
+              "cas_nr VARCHAR(80) NOT NULL PRIMARY KEY, "
+              "state VARCHAR(10) NOT NULL, "
+              "worker VARCHAR(100) NULL, "
+              "lease_token CHAR(32) NULL, "
+              "lease_expires DOUBLE NULL, "
+              "attempts INT NOT NULL DEFAULT 0, "
+              "found TINYINT NULL, "
+              "sds_source VARCHAR(100) NULL, "
+              "sds_file LONGBLOB NULL, "
+              "KEY job_state (state, lease_expires), "
+              "KEY job_lease (lease_token))"],
+    'sqlite': [f"CREATE TABLE IF NOT EXISTS {job_table} ("
+               "cas_nr TEXT NOT NULL PRIMARY KEY, "
+               "state TEXT NOT NULL, "
+               "worker TEXT NULL, "
+               "lease_token TEXT NULL, "
+               "lease_expires REAL NULL, "
+               "attempts INTEGER NOT NULL DEFAULT 0, "
+               "found INTEGER NULL, "
+               "sds_source TEXT NULL, "
+               "sds_file BLOB NULL)",
+               f"CREATE INDEX IF NOT EXISTS job_state ON {job_table} (state, lease_expires)",
+               f"CREATE INDEX IF NOT EXISTS job_lease ON {job_table} (lease_token)"],
+}
+enqueue_queries = {
+    'mysql': f"INSERT IGNORE INTO {job_table} (cas_nr, state) VALUES (%s, 'queued')",
+    'sqlite': f"INSERT OR IGNORE INTO {job_table} (cas_nr, state) VALUES (%s, 'queued')",
+}
+# The jobs queued, or leased by a worker whose lease expired
+_leasable = "(state='queued' OR (state='leased' AND lease_expires < %s)) AND attempts < %s"
+lease_queries = {
+    # One statement: two workers never lease the same job
+    'mysql': (f"UPDATE {job_table} SET state='leased', worker=%s, lease_token=%s, lease_expires=%s, "
+              f"attempts=attempts+1 WHERE {_leasable} ORDER BY attempts, cas_nr LIMIT %s"),
+    'sqlite': (f"UPDATE {job_table} SET state='leased', worker=%s, lease_token=%s, lease_expires=%s, "
+               f"attempts=attempts+1 WHERE cas_nr IN (SELECT cas_nr FROM {job_table} WHERE {_leasable} "
+               "ORDER BY attempts, cas_nr LIMIT %s)"),
+}
+
+
+class JobQueue:
+    """Job table of a coordinator and its workers
+
+    The connection is shared between threads, every access holds a lock.
+
+    Parameters
+    ----------
+    connection : mysql.connector Object or sqlite3.Connection
+        a connection to the database keeping the job table, created if it does not exist
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.dialect = 'sqlite' if isinstance(connection, sqlite3.Connection) else 'mysql'
+        self._lock = threading.Lock()
+        for query in create_table_queries[self.dialect]:
+            self._execute(query)
+
+    @classmethod
+    def sqlite(cls, path: Union[str, Path]) -> 'JobQueue':
+        """Open the job table kept in an SQLite file, e.g. for workers on the same host"""
+        return cls(sqlite3.connect(str(path), timeout=30, check_same_thread=False))
+
+    def close(self) -> None:
+        with self._lock:
+            self.connection.close()
+
+    def _execute(self, query: str, params: tuple = (), many: bool = False, fetch: bool = False):
+        """Run query in its own transaction, and return the rows it selected if fetch"""
+        if self.dialect == 'sqlite':
+            query = query.replace('%s', '?')
+        with self._lock:
+            cursor = self.connection.cursor()
+            try:
+                if many:
+                    cursor.executemany(query, params)
+                else:
+                    cursor.execute(query, params)
+                rows = cursor.fetchall() if fetch else cursor.rowcount
+                self.connection.commit()
+                return rows
+            except Exception:
+                self.connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def enqueue(self, cas_list: Iterable[str]) -> int:
+        """Add a job for each CAS number not in the queue yet
+
+        Returns
+        -------
+        int
+            the number of CAS numbers given
+        """
+        count = 0
+        chunk = []
+        for cas_nr in cas_list:
+            chunk.append((cas_nr, ))
+            if len(chunk) >= enqueue_chunk_size:
+                self._execute(enqueue_queries[self.dialect], chunk, many=True)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            self._execute(enqueue_queries[self.dialect], chunk, many=True)
+            count += len(chunk)
+        return count
+
+    def lease(self, worker: str, count: int) -> Tuple[str, List[str]]:
+        """Lease up to count jobs for `lease_timeout` seconds
+
+        Parameters
+        ----------
+        worker : str
+            the name of the worker, e.g. '<host>:<pid>'
+        count : int
+            the maximum number of jobs leased
+
+        Returns
+        -------
+        Tuple[str, List[str]]
+            the lease token, to give back with the results, and the CAS numbers leased
+        """
+        token = uuid.uuid4().hex
+        now = time.time()
+        self._execute(lease_queries[self.dialect], (worker, token, now + lease_timeout, now, max_attempts, count))
+        rows = self._execute(f"SELECT cas_nr FROM {job_table} WHERE lease_token=%s", (token, ), fetch=True)
+        return token, [cas_nr for (cas_nr, ) in rows]
+
+    def complete(self, cas_nr: str, token: str, found: bool, sds_source: Optional[str] = None,
+                 sds_file: Optional[bytes] = None) -> bool:
+        """Give the result of a leased job
+
+        Parameters
+        ----------
+        cas_nr : str
+            the CAS number of the job
+        token : str
+            the token of its lease
+        found : bool
+            True if the SDS was downloaded
+        sds_source : Optional[str], optional
+            the name of the SDS source
+        sds_file : Optional[bytes], optional
+            the content of the SDS file
+
+        Returns
+        -------
+        bool
+            False if the lease had expired and the job was leased again by another worker
+        """
+        return self._execute(
+            f"UPDATE {job_table} SET state='done', found=%s, sds_source=%s, sds_file=%s, lease_token=NULL "
+            "WHERE cas_nr=%s AND lease_token=%s", (int(found), sds_source, sds_file, cas_nr, token)) > 0
+
+    def done_jobs(self, count: int) -> List[Tuple[str, bool, Optional[str], Optional[bytes]]]:
+        """Get up to count jobs done, as (cas_nr, found, sds_source, sds_file)"""
+        rows = self._execute(f"SELECT cas_nr, found, sds_source, sds_file FROM {job_table} WHERE state='done' "
+                             "LIMIT %s", (count, ), fetch=True)
+        return [(cas_nr, bool(found), sds_source, bytes(sds_file) if sds_file is not None else None)
+                for cas_nr, found, sds_source, sds_file in rows]
+
+    def remove(self, cas_list: Iterable[str]) -> None:
+        """Remove the jobs of the CAS numbers, once their results are applied"""
+        self._execute(f"DELETE FROM {job_table} WHERE cas_nr=%s", [(cas_nr, ) for cas_nr in cas_list], many=True)
+
+    def give_up_expired(self) -> int:
+        """Mark as done, without SDS, the jobs whose last lease expired after `max_attempts` attempts
+
+        Returns
+        -------
+        int
+            the number of jobs given up
+        """
+        return self._execute(f"UPDATE {job_table} SET state='done', found=0, lease_token=NULL "
+                             "WHERE state='leased' AND lease_expires < %s AND attempts >= %s",
+                             (time.time(), max_attempts))
+
+    def counts(self) -> Dict[str, int]:
+        """Get the number of jobs in each state: 'queued', 'leased' and 'done'"""
+        return dict(self._execute(f"SELECT state, COUNT(*) FROM {job_table} GROUP BY state", fetch=True))
+
+    def is_drained(self) -> bool:
+        """Check that no job is left to lease, now or when the current leases expire"""
+        counts = self.counts()
+        return not counts.get('queued') and not counts.get('leased')
@@ -0,0 +1,129 @@
+"""
+Append-only journal of the progress of a run, to resume it after a crash
+
+Each line of the journal file (JSON lines, in the download folder) records
+the new state of one CAS number:
+
+    queued      selected from the database, to be searched
+    resolved    the url of its SDS was found (with 'source' and 'url')
+    downloaded  its SDS file is in the download folder (with 'source')
+    missing     no supplier has its SDS
+    applied     its SDS was uploaded into the database (with 'database')
+
+Every line is flushed when written, so the journal survives the program
+being killed. A resumed run (`Journal(..., resume=True)`) reads the journal
+back: the CAS numbers applied or missing are finished and skipped, the ones
+resolved go straight to the download of their url, and the others are
+searched again.
+"""
+
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple, Union
+
+
+# Name of the journal file, created in the download folder
+journal_file_name = 'oe_find_sds_journal.jsonl'
+# States of a CAS number, in the order they are reached
+states = ('queued', 'resolved', 'downloaded', 'missing', 'applied')
+
+
+class Journal:
+    """Journal of the states of the CAS numbers of a run
+
+    The journal is shared between threads, every write holds a lock.
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        the journal file
+    resume : bool, optional
+        True to read the journal of the previous run and append to it,
+        False (default) to start a new journal
+    """
+    def __init__(self, path: Union[str, Path], resume: bool = False):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        # Last state of each CAS number, with the fields recorded with it
+        self.entries: Dict[str, Dict] = {}
+        # CAS numbers applied, by database
+        self.applied: Dict[str, Set[str]] = {}
+        if resume and self.path.exists():
+            self._replay()
+        self._file = open(str(self.path), 'a' if resume else 'w', encoding='utf-8')
+
+    @classmethod
+    def in_folder(cls, folder: Union[str, Path], resume: bool = False) -> 'Journal':
+        """Open the journal kept in folder (usually the download folder)"""
+        return cls(Path(folder) / journal_file_name, resume=resume)
+
+    def _replay(self) -> None:
+        with open(str(self.path), encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line is cut if the program was killed while writing it
+                    continue
+                if entry.get('state') == 'applied':
+                    self.applied.setdefault(entry.get('database', ''), set()).add(entry['cas'])
+                else:
+                    self.entries[entry['cas']] = entry
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+    def record(self, cas_nr: str, state: str, **fields: Optional[str]) -> None:
+        """Append the new state of cas_nr to the journal
+
+        Parameters
+        ----------
+        cas_nr : str
+            the CAS number
+        state : str
+            its new state, one of `states`
+        fields
+            the details of the state, e.g. source and url for 'resolved'
+        """
+        entry = {'cas': cas_nr, 'state': state, 'time': round(time.time(), 3), **fields}
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if state == 'applied':
+                self.applied.setdefault(fields.get('database') or '', set()).add(cas_nr)
+            else:
+                self.entries[cas_nr] = entry
+
+    def record_many(self, cas_list, state: str, **fields: Optional[str]) -> None:
+        """Append the same state for many CAS numbers, e.g. 'queued', in one write"""
+        now = round(time.time(), 3)
+        entries = [{'cas': cas_nr, 'state': state, 'time': now, **fields} for cas_nr in cas_list]
+        with self._lock:
+            self._file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+            self._file.flush()
+            for entry in entries:
+                self.entries[entry['cas']] = entry
+
+    def state(self, cas_nr: str) -> Optional[str]:
+        """Get the last state recorded for cas_nr (other than 'applied'), None if not in the journal"""
+        entry = self.entries.get(cas_nr)
+        return entry['state'] if entry else None
+
+    def is_finished(self, cas_nr: str, database: str = '') -> bool:
+        """Check if nothing is left to do for cas_nr in database: applied, or missing everywhere"""
+        return cas_nr in self.applied.get(database, ()) or self.state(cas_nr) == 'missing'
+
+    def resolved_url(self, cas_nr: str) -> Optional[Tuple[str, str]]:
+        """Get the SDS source and url recorded for cas_nr, if its last state is 'resolved'"""
+        entry = self.entries.get(cas_nr)
+        if entry and entry['state'] == 'resolved' and entry.get('url'):
+            return entry.get('source') or 'SDS', entry['url']
+        return None
@@ -0,0 +1,266 @@
+"""
+Metrics of a run: supplier searches, HTTP requests, SDS downloads and SQL phases
+
+The metrics are counters, gauges and histograms with labels, kept in memory
+behind one lock: recording a value is a dictionary update, cheap enough to
+be always on. At the end of a run (and with the status reports) they are
+written as JSON and/or as a Prometheus textfile for the textfile collector
+of node_exporter.
+"""
+
+
+import bisect
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+
+# Prefix of the metric names
+namespace = 'oe_find_sds'
+# Files the metrics are written to by `write_metrics()`, None to not write them
+json_file: Optional[str] = None
+prometheus_file: Optional[str] = None
+
+# Bucket upper bounds of the histograms
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 60)
+size_buckets = (16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024)
+
+_lock = threading.Lock()
+_metrics: List['Metric'] = []
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class Metric:
+    """Base class of the metrics, one value for each set of label values
+
+    Parameters
+    ----------
+    name : str
+        the name of the metric, without `namespace`
+    help : str
+        the description of the metric
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[LabelKey, object] = {}
+        _metrics.append(self)
+
+    @property
+    def full_name(self) -> str:
+        return f'{namespace}_{self.name}'
+
+    def reset(self) -> None:
+        with _lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    """Value that only goes up, e.g. a number of requests"""
+    kind = 'counter'
+
+    def inc(self, value: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+
+class Gauge(Counter):
+    """Value that is set, e.g. the duration of a phase"""
+    kind = 'gauge'
+
+    def set(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """Distribution of values, counted in buckets
+
+    Parameters
+    ----------
+    buckets : Sequence[float]
+        the upper bounds of the buckets, in increasing order
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = latency_buckets):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count for each bucket and for +Inf, then the sum of the values
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def get(self, **labels: str) -> Tuple[int, float]:
+        """Get the number and the sum of the values observed"""
+        with _lock:
+            counts = self.values.get(tuple(sorted(labels.items())))
+            return (sum(counts[:-1]), counts[-1]) if counts else (0, 0.0)
+
+
+# Supplier searches, labelled by supplier and result ('hit', 'miss', 'unreachable' or 'error')
+extractor_searches = Counter('extractor_searches_total', 'Supplier searches for the SDS url of a CAS number')
+extractor_seconds = Histogram('extractor_seconds', 'Time taken by a supplier search')
+# Exceptions caught by the extractors, labelled by supplier and error class. Some are the usual way
+# of finding no SDS, a jump in one of them often means the supplier website changed
+extractor_exceptions = Counter('extractor_exceptions_total', 'Exceptions caught by the supplier extractors')
+# HTTP requests, labelled by host
+http_requests = Counter('http_requests_total', 'HTTP requests sent to the supplier hosts')
+http_request_seconds = Histogram('http_request_seconds', 'Time taken by an HTTP request, until the headers are received')
+http_errors = Counter('http_errors_total', 'HTTP requests that failed, by error class or status code')
+http_response_bytes = Counter('http_response_bytes_total', 'Bytes received in the HTTP responses')
+# Lookups of the on-disk response cache, labelled by host and result ('hit', 'miss' or 'bypass')
+http_cache_lookups = Counter('http_cache_lookups_total', 'Requests looked up in the on-disk HTTP response cache')
+# SDS downloads, labelled by result ('ok' or 'rejected')
+pdf_downloads = Counter('pdf_downloads_total', 'SDS file downloads')
+pdf_download_seconds = Histogram('pdf_download_seconds', 'Time taken by an SDS file download')
+pdf_size_bytes = Histogram('pdf_size_bytes', 'Size of the SDS files downloaded', buckets=size_buckets)
+# SQL phases, labelled by phase ('select', 'update')
+phase_seconds = Gauge('phase_seconds', 'Time spent in each phase of the run')
+sql_update_batch_seconds = Histogram('sql_update_batch_seconds', 'Time taken by an SQL update batch')
+sql_updated = Counter('sql_updated_total', 'Molecule CAS numbers updated with an SDS')
+
+
+def reset() -> None:
+    """Forget the values of all metrics"""
+    for metric in _metrics:
+        metric.reset()
+
+
+def _format_labels(labels: Union[LabelKey, List[Tuple[str, str]]]) -> str:
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_bound(bound: float) -> str:
+    return repr(float(bound))
+
+
+def _format_value(value: float) -> str:
+    # Counts are written in full, e.g. a number of bytes
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def to_prometheus() -> str:
+    """Format the metrics in the Prometheus text exposition format
+
+    Examples
+    --------
+    >>> reset(); http_requests.inc(host='www.fishersci.com')
+    >>> print([line for line in to_prometheus().splitlines() if line.startswith('oe_find_sds_http_requests')][0])
+    oe_find_sds_http_requests_total{host="www.fishersci.com"} 1
+    """
+    lines = []
+    with _lock:
+        for metric in _metrics:
+            lines.append(f'# HELP {metric.full_name} {metric.help}')
+            lines.append(f'# TYPE {metric.full_name} {metric.kind}')
+            for key, value in sorted(metric.values.items()):
+                if metric.kind != 'histogram':
+                    lines.append(f'{metric.full_name}{_format_labels(key)} {_format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ('+Inf', ), value[:-1]):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else _format_bound(bound)
+                    lines.append(f'{metric.full_name}_bucket{_format_labels(list(key) + [("le", le)])} {cumulative}')
+                lines.append(f'{metric.full_name}_sum{_format_labels(key)} {_format_value(value[-1])}')
+                lines.append(f'{metric.full_name}_count{_format_labels(key)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def to_dict() -> Dict[str, Dict]:
+    """Get the metrics as a dictionary, for JSON
+
+    Returns
+    -------
+    Dict[str, Dict]
+        for each metric: its type, description and a list of values with their labels
+        (for histograms: count, sum and the count of each bucket)
+    """
+    result = {}
+    with _lock:
+        for metric in _metrics:
+            values = []
+            for key, value in sorted(metric.values.items()):
+                if metric.kind == 'histogram':
+                    buckets = {_format_bound(bound): count for bound, count in zip(metric.buckets, value)}
+                    buckets['+Inf'] = value[-2]
+                    values.append({'labels': dict(key), 'count': sum(value[:-1]), 'sum': value[-1], 'buckets': buckets})
+                else:
+                    values.append({'labels': dict(key), 'value': value})
+            result[metric.full_name] = {'type': metric.kind, 'help': metric.help, 'values': values}
+    return result
+
+
+def supplier_summary() -> Dict[str, Dict[str, float]]:
+    """Get for each supplier its number of searches, hit rate, errors and mean search time"""
+    summary = {}
+    with _lock:
+        searches = list(extractor_searches.values.items())
+    for key, count in searches:
+        labels = dict(key)
+        supplier = summary.setdefault(labels['supplier'], {'searches': 0, 'hit': 0, 'miss': 0,
+                                                           'unreachable': 0, 'error': 0})
+        supplier['searches'] += count
+        supplier[labels['result']] = supplier.get(labels['result'], 0) + count
+    for name, supplier in summary.items():
+        count, total = extractor_seconds.get(supplier=name)
+        supplier['hit_rate'] = supplier['hit'] / supplier['searches'] if supplier['searches'] else 0
+        supplier['mean_seconds'] = total / count if count else 0
+    return summary
+
+
+def format_supplier_summary() -> str:
+    """Format `supplier_summary()` as one line for each supplier"""
+    lines = []
+    for supplier, status in sorted(supplier_summary().items()):
+        lines.append('\t{:15} {:6} searches, {:5.1%} hits, {} misses, {} unreachable, {} errors, {:.2f}s per search'.format(
+            supplier, int(status['searches']), status['hit_rate'], int(status['miss']),
+            int(status['unreachable']), int(status['error']), status['mean_seconds']))
+    return '\n'.join(lines)
+
+
+def _write_atomic(path: Union[str, Path], content: str) -> None:
+    """Write a file through a temporary file, so its readers never see it half written"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(dir=str(path.parent), prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, str(path))
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
+def write_metrics() -> None:
+    """Write the metrics into `json_file` and `prometheus_file`, the ones that are set"""
+    global json_file, prometheus_file
+
+    if json_file:
+        _write_atomic(json_file, json.dumps({'metrics': to_dict(), 'suppliers': supplier_summary()}, indent=2))
+    if prometheus_file:
+        _write_atomic(prometheus_file, to_prometheus())
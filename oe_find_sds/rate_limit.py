@@ -0,0 +1,261 @@
+"""
+Per-host rate limiting and adaptive backoff for the supplier requests
+
+Each host gets its own token bucket (requests per second, with bursts) and
+a cap on the number of requests in flight. When a host answers 429/503 or
+times out, its rate is halved and all requests to it wait for the backoff
+delay (or the `Retry-After` given by the host). The rate then slowly grows
+back to its configured limit while requests succeed.
+"""
+
+
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Dict, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+
+class RateLimit(NamedTuple):
+    # maximum number of requests per second
+    rate: float = 10.0
+    # maximum number of requests sent at once after a quiet period
+    burst: int = 20
+    # maximum number of requests in flight at the same time
+    max_concurrency: int = 20
+
+
+# Limit used for the hosts without their own limit
+default_limit = RateLimit()
+# Limit for each host, set with `set_host_limit()`
+host_limits: Dict[str, RateLimit] = {}
+# Number of times a request answered with 429/503 is sent again
+max_retries = 2
+# Bounds of the backoff delay, in seconds
+min_backoff = 1.0
+max_backoff = 120.0
+
+_limiters: Dict[str, 'HostLimiter'] = {}
+_limiters_lock = threading.Lock()
+
+
+class HostLimiter:
+    """Token bucket, concurrency cap and backoff state of a single host
+
+    Use as a context manager around each request:
+
+    >>> limiter = HostLimiter('www.fishersci.com', RateLimit(rate=5, burst=5, max_concurrency=2))
+    >>> with limiter:
+    ...     pass
+    >>> limiter.succeeded()
+    """
+    # Window used to compute the current request rate, in seconds
+    rate_window = 60.0
+
+    def __init__(self, host: str, limit: RateLimit):
+        self.host = host
+        self.limit = limit
+        # Rate currently allowed, lowered after throttling and raised back after successes
+        self.rate = float(limit.rate)
+        self.tokens = float(limit.burst)
+        self.backoff = 0.0
+        self.blocked_until = 0.0
+        self.in_flight = 0
+        self.throttle_count = 0
+        self._updated = time.monotonic()
+        self._sent = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(limit.max_concurrency)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def acquire(self) -> None:
+        """Wait for the backoff delay, a free slot and a token"""
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    wait = self.blocked_until - now
+                    if wait <= 0:
+                        self._refill(now)
+                        if self.tokens >= 1:
+                            self.tokens -= 1
+                            self.in_flight += 1
+                            self._sent.append(now)
+                            return
+                        wait = (1 - self.tokens) / self.rate
+                time.sleep(wait)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self) -> None:
+        """Give back the slot taken by `acquire()`"""
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.limit.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def succeeded(self) -> None:
+        """Record a successful request: slowly raise the rate back to its limit"""
+        with self._lock:
+            self.rate = min(self.limit.rate, self.rate + self.limit.rate * 0.05)
+            self.backoff = self.backoff / 2 if self.backoff > min_backoff else 0.0
+
+    def throttled(self, retry_after: Optional[str] = None) -> float:
+        """Record a throttled (429/503) or timed out request
+
+        Parameters
+        ----------
+        retry_after : Optional[str], optional
+            the `Retry-After` header given by the host, by default None
+
+        Returns
+        -------
+        float
+            the number of seconds all requests to this host now wait
+        """
+        delay = parse_retry_after(retry_after)
+        with self._lock:
+            self.throttle_count += 1
+            self.rate = max(self.limit.rate / 64, self.rate / 2)
+            self.backoff = min(max_backoff, max(min_backoff, self.backoff * 2))
+            delay = min(max_backoff, self.backoff if delay is None else delay)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            # Do not send a burst of requests as soon as the backoff is over
+            self.tokens = min(self.tokens, 1.0)
+        return delay
+
+    def status(self) -> Dict[str, float]:
+        """Get the current state of this host
+
+        Returns
+        -------
+        Dict[str, float]
+            - 'rate': requests sent per second over the last minute
+            - 'allowed_rate': the rate currently allowed
+            - 'limit': the configured rate
+            - 'in_flight': the number of requests in flight
+            - 'backoff': the number of seconds before requests are sent again
+            - 'throttled': the number of throttled or timed out requests
+        """
+        with self._lock:
+            now = time.monotonic()
+            while self._sent and self._sent[0] < now - self.rate_window:
+                self._sent.popleft()
+            return {
+                'rate': round(len(self._sent) / self.rate_window, 2),
+                'allowed_rate': round(self.rate, 2),
+                'limit': self.limit.rate,
+                'in_flight': self.in_flight,
+                'backoff': round(max(0.0, self.blocked_until - now), 1),
+                'throttled': self.throttle_count,
+            }
+
+
+def parse_retry_after(retry_after: Optional[str]) -> Optional[float]:
+    """Convert a `Retry-After` header into a number of seconds
+
+    Parameters
+    ----------
+    retry_after : Optional[str]
+        the header value, either a number of seconds or an HTTP date
+
+    Returns
+    -------
+    Optional[float]
+        the number of seconds to wait, None if the header is missing or invalid
+
+    Examples
+    --------
+    >>> parse_retry_after('30')
+    30.0
+    >>> parse_retry_after(None) is None
+    True
+    """
+    if not retry_after:
+        return None
+    retry_after = retry_after.strip()
+    if retry_after.isdigit():
+        return float(retry_after)
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def _host(url: str) -> str:
+    return (urlsplit(url.strip()).hostname or '').lower()
+
+
+def get_limiter(url: str) -> HostLimiter:
+    """Get the limiter of the host of url, creating it if needed
+
+    Parameters
+    ----------
+    url : str
+        any url on the host of interest
+
+    Returns
+    -------
+    HostLimiter
+        the limiter for this host
+    """
+    host = _host(url)
+    limiter = _limiters.get(host)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(host)
+            if limiter is None:
+                limiter = HostLimiter(host, host_limits.get(host, default_limit))
+                _limiters[host] = limiter
+    return limiter
+
+
+def set_host_limit(host: str, limit: RateLimit) -> None:
+    """Set the limit of a host, replacing its current limiter
+
+    Parameters
+    ----------
+    host : str
+        the host name, e.g. 'www.fishersci.com'
+    limit : RateLimit
+        the new limit of this host
+    """
+    host = host.lower()
+    with _limiters_lock:
+        host_limits[host] = limit
+        _limiters.pop(host, None)
+
+
+def reset_limiters() -> None:
+    """Forget the state of all hosts"""
+    with _limiters_lock:
+        _limiters.clear()
+
+
+def limiter_status() -> Dict[str, Dict[str, float]]:
+    """Get the current state of every host, see `HostLimiter.status()`"""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.host: limiter.status() for limiter in limiters}
+
+
+def format_limiter_status() -> str:
+    """Format `limiter_status()` as one line for each host"""
+    lines = []
+    for host, status in sorted(limiter_status().items()):
+        lines.append('\t{:25} {:6.2f} req/s (allowed {:.2f}/{:.2f}), {} in flight, {} throttled, backoff {}s'.format(
+            host, status['rate'], status['allowed_rate'], status['limit'],
+            status['in_flight'], status['throttled'], status['backoff']))
+    return '\n'.join(lines)
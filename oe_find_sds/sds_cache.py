@@ -0,0 +1,419 @@
+"""
+Persistent cache of the SDS searches, kept in a SQLite file next to the downloaded SDS
+
+The negative cache records, for each CAS number, the suppliers that do not
+carry its SDS. These suppliers are skipped until the entry expires, so the
+CAS numbers no supplier carries are not searched again on every run.
+
+The url cache records, for each CAS number, the SDS url found by the
+suppliers, so a later run goes straight to the SDS download.
+
+The supplier statistics record, for each supplier, its number of searches,
+hits and search time, overall and for each CAS prefix, so the suppliers
+can be ordered by their chance to give the SDS quickly.
+
+The blob index records, for each SDS file content (SHA-256 hash) uploaded
+into a database, a CAS number it was uploaded for, so the same content is
+copied inside the database instead of being uploaded again.
+
+The watermarks record, for each database, the last molecule looked at and
+the time of the last full sweep, so an incremental run only looks at the
+molecules added since the previous run.
+
+The validators record, for each SDS file downloaded, its url and the
+ETag, Last-Modified and Content-Length headers it was sent with, so the
+refresh mode checks that the SDS did not change with a conditional request
+instead of downloading it again.
+"""
+
+
+import random
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+
+# Name of the cache file, created in the download folder
+cache_file_name = 'oe_find_sds_cache.sqlite3'
+# Number of seconds a supplier miss is remembered, by default 7 days
+negative_ttl = 7 * 24 * 3600
+# The TTL of each miss is randomly changed by up to +/- this fraction, so that
+# the misses recorded in the same run do not all expire in the same run
+negative_ttl_jitter = 0.25
+# Number of seconds a url found for an SDS is kept, by default 30 days
+url_ttl = 30 * 24 * 3600
+# Number of seconds a url is kept for the suppliers giving urls that expire sooner
+supplier_url_ttl: Dict[str, float] = {
+    # The urls of chemicalsafety are signed, they are only kept for a day
+    'chemicalsafety': 24 * 3600,
+}
+# Maximum number of searches kept in the statistics of a supplier: older searches
+# weigh less and less, so the statistics follow the changes of the suppliers
+stats_window = 1000
+
+
+def cas_prefix(cas_nr: str) -> str:
+    """Get the prefix grouping cas_nr with similar CAS numbers in the supplier statistics
+
+    The CAS numbers are given in order of registration, so the number of
+    digits of their first part groups the substances by age.
+
+    Examples
+    --------
+    >>> cas_prefix('64-19-7'), cas_prefix('885051-07-0')
+    ('2', '6')
+    """
+    return str(len(cas_nr.split('-')[0]))
+
+
+class SdsCache:
+    """SQLite cache of the SDS searches
+
+    The connection is shared between threads, every access holds a lock.
+
+    Parameters
+    ----------
+    path : Union[str, Path]
+        the cache file, created if it does not exist
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False,
+                                           isolation_level=None)
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS negative_cache ('
+                ' cas_nr TEXT NOT NULL,'
+                ' supplier TEXT NOT NULL,'
+                ' checked_at REAL NOT NULL,'
+                ' expires_at REAL NOT NULL,'
+                ' PRIMARY KEY (cas_nr, supplier))')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS resolved_urls ('
+                ' cas_nr TEXT PRIMARY KEY,'
+                ' supplier TEXT NOT NULL,'
+                ' sds_source TEXT NOT NULL,'
+                ' full_url TEXT NOT NULL,'
+                ' resolved_at REAL NOT NULL)')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS supplier_stats ('
+                ' supplier TEXT NOT NULL,'
+                ' cas_prefix TEXT NOT NULL,'
+                ' searches REAL NOT NULL,'
+                ' hits REAL NOT NULL,'
+                ' seconds REAL NOT NULL,'
+                ' PRIMARY KEY (supplier, cas_prefix))')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS stored_blobs ('
+                ' database TEXT NOT NULL,'
+                ' sha256 TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' cas_nr TEXT NOT NULL,'
+                ' PRIMARY KEY (database, sha256))')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS sds_validators ('
+                ' cas_nr TEXT PRIMARY KEY,'
+                ' sds_source TEXT NOT NULL,'
+                ' full_url TEXT NOT NULL,'
+                ' etag TEXT,'
+                ' last_modified TEXT,'
+                ' content_length INTEGER,'
+                ' checked_at REAL NOT NULL)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS sds_validators_checked_at ON sds_validators (checked_at)')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS watermarks ('
+                ' database TEXT PRIMARY KEY,'
+                ' molecule_id INTEGER NOT NULL,'
+                ' scanned_at REAL NOT NULL,'
+                ' full_sweep_at REAL NOT NULL)')
+            self._connection.execute('DELETE FROM negative_cache WHERE expires_at <= ?', (time.time(), ))
+            # The statistics are kept in memory during the run, and saved by close()
+            self._saved_stats: Dict[Tuple[str, str], List[float]] = {
+                (supplier, prefix): [searches, hits, seconds] for supplier, prefix, searches, hits, seconds
+                in self._connection.execute('SELECT supplier, cas_prefix, searches, hits, seconds FROM supplier_stats')}
+        self._run_stats: Dict[Tuple[str, str], List[float]] = {}
+
+    @classmethod
+    def in_folder(cls, folder: Union[str, Path]) -> 'SdsCache':
+        """Open the cache file kept in folder (usually the download folder)"""
+        return cls(Path(folder) / cache_file_name)
+
+    def close(self) -> None:
+        """Save the supplier statistics and close the cache file"""
+        self.save_stats()
+        with self._lock:
+            self._connection.close()
+
+    def record_miss(self, cas_nr: str, supplier: str, ttl: Optional[float] = None) -> None:
+        """Remember that supplier does not have the SDS of cas_nr
+
+        Parameters
+        ----------
+        cas_nr : str
+            the CAS number searched
+        supplier : str
+            the name of the supplier, e.g. 'fisher'
+        ttl : Optional[float], optional
+            number of seconds the miss is remembered, by default None (use `negative_ttl`)
+        """
+        ttl = negative_ttl if ttl is None else ttl
+        now = time.time()
+        expires_at = now + ttl * (1 + random.uniform(-negative_ttl_jitter, negative_ttl_jitter))
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO negative_cache (cas_nr, supplier, checked_at, expires_at) VALUES (?, ?, ?, ?)',
+                (cas_nr, supplier, now, expires_at))
+
+    def known_misses(self, cas_nr: str) -> Set[str]:
+        """Get the suppliers known not to have the SDS of cas_nr
+
+        Parameters
+        ----------
+        cas_nr : str
+            the CAS number of interest
+
+        Returns
+        -------
+        Set[str]
+            the names of the suppliers with a miss that has not expired yet
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT supplier FROM negative_cache WHERE cas_nr = ? AND expires_at > ?',
+                (cas_nr, time.time())).fetchall()
+        return {supplier for (supplier, ) in rows}
+
+    def forget_misses(self, cas_nr: str) -> None:
+        """Forget all the misses recorded for cas_nr"""
+        with self._lock:
+            self._connection.execute('DELETE FROM negative_cache WHERE cas_nr = ?', (cas_nr, ))
+
+    def record_url(self, cas_nr: str, supplier: str, sds_source: str, full_url: str) -> None:
+        """Remember the url of the SDS of cas_nr
+
+        Parameters
+        ----------
+        cas_nr : str
+            the CAS number searched
+        supplier : str
+            the name of the supplier that found the url, e.g. 'fisher'
+        sds_source : str
+            the name of the SDS source
+        full_url : str
+            the url of the SDS file
+        """
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO resolved_urls (cas_nr, supplier, sds_source, full_url, resolved_at)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (cas_nr, supplier, sds_source, full_url, time.time()))
+
+    def cached_url(self, cas_nr: str) -> Optional[Tuple[str, str]]:
+        """Get the url found by a previous run for the SDS of cas_nr
+
+        Parameters
+        ----------
+        cas_nr : str
+            the CAS number of interest
+
+        Returns
+        -------
+        Optional[Tuple[str, str]]
+            Tuple[str, str]:
+                the name of the SDS source
+                the url of the SDS file
+            None: if no url is cached or the cached url has expired
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT supplier, sds_source, full_url, resolved_at FROM resolved_urls WHERE cas_nr = ?',
+                (cas_nr, )).fetchone()
+        if row is None:
+            return None
+        supplier, sds_source, full_url, resolved_at = row
+        if resolved_at + supplier_url_ttl.get(supplier, url_ttl) <= time.time():
+            self.forget_url(cas_nr)
+            return None
+        return sds_source, full_url
+
+    def forget_url(self, cas_nr: str) -> None:
+        """Forget the url cached for cas_nr"""
+        with self._lock:
+            self._connection.execute('DELETE FROM resolved_urls WHERE cas_nr = ?', (cas_nr, ))
+
+    def record_blob(self, database: str, sha256: str, size: int, cas_nr: str) -> None:
+        """Remember that the SDS file with this hash was uploaded into database for cas_nr
+
+        Parameters
+        ----------
+        database : str
+            the name of the database
+        sha256 : str
+            the SHA-256 hash of the SDS file
+        size : int
+            the size of the SDS file, in bytes
+        cas_nr : str
+            the CAS number the SDS file was uploaded for
+        """
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO stored_blobs (database, sha256, size, cas_nr) VALUES (?, ?, ?, ?)',
+                (database, sha256, size, cas_nr))
+
+    def stored_blob(self, database: str, sha256: str) -> Optional[Tuple[str, int]]:
+        """Get a CAS number the SDS file with this hash was uploaded into database for
+
+        Returns
+        -------
+        Optional[Tuple[str, int]]
+            the CAS number and the size of the SDS file, None if it was never uploaded
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT cas_nr, size FROM stored_blobs WHERE database = ? AND sha256 = ?',
+                (database, sha256)).fetchone()
+        return tuple(row) if row else None
+
+    def forget_blob(self, database: str, sha256: str) -> None:
+        """Forget the upload of the SDS file with this hash into database"""
+        with self._lock:
+            self._connection.execute('DELETE FROM stored_blobs WHERE database = ? AND sha256 = ?',
+                                     (database, sha256))
+
+    def watermark(self, database: str) -> Optional[Tuple[int, float]]:
+        """Get the watermark of database
+
+        Returns
+        -------
+        Optional[Tuple[int, float]]
+            the highest molecule_id looked at by the previous runs, and the time of the
+            last full sweep; None if the database was never scanned
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT molecule_id, full_sweep_at FROM watermarks WHERE database = ?', (database, )).fetchone()
+        return tuple(row) if row else None
+
+    def save_watermark(self, database: str, molecule_id: int, full_sweep: bool) -> None:
+        """Remember that the molecules of database up to molecule_id were looked at
+
+        Parameters
+        ----------
+        database : str
+            the name of the database
+        molecule_id : int
+            the highest molecule_id looked at
+        full_sweep : bool
+            True if all the molecules were looked at, not only the ones after the previous watermark
+        """
+        now = time.time()
+        previous = self.watermark(database)
+        full_sweep_at = now if full_sweep or previous is None else previous[1]
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO watermarks (database, molecule_id, scanned_at, full_sweep_at) VALUES (?, ?, ?, ?)',
+                (database, molecule_id, now, full_sweep_at))
+
+    def record_validators(self, cas_nr: str, sds_source: str, full_url: str, etag: Optional[str] = None,
+                          last_modified: Optional[str] = None, content_length: Optional[int] = None) -> None:
+        """Remember the url and the validators of the SDS file of cas_nr, just downloaded or checked
+
+        Parameters
+        ----------
+        cas_nr : str
+            the CAS number
+        sds_source : str
+            the name of the SDS source
+        full_url : str
+            the url the SDS file was downloaded from
+        etag, last_modified, content_length : optional
+            the ETag, Last-Modified and Content-Length headers of the SDS file, None if not sent
+        """
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO sds_validators'
+                ' (cas_nr, sds_source, full_url, etag, last_modified, content_length, checked_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (cas_nr, sds_source, full_url, etag, last_modified, content_length, time.time()))
+
+    def validators(self, cas_nr: str) -> Optional[Tuple[str, str, Optional[str], Optional[str], Optional[int]]]:
+        """Get the SDS source, url, ETag, Last-Modified and Content-Length recorded for cas_nr, None if none"""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT sds_source, full_url, etag, last_modified, content_length FROM sds_validators WHERE cas_nr = ?',
+                (cas_nr, )).fetchone()
+        return tuple(row) if row else None
+
+    def stale_validators(self, max_age: float, limit: int) -> List[str]:
+        """Get the CAS numbers whose SDS was last downloaded or checked more than max_age seconds ago,
+        the oldest first, at most limit of them"""
+        with self._lock:
+            return [cas_nr for (cas_nr, ) in self._connection.execute(
+                'SELECT cas_nr FROM sds_validators WHERE checked_at <= ? ORDER BY checked_at LIMIT ?',
+                (time.time() - max_age, limit))]
+
+    def mark_checked(self, cas_nr: str) -> None:
+        """Remember that the SDS of cas_nr was checked and did not change"""
+        with self._lock:
+            self._connection.execute('UPDATE sds_validators SET checked_at = ? WHERE cas_nr = ?', (time.time(), cas_nr))
+
+    def record_search(self, cas_nr: str, supplier: str, hit: bool, seconds: float) -> None:
+        """Add a search to the statistics of supplier
+
+        Parameters
+        ----------
+        cas_nr : str
+            the CAS number searched
+        supplier : str
+            the name of the supplier, e.g. 'fisher'
+        hit : bool
+            True if the supplier gave the url of the SDS
+        seconds : float
+            the time taken by the search
+        """
+        with self._lock:
+            for prefix in ('', cas_prefix(cas_nr)):
+                stats = self._run_stats.setdefault((supplier, prefix), [0, 0, 0.0])
+                stats[0] += 1
+                stats[1] += hit
+                stats[2] += seconds
+
+    def supplier_stats(self, prefix: str = '') -> Dict[str, Tuple[float, float, float]]:
+        """Get the statistics of the suppliers, previous runs and this run together
+
+        Parameters
+        ----------
+        prefix : str, optional
+            the CAS prefix (see `cas_prefix()`), by default '' (all CAS numbers)
+
+        Returns
+        -------
+        Dict[str, Tuple[float, float, float]]
+            for each supplier searched: its number of searches, of hits, and its total search time
+        """
+        stats = {}
+        with self._lock:
+            for source in (self._saved_stats, self._run_stats):
+                for (supplier, stats_prefix), (searches, hits, seconds) in source.items():
+                    if stats_prefix == prefix:
+                        total = stats.get(supplier, (0, 0, 0.0))
+                        stats[supplier] = (total[0] + searches, total[1] + hits, total[2] + seconds)
+        return stats
+
+    def save_stats(self) -> None:
+        """Add the statistics of this run to the ones saved, keeping at most
+        `stats_window` searches for each supplier"""
+        with self._lock:
+            for key, run in self._run_stats.items():
+                stats = [saved + new for saved, new in zip(self._saved_stats.get(key, [0, 0, 0.0]), run)]
+                if stats[0] > stats_window:
+                    stats = [value * stats_window / stats[0] for value in stats]
+                self._saved_stats[key] = stats
+            self._run_stats = {}
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO supplier_stats (supplier, cas_prefix, searches, hits, seconds) VALUES (?, ?, ?, ?, ?)',
+                [(supplier, prefix, *stats) for (supplier, prefix), stats in self._saved_stats.items()])
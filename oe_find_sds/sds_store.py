@@ -0,0 +1,107 @@
+"""
+Content-addressed store of the downloaded SDS files
+
+Many CAS numbers share the same SDS file, e.g. the salts and hydrates of a
+substance or the generic sheets of a supplier. Each SDS file is stored once
+in the download folder, named by its SHA-256 hash:
+
+    <download folder>/sha256/ab/ab12...ef.pdf
+
+and '<cas_nr>.pdf' is a hardlink to it, so the rest of the program (and the
+`LOAD_FILE()` of the database server) still finds the SDS of a CAS number
+by its name. The disk usage grows with the number of different SDS files,
+not with the number of CAS numbers.
+"""
+
+
+import hashlib
+import mmap
+import os
+import tempfile
+from pathlib import Path
+from typing import Tuple, Union
+
+
+# Name of the folder of the stored files, created in the download folder
+store_folder_name = 'sha256'
+# Size of the reads when a file cannot be mapped in memory
+chunk_size = 1024 * 1024
+
+
+def file_sha256(path: Union[str, Path]) -> str:
+    """Get the SHA-256 hash of a file, read through mmap (or in chunks)
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile() as f:
+    ...     file_sha256(f.name)
+    'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                sha256.update(mapped)
+        except (ValueError, OSError):
+            # Empty files and some file systems cannot be mapped
+            f.seek(0)
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def file_digest(path: Union[str, Path]) -> Tuple[str, int]:
+    """Get the SHA-256 hash and the size of a file"""
+    return file_sha256(path), os.path.getsize(path)
+
+
+def stored_path(folder: Union[str, Path], sha256: str) -> Path:
+    """Get the path of the stored file with this hash, in the store of folder"""
+    return Path(folder) / store_folder_name / sha256[:2] / f'{sha256}.pdf'
+
+
+def store_file(sds_file: Union[str, Path]) -> str:
+    """Move sds_file into the store of its folder, and replace it with a hardlink to the stored file
+
+    If a file with the same content is already stored, sds_file becomes a
+    hardlink to it and its own copy is dropped. Where hardlinks are not
+    supported, sds_file is left as it is.
+
+    Parameters
+    ----------
+    sds_file : Union[str, Path]
+        the SDS file of a CAS number, e.g. '<download folder>/64-19-7.pdf'
+
+    Returns
+    -------
+    str
+        the SHA-256 hash of the file
+    """
+    sds_file = Path(sds_file)
+    sha256 = file_sha256(sds_file)
+    stored_file = stored_path(sds_file.parent, sha256)
+    try:
+        if stored_file.exists() and os.path.samefile(str(stored_file), str(sds_file)):
+            return sha256
+        stored_file.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(str(sds_file), str(stored_file))
+            return sha256
+        except FileExistsError:
+            pass
+        # The same content is already stored: link to it through a temporary
+        # name, so sds_file is never missing
+        fd, temp_file = tempfile.mkstemp(dir=str(sds_file.parent), prefix=f'.{sds_file.name}.', suffix='.link')
+        os.close(fd)
+        os.remove(temp_file)
+        try:
+            os.link(str(stored_file), temp_file)
+            os.replace(temp_file, str(sds_file))
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    except OSError:
+        # e.g. a file system without hardlinks: the file is kept, without deduplication
+        pass
+    return sha256
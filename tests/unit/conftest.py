@@ -0,0 +1,41 @@
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    '''Request handler that does not log every request'''
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def serve():
+    '''Start local HTTP servers with the given handler class, return their base url
+
+    The shared HTTP sessions and rate limiters are reset afterwards.
+    '''
+    from oe_find_sds import rate_limit
+    from oe_find_sds.http_sessions import close_sessions
+
+    servers = []
+
+    def start(handler_class):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f'http://127.0.0.1:{server.server_address[1]}'
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    close_sessions()
+    rate_limit.reset_limiters()
@@ -0,0 +1,39 @@
+import sys, os
+sys.path.append(os.path.realpath('oe_find_sds'))
+sys.path.append(os.path.realpath('benchmarks'))
+
+import pytest
+from oe_find_sds import find_sds, http_sessions
+from run_pipeline import make_cas_list, percentile, run_benchmark
+
+
+@pytest.mark.parametrize("race, upload_mode", [(False, 'server'), (True, 'client')])
+def test_run_benchmark(race, upload_mode):
+    '''Run the whole pipeline offline, against the stand-in suppliers and database'''
+    report = run_benchmark(cas_count=30, concurrency=10, batch_size=7, latency=0, jitter=0,
+                           pdf_size=1024, race=race, upload_mode=upload_mode)
+    results = report['results']
+    assert results['updated'] == results['stored'] > 0
+    assert results['updated'] + results['missing'] == 30
+    assert results['latency_p50'] <= results['latency_p99']
+    assert results['requests']['www.chemblink.com'] >= 30
+    # The program state is restored afterwards
+    assert http_sessions.host_overrides == {}
+    assert find_sds.search_cache is None
+
+
+def test_make_cas_list():
+    cas_list = make_cas_list(3, start=6419)
+    assert cas_list == ['64-19-7', '64-20-0', '64-21-1']
+
+
+@pytest.mark.parametrize(
+    "values, fraction, expect", [
+        ([], 0.5, 0),
+        ([3, 1, 2], 0.5, 2),
+        (list(range(1, 101)), 0.99, 99),
+        (list(range(1, 101)), 1, 100),
+    ]
+)
+def test_percentile(values, fraction, expect):
+    assert percentile(values, fraction) == expect
@@ -0,0 +1,142 @@
+import sys, os
+sys.path.append(os.path.realpath('oe_find_sds'))
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from oe_find_sds.chemicalsafety import ChemicalSafetyResolver
+from oe_find_sds.find_sds import extract_download_url_from_chemicalsafety
+
+
+def row(msds_id, cas_nr, pdf_file=None):
+    '''Row of a retriever.php answer, with the PDF file column if given'''
+    return [msds_id, 'name', 'manufacturer', cas_nr] + ([''] * 6 + [pdf_file + ','] if pdf_file else [])
+
+
+class FakeRetriever:
+    '''Answer the retriever.php forms from the rows given for each CAS number'''
+    def __init__(self, search_rows, pdf_files, delay=0.0):
+        self.search_rows = search_rows
+        self.pdf_files = pdf_files
+        self.delay = delay
+        self.forms = []
+        self._lock = threading.Lock()
+
+    def post(self, url, headers, data, timeout):
+        form = json.loads(data)
+        with self._lock:
+            self.forms.append((form['action'], form['p1'] if form['action'] != 'search' else form['p3']))
+        time.sleep(self.delay)
+        if form['action'] == 'search':
+            answer = {'rows': self.search_rows.get(form['p3'].split('|')[1], [])}
+        elif form['action'] == 'msdsdetail':
+            cas_nr, pdf_file = self.pdf_files[form['p1']]
+            answer = {'rows': [row(form['p1'], cas_nr, pdf_file)]}
+        else:
+            answer = {'url': f'https://sds.chemicalsafety.com/getpdf.ashx?param1={form["p1"]}'}
+        return FakeResponse(answer)
+
+
+class FakeResponse:
+    status_code = 200
+    history = []
+
+    def __init__(self, answer):
+        self.answer = answer
+
+    def json(self):
+        return self.answer
+
+
+def test_resolve():
+    retriever = FakeRetriever({'64-19-7': [row('m1', '64-19-7'), row('m2', '67-56-1')]},
+                              {'m1': ('64-19-7', 'fdp.1_1'), 'm2': ('67-56-1', 'fdp.1_1')})
+    resolver = ChemicalSafetyResolver()
+    assert resolver.resolve('64-19-7', retriever.post) == 'https://sds.chemicalsafety.com/getpdf.ashx?param1=fdp.1_1'
+    # 67-56-1 was in the answer of the search of 64-19-7, and has the same PDF file
+    assert resolver.resolve('67-56-1', retriever.post) == 'https://sds.chemicalsafety.com/getpdf.ashx?param1=fdp.1_1'
+    assert retriever.forms == [('search', 'MSCHEM.CAS|64-19-7'), ('msdsdetail', 'm1'), ('getpdfurl', 'fdp.1_1'),
+                               ('msdsdetail', 'm2')]
+    # Not found, and not searched again
+    assert resolver.resolve('7647-14-5', retriever.post) is None
+    assert resolver.resolve('7647-14-5', retriever.post) is None
+    assert resolver.requests == {'search': 2, 'msdsdetail': 2, 'getpdfurl': 1}
+
+
+def test_pdf_file_taken_from_the_detail():
+    '''Test the PDF file of a search row is not used, the detail of every CAS number is asked'''
+    retriever = FakeRetriever({'64-19-7': [row('m1', '64-19-7', 'fdp.9_9')]}, {'m1': ('64-19-7', 'fdp.1_1')})
+    assert ChemicalSafetyResolver().resolve('64-19-7', retriever.post).endswith('fdp.1_1')
+    assert [action for action, p1 in retriever.forms] == ['search', 'msdsdetail', 'getpdfurl']
+
+
+def test_msds_id_of_other_search_not_confirmed():
+    '''Test a CAS number is searched if the msds id seen in the search of another CAS number is not confirmed'''
+    retriever = FakeRetriever({'64-19-7': [row('m1', '64-19-7'), row('m2', '67-56-1'), row('m4', '1310-73-2')],
+                               '67-56-1': [row('m3', '67-56-1')]},
+                              {'m1': ('64-19-7', 'fdp.1_1'), 'm2': ('7647-14-5', 'fdp.2_2'),
+                               'm3': ('67-56-1', 'fdp.3_3'), 'm4': ('7440-23-5', 'fdp.4_4')})
+    resolver = ChemicalSafetyResolver()
+    assert resolver.resolve('64-19-7', retriever.post).endswith('fdp.1_1')
+    # The detail of m2 is not about 67-56-1, its own search gives m3
+    assert resolver.resolve('67-56-1', retriever.post).endswith('fdp.3_3')
+    assert retriever.forms[3:] == [('msdsdetail', 'm2'), ('search', 'MSCHEM.CAS|67-56-1'), ('msdsdetail', 'm3'),
+                                   ('getpdfurl', 'fdp.3_3')]
+    # Not found by its own search either
+    assert resolver.resolve('1310-73-2', retriever.post) is None
+    assert retriever.forms[7:] == [('msdsdetail', 'm4'), ('search', 'MSCHEM.CAS|1310-73-2')]
+    assert resolver.resolve('1310-73-2', retriever.post) is None
+    assert len(retriever.forms) == 9
+
+
+def test_answers_expire_and_forget(monkeypatch):
+    '''Test a CAS number not found is searched again once the answers expired, or once forgotten'''
+    retriever = FakeRetriever({'64-19-7': [row('m1', '64-19-7')]}, {'m1': ('64-19-7', 'fdp.1_1')})
+    resolver = ChemicalSafetyResolver()
+    assert resolver.resolve('7647-14-5', retriever.post) is None
+    assert resolver.resolve('64-19-7', retriever.post)
+    assert resolver.resolve('7647-14-5', retriever.post) is None
+    assert resolver.requests == {'search': 2, 'msdsdetail': 1, 'getpdfurl': 1}
+
+    resolver.forget('64-19-7')
+    assert resolver.resolve('64-19-7', retriever.post)
+    assert resolver.requests == {'search': 3, 'msdsdetail': 2, 'getpdfurl': 2}
+
+    monkeypatch.setattr('oe_find_sds.chemicalsafety.answer_ttl', -1)
+    assert resolver.resolve('7647-14-5', retriever.post) is None
+    assert resolver.requests['search'] == 4
+    assert resolver.searched == {'7647-14-5'} and resolver.msds_ids == {}
+
+
+def test_resolve_checks_the_detail():
+    retriever = FakeRetriever({'64-19-7': [row('m1', '64-19-7')]}, {'m1': ('67-56-1', 'fdp.1_1')})
+    assert ChemicalSafetyResolver().resolve('64-19-7', retriever.post) is None
+
+
+def test_pdf_url_expires(monkeypatch):
+    retriever = FakeRetriever({}, {})
+    resolver = ChemicalSafetyResolver()
+    resolver.pdf_url('fdp.1_1', retriever.post)
+    resolver.pdf_url('fdp.1_1', retriever.post)
+    monkeypatch.setattr('oe_find_sds.chemicalsafety.url_ttl', -1)
+    resolver.pdf_url('fdp.1_1', retriever.post)
+    assert retriever.forms == [('getpdfurl', 'fdp.1_1')] * 2
+
+
+def test_concurrent_lookups_are_sent_once():
+    retriever = FakeRetriever({'64-19-7': [row('m1', '64-19-7')]}, {'m1': ('64-19-7', 'fdp.1_1')}, delay=0.05)
+    resolver = ChemicalSafetyResolver()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        urls = list(executor.map(lambda cas_nr: resolver.resolve(cas_nr, retriever.post), ['64-19-7'] * 8))
+    assert len(set(urls)) == 1 and urls[0]
+    assert retriever.forms == [('search', 'MSCHEM.CAS|64-19-7'), ('msdsdetail', 'm1'), ('getpdfurl', 'fdp.1_1')]
+
+
+def test_extract_url_from_chemicalsafety(monkeypatch):
+    retriever = FakeRetriever({'64-19-7': [row('m1', '64-19-7')]}, {'m1': ('64-19-7', 'fdp.1_1')})
+    monkeypatch.setattr('oe_find_sds.find_sds.chemicalsafety_resolver', ChemicalSafetyResolver())
+    monkeypatch.setattr('oe_find_sds.find_sds.http_post', retriever.post)
+    assert extract_download_url_from_chemicalsafety('64-19-7') == \
+        ('ChemicalSafety', 'https://sds.chemicalsafety.com/getpdf.ashx?param1=fdp.1_1')
@@ -0,0 +1,118 @@
+import sys, os
+sys.path.append(os.path.realpath('oe_find_sds'))
+
+import signal
+import threading
+import time
+
+import pytest
+from oe_find_sds import find_sds
+from oe_find_sds.find_sds import _poll_database, _until_stopped, parse_args, read_settings, run_daemon
+from oe_find_sds.rate_limit import RateLimit
+
+
+def test_settings(tmpdir, monkeypatch):
+    '''Test the command line options take precedence over the environment, and the environment over the config file'''
+    config_file = os.path.join(str(tmpdir), 'oe_find_sds.ini')
+    with open(config_file, 'w') as f:
+        f.write('[oe_find_sds]\n'
+                'database = group_a\n'
+                'password = secret\n'
+                'download-path = /var/sds\n'
+                'batch_size = 20\n'
+                'race = true\n'
+                'incremental = false\n'
+                'rate_limit = fisher=2/4 default=5\n')
+    monkeypatch.setenv('OE_FIND_SDS_BATCH_SIZE', '50')
+    monkeypatch.setenv('OE_FIND_SDS_CONFIG', config_file)
+    assert read_settings(config_file)['batch_size'] == '50'
+
+    args = parse_args(['--batch-size', '80', '--daemon'])
+    assert (args.database, args.password, args.download_path) == ('group_a', 'secret', '/var/sds')
+    assert args.batch_size == 80
+    assert args.race and not args.incremental and args.daemon
+    assert args.rate_limit == [('fisher', RateLimit(2, 2, 4)), ('default', RateLimit(5, 5, 20))]
+
+
+@pytest.mark.parametrize("setting", ['OE_FIND_SDS_NO_SUCH_OPTION', 'OE_FIND_SDS_BATCH_SIZE'])
+def test_bad_settings(monkeypatch, setting):
+    monkeypatch.setenv(setting, 'many')
+    with pytest.raises(SystemExit):
+        parse_args([])
+
+
+def test_until_stopped():
+    stop = threading.Event()
+    cas_list = _until_stopped(iter(['64-19-7', '67-56-1']), stop)
+    assert next(cas_list) == '64-19-7'
+    stop.set()
+    assert list(cas_list) == []
+
+
+def test_run_daemon(tmpdir, monkeypatch):
+    '''Test the daemon polls again after an error, and stops cleanly on SIGTERM'''
+    polls = []
+    connections = []
+
+    class Connection:
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    def connect_database(database, password):
+        connections.append(Connection())
+        return connections[-1]
+
+    def poll_database(mariadb_connection, scan_connection, database, stop):
+        polls.append(database)
+        if len(polls) == 2:
+            raise RuntimeError('connection lost')
+        if len(polls) == 3:
+            os.kill(os.getpid(), signal.SIGTERM)
+        return 2
+
+    monkeypatch.setattr('oe_find_sds.find_sds.download_path', str(tmpdir))
+    monkeypatch.setattr('oe_find_sds.find_sds.poll_interval', 0.01)
+    monkeypatch.setattr('oe_find_sds.find_sds.incremental', False)
+    monkeypatch.setattr('oe_find_sds.find_sds.connect_database', connect_database)
+    monkeypatch.setattr('oe_find_sds.find_sds.warm_up_sessions', lambda urls: None)
+    monkeypatch.setattr('oe_find_sds.find_sds._poll_database', poll_database)
+    handler = signal.getsignal(signal.SIGTERM)
+
+    assert run_daemon('group_a', 'secret') == 4
+    assert polls == ['group_a'] * 3
+    # Connected again after the error
+    assert len(connections) == 4 and all(connection.closed for connection in connections)
+    assert signal.getsignal(signal.SIGTERM) == handler
+    assert find_sds.search_cache is None and not find_sds.daemon_mode
+
+
+def test_poll_stops_with_downloads_in_flight(monkeypatch):
+    '''Test a stop during a poll only lets the CAS numbers in flight finish, and uploads them'''
+    stop = threading.Event()
+    started = []
+    uploaded = []
+    cas_list = [f'{n}-00-0' for n in range(500)]
+
+    def iter_missing_cas(scan_connection, database):
+        yield from cas_list
+
+    def download_sds(cas_nr):
+        started.append(cas_nr)
+        if len(started) == 5:
+            stop.set()
+        time.sleep(0.05)
+        return cas_nr, True, 'Fisher'
+
+    monkeypatch.setattr('oe_find_sds.find_sds.iter_missing_cas', iter_missing_cas)
+    monkeypatch.setattr('oe_find_sds.find_sds.download_sds', download_sds)
+    monkeypatch.setattr('oe_find_sds.find_sds.update_sql_sds_batch',
+                        lambda connection, results, batch_size: uploaded.extend(results) or len(results))
+    monkeypatch.setattr('oe_find_sds.find_sds.concurrency', 10)
+    monkeypatch.setattr('oe_find_sds.find_sds.status_interval', 0)
+    monkeypatch.setattr('oe_find_sds.find_sds.save_watermarks', lambda: pytest.fail('watermarks saved'))
+
+    assert _poll_database(None, None, 'group_a', stop) == 10
+    assert started == cas_list[:10]
+    assert sorted(cas_nr for cas_nr, found, source in uploaded) == sorted(started)
@@ -1,10 +1,13 @@
 import sys, os
 sys.path.append(os.path.realpath('oe_find_sds'))
 
-import re
+import time
+from pathlib import Path
+
 import pytest
-from unittest.mock import patch
-from oe_find_sds.find_sds import download_sds
+from conftest import QuietHandler
+from oe_find_sds.find_sds import download_sds, download_all_sds, fetch_sds, is_valid_pdf, resolve_sds_url, supplier_order
+from oe_find_sds.sds_store import store_folder_name
 
 
 def mock_raise_exception():
@@ -91,3 +94,183 @@ def test_download_sds_with_error(tmpdir, monkeypatch, cas_nr, expect):
 
     result = download_sds(cas_nr)
     assert result == expect
+
+
+@pytest.mark.parametrize(
+    "cas_list, max_concurrency", [
+        (['623-51-8', '28697-53-2', '1450-76-6'], 1),
+        (['623-51-8', '28697-53-2', '1450-76-6'], 100),
+        ([f'{i}-00-0' for i in range(250)], 50),
+        ([], 10),
+    ]
+)
+def test_download_all_sds(monkeypatch, cas_list, max_concurrency):
+    '''Test download_all_sds() keeps the (cas, downloaded, source) result contract'''
+    monkeypatch.setattr('oe_find_sds.find_sds.download_sds', lambda cas_nr: (cas_nr, True, 'Fisher'))
+
+    result = download_all_sds(cas_list, max_concurrency=max_concurrency)
+    assert result == [(cas_nr, True, 'Fisher') for cas_nr in cas_list]
+
+
+def test_download_all_sds_with_error(monkeypatch):
+    '''Test download_all_sds() when download_sds() raises'''
+    monkeypatch.setattr('oe_find_sds.find_sds.download_sds', mock_raise_exception)
+
+    result = download_all_sds(['00000-00-0'], max_concurrency=10)
+    assert result == [('00000-00-0', False, None)]
+
+
+def mock_extractor(result, delay=0.0):
+    '''Create a fake extractor answering `result` after `delay` seconds'''
+    def extractor(cas_nr):
+        time.sleep(delay)
+        return result
+    return extractor
+
+
+@pytest.mark.parametrize(
+    "race, answers, expect", [
+        (False, {'fluorochem': ('Fluorochem', 'url-fluorochem')}, ('Fluorochem', 'url-fluorochem')),
+        (True, {'fluorochem': ('Fluorochem', 'url-fluorochem')}, ('Fluorochem', 'url-fluorochem')),
+        (False, {'vwr': ('TCI America', 'url-vwr'), 'fisher': ('Fisher', 'url-fisher')}, ('TCI America', 'url-vwr')),
+        (True, {'vwr': ('TCI America', 'url-vwr'), 'fisher': ('Fisher', 'url-fisher')}, ('TCI America', 'url-vwr')),
+        (True, {}, None),
+    ]
+)
+def test_resolve_sds_url(monkeypatch, race, answers, expect):
+    '''Test resolve_sds_url() keeps the supplier priority order, with or without racing'''
+    monkeypatch.setattr('oe_find_sds.find_sds.race_suppliers', race)
+    for supplier in supplier_order:
+        # Higher priority suppliers answer last
+        delay = 0.05 * (len(supplier_order) - supplier_order.index(supplier))
+        monkeypatch.setattr(f'oe_find_sds.find_sds.extract_download_url_from_{supplier}',
+                            mock_extractor(answers.get(supplier), delay))
+
+    assert resolve_sds_url('623-51-8') == expect
+
+
+def test_resolve_sds_url_race_latency(monkeypatch):
+    '''Test racing costs about the slowest necessary supplier instead of the sum'''
+    monkeypatch.setattr('oe_find_sds.find_sds.race_suppliers', True)
+    for supplier in supplier_order:
+        monkeypatch.setattr(f'oe_find_sds.find_sds.extract_download_url_from_{supplier}', mock_extractor(None, 0.3))
+    monkeypatch.setattr('oe_find_sds.find_sds.extract_download_url_from_fluorochem',
+                        mock_extractor(('Fluorochem', 'url-fluorochem'), 0.3))
+
+    start = time.monotonic()
+    assert resolve_sds_url('28697-53-2') == ('Fluorochem', 'url-fluorochem')
+    assert time.monotonic() - start < 0.3 * len(supplier_order) / 2
+
+
+def test_resolve_sds_url_race_with_error(monkeypatch):
+    '''Test a failing supplier does not hide the answer of a lower priority supplier when racing'''
+    monkeypatch.setattr('oe_find_sds.find_sds.race_suppliers', True)
+    for supplier in supplier_order:
+        monkeypatch.setattr(f'oe_find_sds.find_sds.extract_download_url_from_{supplier}', mock_extractor(None))
+    monkeypatch.setattr('oe_find_sds.find_sds.extract_download_url_from_chemblink', mock_raise_exception)
+    monkeypatch.setattr('oe_find_sds.find_sds.extract_download_url_from_tci', mock_extractor(('TCI', 'url-tci')))
+
+    assert resolve_sds_url('950194-37-3') == ('TCI', 'url-tci')
+
+
+PDF_FILE = b'%PDF-1.4\n' + b'0' * 100000 + b'\n%%EOF\n'
+
+
+class SdsHandler(QuietHandler):
+    '''Serve PDF files, HTML error pages with status 200 and a redirect'''
+    pages = {
+        '/sds.pdf': ('application/pdf', PDF_FILE),
+        '/octet-stream': ('application/octet-stream', PDF_FILE),
+        '/error.html': ('text/html', b'<html>Error</html>'),
+        '/not-pdf': ('application/octet-stream', b'<html>Error</html>' * 1000),
+        '/pdf-as-html': ('text/html', PDF_FILE),
+        '/no-eof.pdf': ('application/pdf', PDF_FILE[:-7]),
+        '/trailing-bytes.pdf': ('application/pdf', PDF_FILE + b'0' * 4096),
+    }
+
+    def do_GET(self):
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/sds.pdf')
+            self.end_headers()
+            return
+        content_type, body = self.pages[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.mark.parametrize(
+    "path, max_sds_size, expect", [
+        ('/sds.pdf', 10 ** 6, True),
+        ('/octet-stream', 10 ** 6, True),
+        ('/error.html', 10 ** 6, False),
+        ('/not-pdf', 10 ** 6, False),
+        ('/pdf-as-html', 10 ** 6, False),
+        # Not downloaded again on every run by download_sds()
+        ('/no-eof.pdf', 10 ** 6, False),
+        ('/trailing-bytes.pdf', 10 ** 6, False),
+        ('/redirect', 10 ** 6, False),
+        ('/sds.pdf', 1000, False),
+    ]
+)
+def test_fetch_sds(tmpdir, monkeypatch, serve, path, max_sds_size, expect):
+    '''Test fetch_sds() only saves complete PDF files, without redirect'''
+    monkeypatch.setattr('oe_find_sds.find_sds.max_sds_size', max_sds_size)
+    download_file = Path(tmpdir) / '623-51-8.pdf'
+    assert fetch_sds(serve(SdsHandler) + path, download_file) == expect
+    assert download_file.exists() == expect
+    if expect:
+        assert download_file.read_bytes() == PDF_FILE
+    # No temporary file is left behind, the SDS file is linked into the store
+    assert sorted(os.listdir(tmpdir)) == (['623-51-8.pdf', store_folder_name] if expect else [])
+
+
+def test_fetch_sds_interrupted(tmpdir, monkeypatch):
+    '''Test an interrupted download leaves neither a truncated SDS nor a temporary file'''
+    class InterruptedResponse:
+        status_code = 200
+        history = []
+        headers = {'Content-Type': 'application/pdf'}
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def iter_content(self, chunk_size):
+            yield PDF_FILE[:chunk_size]
+            raise ConnectionError()
+
+    monkeypatch.setattr('oe_find_sds.find_sds.http_get', lambda *args, **kwargs: InterruptedResponse())
+    with pytest.raises(ConnectionError):
+        fetch_sds('url', Path(tmpdir) / '623-51-8.pdf')
+    assert os.listdir(tmpdir) == []
+
+
+@pytest.mark.parametrize(
+    "content, expect", [
+        (PDF_FILE, True),
+        (PDF_FILE[:5000], False),
+        (b'<html>Error</html>', False),
+        (b'', False),
+    ]
+)
+def test_is_valid_pdf(tmpdir, content, expect):
+    sds_file = Path(tmpdir) / '623-51-8.pdf'
+    sds_file.write_bytes(content)
+    assert is_valid_pdf(sds_file) == expect
+
+
+def test_download_sds_with_truncated_file(tmpdir, monkeypatch):
+    '''Test download_sds() downloads again a truncated file left by an interrupted run'''
+    monkeypatch.setattr('oe_find_sds.find_sds.download_path', tmpdir)
+    monkeypatch.setattr('oe_find_sds.find_sds.resolve_sds_url',
+                        lambda cas_nr, **kwargs: ('Fisher', 'url-fisher'))
+    monkeypatch.setattr('oe_find_sds.find_sds.fetch_sds', lambda full_url, download_file, validators=None: True)
+    (Path(tmpdir) / '623-51-8.pdf').write_bytes(PDF_FILE[:5000])
+
+    assert download_sds('623-51-8') == ('623-51-8', True, 'Fisher')
@@ -52,7 +52,7 @@ def test_extract_url_from_fisher(cas_nr, expect):
     ]
 )
 def test_extract_url_from_fisher_with_exception(monkeypatch, cas_nr, expect):
-    monkeypatch.setattr('oe_find_sds.find_sds.requests.get', mock_raise_exception)
+    monkeypatch.setattr('oe_find_sds.find_sds.http_get', mock_raise_exception)
     result = extract_download_url_from_fisher(cas_nr)
     assert result == expect
 
@@ -95,7 +95,7 @@ def test_extract_url_from_chemicalsafety(cas_nr, expect):
     ]
 )
 def test_extract_url_from_chemicalsafety_with_exception(monkeypatch, cas_nr, expect):
-    monkeypatch.setattr('oe_find_sds.find_sds.requests.post', mock_raise_exception)
+    monkeypatch.setattr('oe_find_sds.find_sds.http_post', mock_raise_exception)
     result = extract_download_url_from_chemicalsafety(cas_nr)
     assert result == expect
 
@@ -135,7 +135,7 @@ def test_extract_url_from_fluorochem(cas_nr, expect):
     ]
 )
 def test_extract_url_from_fluorochem_with_exception(monkeypatch, cas_nr, expect):
-    monkeypatch.setattr('oe_find_sds.find_sds.requests.post', mock_raise_exception)
+    monkeypatch.setattr('oe_find_sds.find_sds.http_post', mock_raise_exception)
     result = extract_download_url_from_fluorochem(cas_nr)
     assert result == expect
 
@@ -180,7 +180,7 @@ def test_extract_url_from_chemblink(cas_nr, expect):
     ]
 )
 def test_extract_url_from_chemblink_with_exception(monkeypatch, cas_nr, expect):
-    monkeypatch.setattr('oe_find_sds.find_sds.requests.get', mock_raise_exception)
+    monkeypatch.setattr('oe_find_sds.find_sds.http_get', mock_raise_exception)
     result = extract_download_url_from_chemblink(cas_nr)
     assert result == expect
 
@@ -236,7 +236,7 @@ def test_extract_url_from_vwr(cas_nr, expect):
     ]
 )
 def test_extract_url_from_vwr_with_exception(monkeypatch, cas_nr, expect):
-    monkeypatch.setattr('oe_find_sds.find_sds.requests.Session', mock_raise_exception)
+    monkeypatch.setattr('oe_find_sds.find_sds.http_get', mock_raise_exception)
     result = extract_download_url_from_vwr(cas_nr)
     assert result == expect
 
@@ -302,6 +302,6 @@ def test_extract_url_from_tci(cas_nr, expect):
     ]
 )
 def test_extract_url_from_tci_with_exception(monkeypatch, cas_nr, expect):
-    monkeypatch.setattr('oe_find_sds.find_sds.requests.Session', mock_raise_exception)
+    monkeypatch.setattr('oe_find_sds.find_sds.http_get', mock_raise_exception)
     result = extract_download_url_from_tci(cas_nr)
     assert result == expect
@@ -0,0 +1,118 @@
+import sys, os
+sys.path.append(os.path.realpath('oe_find_sds'))
+
+import importlib.util
+
+import pytest
+from oe_find_sds.find_sds import extract_download_url_from_chemblink, \
+                                    extract_download_url_from_fisher, \
+                                    extract_download_url_from_fluorochem, \
+                                    extract_download_url_from_tci, \
+                                    extract_download_url_from_vwr
+from oe_find_sds.html_parsing import PageFilter, has_class, make_soup
+
+
+backends = [
+    'html.parser',
+    pytest.param('lxml', marks=pytest.mark.skipif(importlib.util.find_spec('lxml') is None,
+                                                   reason='lxml is not installed')),
+]
+
+
+# Small copies of the supplier pages, with the elements the extractors read
+# in the middle of elements they do not read
+NAVIGATION = '<div class="header"><ul><li><a href="/">Home</a></li><li><a href="/cart">Cart</a></li></ul></div>'
+
+VWR_PAGE = f'''<html><head><title>MSDS</title></head><body>{NAVIGATION}
+<div class="search-header clearfix"><span class="pull-left">2 results were found for 885051-07-0</span></div>
+<table><tr><td data-title="Name">Product</td><td data-title="Manufacturer"> TCI America </td>
+<td data-title="SDS"><a href="https://us.vwr.com/assetsvc/asset/en_US/id/18065210/contents">SDS</a></td></tr>
+<tr><td data-title="Name">Other</td><td data-title="Manufacturer">Other</td>
+<td data-title="SDS"><a href="https://us.vwr.com/other">SDS</a></td></tr></table></body></html>'''
+
+FISHER_PAGE = f'''<html><body>{NAVIGATION}<div class="catalog_num"><ul>
+<li class="catlog_items"><a href="/store/msds?partNumber=AAA1432106">AAA1432106</a></li>
+<li class="catlog_items"><a href="/store/msds?partNumber=OTHER">OTHER</a></li></ul></div></body></html>'''
+
+FISHER_ERROR_PAGE = f'''<html><body>{NAVIGATION}
+<div class="errormessage search_results_error_message">Showing results for a similar search</div>
+<div class="catalog_num"><ul><li class="catlog_items"><a href="/store/msds?partNumber=OTHER">OTHER</a></li></ul></div>
+</body></html>'''
+
+CHEMBLINK_PAGE = f'''<html><body>{NAVIGATION}<table><tr><td>Acetic acid</td></tr>
+<tr><td><a href="/MSDS/MSDSFiles/64-19-7_Alfa-Aesar.pdf" class="blue" target="_blank">View / download</a></td></tr>
+<tr><td><a href="/MSDS/MSDSFiles/64-19-7_Matrix.pdf" class="blue" target="_blank">View / download</a></td></tr>
+</table></body></html>'''
+
+FLUOROCHEM_PAGE = '''<div class="results"><table><tr><td>F030371</td><td>D-Arabinose</td><td>28697-53-2</td>
+<td><a class="textLink prodDetailLink" prodcode="F030371" href="#">Details</a></td></tr></table></div>'''
+
+TCI_PAGE = f'''<html><head><script>var ACC = {{config: {{}}}};
+ACC.config.encodedContextPath = '\\/US\\/en';</script></head><body>{NAVIGATION}
+<form><input type="hidden" name="CSRFToken" value="token-123"></form>
+<div id="contentSearchFacet"><span class="facet__text"><a href="#">Products</a>
+<span class="facet__value__count">(1)</span></span></div>
+<div class="prductlist" data-casno="885051-07-0" data-id="B3296"><span>B3296</span></div>
+</body></html>'''
+
+
+class FakeResponse:
+    def __init__(self, text='', headers=None):
+        self.status_code = 200
+        self.history = []
+        self.text = text
+        self.headers = headers or {}
+        self.cookies = {}
+
+
+@pytest.fixture(params=backends)
+def backend(request, monkeypatch):
+    monkeypatch.setattr('oe_find_sds.html_parsing.parser_backend', request.param)
+    return request.param
+
+
+@pytest.mark.parametrize("partial_parsing", [True, False])
+@pytest.mark.parametrize(
+    "extractor, page, cas_nr, expect", [
+        (extract_download_url_from_vwr, VWR_PAGE, '885051-07-0',
+         ('TCI America', 'https://us.vwr.com/assetsvc/asset/en_US/id/18065210/contents')),
+        (extract_download_url_from_fisher, FISHER_PAGE, '623-51-8',
+         ('Fisher', 'https://www.fishersci.com/store/msds?partNumber=AAA1432106')),
+        (extract_download_url_from_fisher, FISHER_ERROR_PAGE, '623-51-8', None),
+        (extract_download_url_from_chemblink, CHEMBLINK_PAGE, '64-19-7',
+         ('Alfa-Aesar', 'https://www.chemblink.com/MSDS/MSDSFiles/64-19-7_Alfa-Aesar.pdf')),
+        (extract_download_url_from_fluorochem, FLUOROCHEM_PAGE, '28697-53-2',
+         ('Fluorochem', 'https://www.cheminfo.org/webservices/msds?brand=fluorochem&catalog=F030371&embed=true')),
+        (extract_download_url_from_tci, TCI_PAGE, '885051-07-0',
+         ('TCI', 'https://www.tcichemicals.com/US/en/sds/B3296_US_EN.pdf')),
+    ],
+    ids=['vwr', 'fisher', 'fisher-error', 'chemblink', 'fluorochem', 'tci']
+)
+def test_extractor_pages(monkeypatch, backend, partial_parsing, extractor, page, cas_nr, expect):
+    '''Test the extractors find the same url whatever the parser and the parts of the page built'''
+    monkeypatch.setattr('oe_find_sds.html_parsing.partial_parsing', partial_parsing)
+    monkeypatch.setattr('oe_find_sds.find_sds.http_get', lambda *args, **kwargs: FakeResponse(page))
+    sds_file_response = FakeResponse(headers={'content-disposition': 'attachment; filename=B3296_US_EN.pdf'})
+    monkeypatch.setattr('oe_find_sds.find_sds.http_post',
+                        lambda *args, **kwargs: FakeResponse(page) if 'fluorochem' in args[0] else sds_file_response)
+    assert extractor(cas_nr) == expect
+
+
+def test_make_soup_partial(backend):
+    page_filter = PageFilter(lambda name, attrs: name == 'li' and has_class(attrs, 'catlog_items'))
+    soup = make_soup(FISHER_PAGE, page_filter)
+    assert [a.text for a in soup.find_all('a')] == ['AAA1432106', 'OTHER']
+    assert soup.find(class_='catalog_num') is None
+    assert 'Cart' not in soup.get_text()
+
+
+@pytest.mark.parametrize(
+    "attrs, class_name, expect", [
+        ({'class': 'catlog_items first'}, 'catlog_items', True),
+        ({'class': ['catlog_items']}, 'catlog_items', True),
+        ({'class': 'catlog_items_2'}, 'catlog_items', False),
+        ({}, 'catlog_items', False),
+    ]
+)
+def test_has_class(attrs, class_name, expect):
+    assert has_class(attrs, class_name) == expect
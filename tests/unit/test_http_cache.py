@@ -0,0 +1,189 @@
+import sys, os
+sys.path.append(os.path.realpath('oe_find_sds'))
+
+import json
+
+import pytest
+import requests
+from conftest import QuietHandler
+from oe_find_sds import find_sds, http_sessions
+from oe_find_sds.http_cache import HttpCache, request_key
+from oe_find_sds.http_sessions import bypassing_cache, http_get, http_post
+
+
+class CountingHandler(QuietHandler):
+    '''Answer the path, query and body of each request with the number of requests received'''
+    requests = 0
+
+    def answer(self, body=b''):
+        CountingHandler.requests += 1
+        status = 404 if 'missing' in self.path else 200
+        content = json.dumps({'path': self.path, 'body': body.decode(), 'count': CountingHandler.requests}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Set-Cookie', 'JSESSIONID=abc; Path=/')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.answer()
+
+    def do_POST(self):
+        self.answer(self.rfile.read(int(self.headers['Content-Length'])))
+
+
+@pytest.fixture
+def cached_server(serve, tmpdir, monkeypatch):
+    CountingHandler.requests = 0
+    cache = HttpCache(os.path.join(str(tmpdir), 'http_cache.sqlite3'))
+    monkeypatch.setattr('oe_find_sds.http_sessions.response_cache', cache)
+    monkeypatch.setattr('oe_find_sds.http_cache.host_ttls', {'127.0.0.1': 60})
+    yield serve(CountingHandler)
+    cache.close()
+
+
+def test_cached_responses(cached_server):
+    '''Test the same request is answered from the cache, the other ones are sent'''
+    r1 = http_get(f'{cached_server}/search', params={'cas': '64-19-7'}, timeout=5)
+    r2 = http_get(f'{cached_server}/search?cas=64-19-7', timeout=5)
+    assert CountingHandler.requests == 1
+    assert r2.status_code == 200 and not r2.history
+    assert r2.json() == r1.json() == {'path': '/search?cas=64-19-7', 'body': '', 'count': 1}
+    assert r2.headers['Content-Type'] == 'application/json; charset=utf-8'
+    assert 'Set-Cookie' not in r2.headers and not r2.cookies
+
+    # Another body, another response
+    assert http_post(f'{cached_server}/retriever', data='{"p1": "a"}', timeout=5).json()['count'] == 2
+    assert http_post(f'{cached_server}/retriever', data='{"p1": "b"}', timeout=5).json()['count'] == 3
+    assert http_post(f'{cached_server}/retriever', data='{"p1": "a"}', timeout=5).json()['count'] == 2
+
+
+@pytest.mark.parametrize(
+    "path, kwargs", [
+        ('/missing', {}),
+        ('/sds.pdf', {'stream': True}),
+        ('/search', {'cookies': {'JSESSIONID': 'abc'}}),
+    ]
+)
+def test_not_cached(cached_server, path, kwargs):
+    for count in (1, 2):
+        with http_get(f'{cached_server}{path}', timeout=5, **kwargs) as r:
+            assert r.json()['count'] == count
+
+
+def test_uncached_host_and_bypass(cached_server, monkeypatch):
+    monkeypatch.setattr('oe_find_sds.http_cache.host_ttls', {})
+    http_get(f'{cached_server}/search', timeout=5)
+    monkeypatch.setattr('oe_find_sds.http_cache.host_ttls', {'127.0.0.1': 60})
+    monkeypatch.setattr('oe_find_sds.http_sessions.response_cache', None)
+    http_get(f'{cached_server}/search', timeout=5)
+    assert CountingHandler.requests == 2
+
+
+def test_bypassing_cache(cached_server):
+    '''Test the requests inside bypassing_cache() are sent again, their cached responses replaced or evicted'''
+    assert http_get(f'{cached_server}/search', timeout=5).json()['count'] == 1
+    with bypassing_cache():
+        assert http_get(f'{cached_server}/search', timeout=5).json()['count'] == 2
+    assert http_get(f'{cached_server}/search', timeout=5).json()['count'] == 2
+
+    key = request_key('GET', f'{cached_server}/missing')
+    http_sessions.response_cache.put(key, make_response(f'{cached_server}/missing', b'{}'), ttl=60)
+    with bypassing_cache():
+        assert http_get(f'{cached_server}/missing', timeout=5).status_code == 404
+    assert http_sessions.response_cache.get(key) is None
+
+
+class MovedSdsHandler(QuietHandler):
+    '''Search page giving the url of an SDS file, a dead url until the supplier `fixed` its page'''
+    fixed = False
+    requests = []
+
+    def do_GET(self):
+        MovedSdsHandler.requests.append(self.path.split('?')[0])
+        if self.path.startswith('/search'):
+            body = json.dumps({'url': '/sds.pdf' if self.fixed else '/dead.pdf'}).encode()
+            content_type = 'application/json'
+        elif self.path == '/sds.pdf':
+            body = b'%PDF-1.4 moved %%EOF'
+            content_type = 'application/pdf'
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_dead_url_searched_again(cached_server, serve, tmpdir, monkeypatch):
+    '''Test a url from a cached search that does not give the SDS is searched again without the cache'''
+    MovedSdsHandler.fixed = False
+    MovedSdsHandler.requests = []
+    server = serve(MovedSdsHandler)
+
+    def extract_download_url_from_fisher(cas_nr):
+        return 'Fisher', server + http_get(f'{server}/search', params={'cas': cas_nr}, timeout=5).json()['url']
+
+    monkeypatch.setattr('oe_find_sds.find_sds.extract_download_url_from_fisher', extract_download_url_from_fisher)
+    monkeypatch.setattr('oe_find_sds.find_sds.supplier_order', ['fisher'])
+    monkeypatch.setattr('oe_find_sds.find_sds.download_path', str(tmpdir))
+    monkeypatch.setattr('oe_find_sds.find_sds.deduplicate', False)
+
+    assert find_sds.download_sds('64-19-7') == ('64-19-7', False, None)
+    # Searched again once, the same dead url is not downloaded again
+    assert MovedSdsHandler.requests == ['/search', '/dead.pdf', '/search']
+
+    MovedSdsHandler.fixed = True
+    MovedSdsHandler.requests = []
+    assert find_sds.download_sds('64-19-7') == ('64-19-7', True, 'Fisher')
+    assert MovedSdsHandler.requests == ['/dead.pdf', '/search', '/sds.pdf']
+
+
+def make_response(url, body):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.encoding = 'utf-8'
+    response._content = body
+    return response
+
+
+def test_expiry_and_refresh(tmpdir):
+    cache = HttpCache(os.path.join(str(tmpdir), 'http_cache.sqlite3'))
+    cache.put('old', make_response('https://www.fishersci.com/old', b'old'), ttl=-1)
+    cache.put('new', make_response('https://www.fishersci.com/new', b'new'), ttl=60)
+    assert cache.get('old') is None
+    assert cache.get('new').text == 'new'
+    cache.close()
+
+    cache = HttpCache(os.path.join(str(tmpdir), 'http_cache.sqlite3'), refresh=True)
+    assert cache.get('new') is None
+    cache.put('new', make_response('https://www.fishersci.com/new', b'newer'), ttl=60)
+    cache.refresh = False
+    assert cache.get('new').text == 'newer'
+    cache.close()
+
+
+def test_lru_eviction(tmpdir, monkeypatch):
+    cache = HttpCache(os.path.join(str(tmpdir), 'http_cache.sqlite3'))
+    body = os.urandom(1000)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, make_response(f'https://us.vwr.com/{key}', body), ttl=60)
+    max_size = cache.size + 500
+    monkeypatch.setattr('oe_find_sds.http_cache.max_size', max_size)
+    # 'a' is used again, 'b' is now the least recently used
+    assert cache.get('a') is not None
+    cache.put('d', make_response('https://us.vwr.com/d', body), ttl=60)
+    assert [key for key in 'abcd' if cache.get(key) is not None] == ['a', 'c', 'd']
+    assert cache.size <= max_size
+    cache.close()
+
+
+def test_request_key():
+    assert request_key('POST', 'https://chemicalsafety.com/retriever.php', data='{"p1": "a"}') != \
+        request_key('POST', 'https://chemicalsafety.com/retriever.php', data='{"p1": "b"}')
+    assert request_key('GET', 'https://chemicalsafety.com/x') != request_key('POST', 'https://chemicalsafety.com/x')
@@ -0,0 +1,80 @@
+import sys, os
+sys.path.append(os.path.realpath('oe_find_sds'))
+
+import pytest
+from conftest import QuietHandler
+from oe_find_sds import http_sessions
+from oe_find_sds.http_sessions import close_sessions, get_session, http_get, warm_up_sessions
+from oe_find_sds.rate_limit import limiter_status
+
+
+class CookieHandler(QuietHandler):
+    '''Set a cookie on every response and echo back the cookie received'''
+    def do_GET(self):
+        body = (self.headers.get('Cookie') or '').encode()
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'JSESSIONID=abc; Path=/')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+
+@pytest.fixture
+def local_server(serve):
+    return serve(CookieHandler)
+
+
+@pytest.mark.parametrize(
+    "url1, url2, same", [
+        ('https://www.fishersci.com/us/en/catalog/search/sds', 'https://www.fishersci.com/store/msds', True),
+        ('https://www.tcichemicals.com/US/en/search/', ' https://www.tcichemicals.com/US/en/documentSearch/', True),
+        ('https://www.fishersci.com/us/en/catalog/search/sds', 'https://us.vwr.com/store/msds', False),
+        ('http://www.fluorochem.co.uk/Products/Search', 'https://www.fluorochem.co.uk/Products/Search', False),
+    ]
+)
+def test_get_session(url1, url2, same):
+    assert (get_session(url1) is get_session(url2)) == same
+    close_sessions()
+
+
+def test_get_session_pool_size(monkeypatch):
+    monkeypatch.setattr('oe_find_sds.http_sessions.pool_size', 7)
+    session = get_session('https://us.vwr.com/store/msds')
+    assert session.get_adapter('https://us.vwr.com/store/msds')._pool_maxsize == 7
+    close_sessions()
+
+
+def test_shared_session_keeps_no_cookie(local_server):
+    r1 = http_get(local_server, timeout=5)
+    assert r1.cookies.get('JSESSIONID') == 'abc'
+
+    # A second lookup must not receive the cookies of the first one
+    r2 = http_get(local_server, timeout=5)
+    assert r2.text == ''
+
+    # Cookies can still be sent explicitly
+    r3 = http_get(local_server, timeout=5, cookies=r1.cookies)
+    assert r3.text == 'JSESSIONID=abc'
+
+
+def test_warm_up_sessions(local_server):
+    assert warm_up_sessions([local_server, 'http://127.0.0.1:1'], connections=2, timeout=5) == 1
+    assert http_sessions._host_key(local_server) in http_sessions._sessions
+
+
+def test_close_sessions(local_server):
+    http_get(local_server, timeout=5)
+    close_sessions()
+    assert http_sessions._sessions == {}
+
+
+def test_host_overrides(monkeypatch, local_server):
+    '''Test the requests to an overridden host go to its stand-in server, within the limits of the host'''
+    monkeypatch.setattr('oe_find_sds.http_sessions.host_overrides', {'https://www.fishersci.com': local_server + '/fisher'})
+    response = http_get('https://www.fishersci.com/store/msds?partNumber=1', timeout=5)
+    assert response.status_code == 200
+    assert response.url == local_server + '/fisher/store/msds?partNumber=1'
+    assert http_sessions._host_key('https://www.fishersci.com') in http_sessions._sessions
+    assert 'www.fishersci.com' in limiter_status()
@@ -0,0 +1,88 @@
+import sys, os
+sys.path.append(os.path.realpath('oe_find_sds'))
+
+from pathlib import Path
+
+import pytest
+from oe_find_sds.find_sds import run_coordinator, run_worker
+from oe_find_sds.job_queue import JobQueue
+
+
+@pytest.fixture
+def queue(tmpdir):
+    queue = JobQueue.sqlite(Path(tmpdir) / 'jobs.sqlite')
+    yield queue
+    queue.close()
+
+
+def test_lease_and_complete(queue):
+    assert queue.enqueue(['64-19-7', '67-56-1', '7647-14-5']) == 3
+    # Queued again by a restarted coordinator
+    queue.enqueue(['64-19-7'])
+    token_a, leased_a = queue.lease('host-a:1', 2)
+    token_b, leased_b = queue.lease('host-b:1', 2)
+    assert sorted(leased_a + leased_b) == ['64-19-7', '67-56-1', '7647-14-5']
+    assert len(leased_a) == 2 and len(leased_b) == 1
+    assert queue.lease('host-c:1', 2)[1] == []
+
+    assert queue.complete(leased_a[0], token_a, True, 'Fisher', b'%PDF')
+    # Not the token of the lease
+    assert not queue.complete(leased_a[1], token_b, True, 'Fisher', b'%PDF')
+    assert queue.counts() == {'done': 1, 'leased': 2}
+    assert queue.done_jobs(10) == [(leased_a[0], True, 'Fisher', b'%PDF')]
+    assert not queue.is_drained()
+
+    queue.remove([leased_a[0]])
+    assert queue.done_jobs(10) == []
+
+
+def test_expired_lease(queue, monkeypatch):
+    '''Test the jobs of a dead worker are leased again, then given up after max_attempts'''
+    monkeypatch.setattr('oe_find_sds.job_queue.lease_timeout', -1)
+    monkeypatch.setattr('oe_find_sds.job_queue.max_attempts', 2)
+    queue.enqueue(['64-19-7'])
+    old_token, [cas_nr] = queue.lease('host-a:1', 1)
+    token, leased = queue.lease('host-b:1', 1)
+    assert leased == [cas_nr]
+    # The first worker comes back too late
+    assert not queue.complete(cas_nr, old_token, True, 'Fisher', b'%PDF')
+    assert queue.lease('host-c:1', 1)[1] == []
+
+    assert queue.give_up_expired() == 1
+    assert queue.done_jobs(10) == [(cas_nr, False, None, None)]
+    assert queue.is_drained()
+
+
+def test_coordinator_and_worker(tmpdir, monkeypatch):
+    '''Test the SDS downloaded by a worker on another host are applied by the coordinator'''
+    coordinator_folder = Path(tmpdir) / 'coordinator'
+    worker_folder = Path(tmpdir) / 'worker'
+    coordinator_folder.mkdir()
+    worker_folder.mkdir()
+    cas_list = ['64-19-7', '67-56-1', '00000-00-0']
+
+    def download_sds(cas_nr):
+        if cas_nr == '00000-00-0':
+            return cas_nr, False, None
+        (worker_folder / f'{cas_nr}.pdf').write_bytes(f'%PDF {cas_nr} %%EOF'.encode())
+        return cas_nr, True, 'Fisher'
+
+    applied = []
+    monkeypatch.setattr('oe_find_sds.find_sds.download_sds', download_sds)
+    monkeypatch.setattr('oe_find_sds.find_sds.update_sql_sds_batch',
+                        lambda connection, results, batch_size: applied.extend(results) or
+                        sum(downloaded for cas_nr, downloaded, sds_source in results))
+    monkeypatch.setattr('oe_find_sds.find_sds.missing_sds', set())
+    monkeypatch.setattr('oe_find_sds.find_sds.poll_interval', 0.01)
+    monkeypatch.setattr('oe_find_sds.find_sds.status_interval', 0)
+    queue_file = Path(tmpdir) / 'jobs.sqlite'
+
+    JobQueue.sqlite(queue_file).enqueue(cas_list)
+    monkeypatch.setattr('oe_find_sds.find_sds.download_path', worker_folder)
+    assert run_worker(JobQueue.sqlite(queue_file), worker='host-b:1', lease_size=2) == 3
+
+    monkeypatch.setattr('oe_find_sds.find_sds.download_path', coordinator_folder)
+    assert run_coordinator(None, JobQueue.sqlite(queue_file), cas_list, batch_size=10) == 2
+    assert sorted(applied) == [('00000-00-0', False, None), ('64-19-7', True, 'Fisher'), ('67-56-1', True, 'Fisher')]
+    assert (coordinator_folder / '64-19-7.pdf').read_bytes() == b'%PDF 64-19-7 %%EOF'
+    assert JobQueue.sqlite(queue_file).counts() == {}
@@ -0,0 +1,121 @@
+import sys, os
+sys.path.append(os.path.realpath('oe_find_sds'))
+
+import json
+from pathlib import Path
+
+import pytest
+from oe_find_sds import find_sds, http_sessions
+from oe_find_sds.find_sds import download_sds, open_journal, queue_in_journal, start_journal
+from oe_find_sds.journal import Journal
+
+
+def test_journal_replay(tmpdir):
+    journal = Journal.in_folder(tmpdir)
+    journal.record_many(['64-19-7', '67-56-1', '7647-14-5', '00000-00-0'], 'queued')
+    journal.record('64-19-7', 'resolved', source='Fisher', url='url-fisher')
+    journal.record('67-56-1', 'resolved', source='VWR', url='url-vwr')
+    journal.record('67-56-1', 'downloaded', source='VWR')
+    journal.record('67-56-1', 'applied', database='group_a')
+    journal.record('00000-00-0', 'missing')
+    journal.close()
+    # The program was killed while writing a line
+    with open(str(Path(tmpdir) / 'oe_find_sds_journal.jsonl'), 'a') as f:
+        f.write('{"cas": "7647-14-5", "sta')
+
+    journal = Journal.in_folder(tmpdir, resume=True)
+    assert journal.state('64-19-7') == 'resolved'
+    assert journal.resolved_url('64-19-7') == ('Fisher', 'url-fisher')
+    assert journal.resolved_url('67-56-1') is None
+    assert journal.state('7647-14-5') == 'queued'
+    assert journal.is_finished('67-56-1', 'group_a')
+    assert not journal.is_finished('67-56-1', 'group_b')
+    assert journal.is_finished('00000-00-0', 'group_b')
+    assert not journal.is_finished('64-19-7', 'group_a')
+    journal.close()
+
+    # A run without resume starts a new journal
+    Journal.in_folder(tmpdir).close()
+    assert Journal.in_folder(tmpdir, resume=True).entries == {}
+
+
+@pytest.fixture
+def download_folder(tmpdir, monkeypatch):
+    monkeypatch.setattr('oe_find_sds.find_sds.download_path', str(tmpdir))
+    monkeypatch.setattr('oe_find_sds.find_sds.deduplicate', False)
+    yield Path(tmpdir)
+    find_sds.close_journal()
+
+
+def read_states(download_folder):
+    with open(str(download_folder / 'oe_find_sds_journal.jsonl')) as f:
+        return [(entry['cas'], entry['state']) for entry in map(json.loads, f)]
+
+
+def test_download_sds_journal(monkeypatch, download_folder):
+    '''Test download_sds() records the states of the CAS numbers'''
+    def fetch_sds(full_url, download_file, validators=None):
+        Path(download_file).write_bytes(b'%PDF')
+        return True
+
+    monkeypatch.setattr('oe_find_sds.find_sds.fetch_sds', fetch_sds)
+    monkeypatch.setattr('oe_find_sds.find_sds.resolve_sds_url',
+                        lambda cas_nr, **kwargs: ('Fisher', 'url-fisher') if cas_nr == '64-19-7' else None)
+    assert start_journal({'': {'64-19-7', '00000-00-0'}}) == {'': {'64-19-7', '00000-00-0'}}
+    download_sds('64-19-7')
+    download_sds('00000-00-0')
+    find_sds.close_journal()
+    assert read_states(download_folder) == [
+        ('00000-00-0', 'queued'), ('64-19-7', 'queued'),
+        ('64-19-7', 'resolved'), ('64-19-7', 'downloaded'), ('00000-00-0', 'missing')]
+
+
+@pytest.mark.parametrize("race", [False, True])
+def test_unreachable_supplier_not_missing(monkeypatch, download_folder, race):
+    '''Test a CAS number is not journaled missing when a supplier could not be reached, also when the
+    suppliers are searched on other threads'''
+    def unreachable(cas_nr):
+        http_sessions._failures.count = http_sessions.request_failures() + 1
+
+    for supplier in find_sds.supplier_order:
+        monkeypatch.setattr(f'oe_find_sds.find_sds.extract_download_url_from_{supplier}', lambda cas_nr: None)
+    monkeypatch.setattr('oe_find_sds.find_sds.extract_download_url_from_fisher', unreachable)
+    monkeypatch.setattr('oe_find_sds.find_sds.race_suppliers', race)
+    start_journal({'': {'00000-00-0', '7647-14-5'}})
+    download_sds('00000-00-0')
+    monkeypatch.setattr('oe_find_sds.find_sds.extract_download_url_from_fisher', lambda cas_nr: None)
+    download_sds('7647-14-5')
+    find_sds.close_journal()
+    assert read_states(download_folder)[2:] == [('7647-14-5', 'missing')]
+
+def test_resume(monkeypatch, download_folder):
+    '''Test a resumed run skips the CAS numbers finished, and downloads the urls found without searching'''
+    journal = Journal.in_folder(download_folder)
+    journal.record_many(['64-19-7', '67-56-1', '7647-14-5', '00000-00-0'], 'queued')
+    journal.record('64-19-7', 'resolved', source='Fisher', url='url-fisher')
+    journal.record('67-56-1', 'applied', database='group_a')
+    journal.record('00000-00-0', 'missing')
+    journal.close()
+
+    monkeypatch.setattr('oe_find_sds.find_sds.resume', True)
+    assert start_journal({'group_a': {'64-19-7', '67-56-1', '7647-14-5', '00000-00-0'}, 'group_b': {'67-56-1'}}) == \
+        {'group_a': {'64-19-7', '7647-14-5'}, 'group_b': {'67-56-1'}}
+
+    fetched = []
+    monkeypatch.setattr('oe_find_sds.find_sds.fetch_sds',
+                        lambda full_url, download_file, validators=None: fetched.append(full_url) or Path(download_file).write_bytes(b'%PDF'))
+    monkeypatch.setattr('oe_find_sds.find_sds.resolve_sds_url', lambda cas_nr, **kwargs: pytest.fail('searched again'))
+    assert download_sds('64-19-7') == ('64-19-7', True, 'Fisher')
+    assert fetched == ['url-fisher']
+
+
+def test_queue_in_journal(monkeypatch, download_folder):
+    journal = Journal.in_folder(download_folder)
+    journal.record('64-19-7', 'applied', database='group_a')
+    journal.record('00000-00-0', 'missing')
+    journal.close()
+
+    monkeypatch.setattr('oe_find_sds.find_sds.resume', True)
+    open_journal()
+    assert list(queue_in_journal(iter(['64-19-7', '00000-00-0', '67-56-1']), 'group_a')) == ['67-56-1']
+    assert find_sds.journal.state('67-56-1') == 'queued'
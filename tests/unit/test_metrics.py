@@ -0,0 +1,100 @@
+import sys, os
+sys.path.append(os.path.realpath('oe_find_sds'))
+
+import json
+
+import pytest
+from conftest import QuietHandler
+from oe_find_sds import metrics
+from oe_find_sds.find_sds import search_supplier
+from oe_find_sds.http_sessions import http_get
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+class PageHandler(QuietHandler):
+    '''Answer 200 with a 5-byte body, or 404 for the paths starting with /missing'''
+    def do_GET(self):
+        self.send_response(404 if self.path.startswith('/missing') else 200)
+        self.send_header('Content-Length', '5')
+        self.end_headers()
+        self.wfile.write(b'hello')
+
+
+def test_histogram():
+    histogram = metrics.Histogram('test_seconds', 'Test histogram', buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, supplier='fisher')
+    assert histogram.get(supplier='fisher') == (4, 3.65)
+    assert histogram.get(supplier='vwr') == (0, 0.0)
+
+    lines = [line for line in metrics.to_prometheus().splitlines() if line.startswith('oe_find_sds_test_seconds')]
+    assert lines == [
+        'oe_find_sds_test_seconds_bucket{supplier="fisher",le="0.1"} 2',
+        'oe_find_sds_test_seconds_bucket{supplier="fisher",le="1.0"} 3',
+        'oe_find_sds_test_seconds_bucket{supplier="fisher",le="+Inf"} 4',
+        'oe_find_sds_test_seconds_sum{supplier="fisher"} 3.65',
+        'oe_find_sds_test_seconds_count{supplier="fisher"} 4',
+    ]
+    metrics._metrics.remove(histogram)
+
+
+def test_counter_labels():
+    metrics.http_errors.inc(host='www.fishersci.com', error='ConnectionError')
+    metrics.http_errors.inc(host='www.fishersci.com', error='ConnectionError')
+    metrics.http_errors.inc(host='us.vwr.com', error='HTTP "503"')
+    assert metrics.http_errors.get(error='ConnectionError', host='www.fishersci.com') == 2
+    assert 'oe_find_sds_http_errors_total{error="HTTP \\"503\\"",host="us.vwr.com"} 1' in metrics.to_prometheus()
+
+
+def test_http_metrics(serve):
+    base_url = serve(PageHandler)
+    http_get(base_url + '/page', timeout=5)
+    http_get(base_url + '/missing', timeout=5)
+    assert metrics.http_requests.get(host='127.0.0.1') == 2
+    assert metrics.http_request_seconds.get(host='127.0.0.1')[0] == 2
+    assert metrics.http_errors.get(host='127.0.0.1', error='HTTP 404') == 1
+    assert metrics.http_response_bytes.get(host='127.0.0.1') == 10
+
+
+def test_search_supplier_metrics(monkeypatch):
+    from oe_find_sds import http_sessions
+
+    answers = {'fisher': ('Fisher', 'url'), 'vwr': None}
+
+    def unreachable(cas_nr):
+        http_sessions._failures.count = http_sessions.request_failures() + 1
+
+    monkeypatch.setattr('oe_find_sds.find_sds.extract_download_url_from_fisher', lambda cas_nr: answers['fisher'])
+    monkeypatch.setattr('oe_find_sds.find_sds.extract_download_url_from_vwr', lambda cas_nr: answers['vwr'])
+    monkeypatch.setattr('oe_find_sds.find_sds.extract_download_url_from_tci', unreachable)
+    for supplier in ('fisher', 'fisher', 'vwr', 'tci'):
+        search_supplier(supplier, '623-51-8')
+
+    summary = metrics.supplier_summary()
+    assert summary['fisher']['searches'] == 2
+    assert summary['fisher']['hit_rate'] == 1
+    assert summary['vwr']['miss'] == 1
+    assert summary['tci']['unreachable'] == 1
+    assert 'fisher' in metrics.format_supplier_summary()
+
+
+def test_write_metrics(monkeypatch, tmpdir):
+    monkeypatch.setattr('oe_find_sds.metrics.json_file', str(tmpdir / 'metrics.json'))
+    monkeypatch.setattr('oe_find_sds.metrics.prometheus_file', str(tmpdir / 'textfile' / 'oe_find_sds.prom'))
+    metrics.phase_seconds.set(1.5, phase='select')
+    metrics.pdf_size_bytes.observe(300 * 1024)
+    metrics.write_metrics()
+
+    written = json.loads((tmpdir / 'metrics.json').read_text('utf-8'))
+    assert written['metrics']['oe_find_sds_phase_seconds']['values'] == [{'labels': {'phase': 'select'}, 'value': 1.5}]
+    assert written['metrics']['oe_find_sds_pdf_size_bytes']['values'][0]['count'] == 1
+    prometheus = (tmpdir / 'textfile' / 'oe_find_sds.prom').read_text('utf-8')
+    assert '# TYPE oe_find_sds_phase_seconds gauge' in prometheus
+    assert 'oe_find_sds_phase_seconds{phase="select"} 1.5' in prometheus
+    assert sorted(os.listdir(tmpdir / 'textfile')) == ['oe_find_sds.prom']
@@ -0,0 +1,140 @@
+import sys, os
+sys.path.append(os.path.realpath('oe_find_sds'))
+
+import argparse
+import threading
+import time
+from email.utils import formatdate
+
+import pytest
+from conftest import QuietHandler
+from oe_find_sds import rate_limit
+from oe_find_sds.find_sds import apply_supplier_limits, parse_rate_limit
+from oe_find_sds.http_sessions import http_get
+from oe_find_sds.rate_limit import HostLimiter, RateLimit, get_limiter, limiter_status, parse_retry_after
+
+
+class ThrottlingHandler(QuietHandler):
+    '''Answer 429 with a Retry-After header to the first `throttled` requests, then 200'''
+    throttled = 1
+    count = 0
+
+    def do_GET(self):
+        type(self).count += 1
+        if type(self).count <= self.throttled:
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+@pytest.fixture
+def throttling_server(serve):
+    ThrottlingHandler.count = 0
+    return serve(ThrottlingHandler)
+
+
+def test_token_bucket_rate():
+    limiter = HostLimiter('example.com', RateLimit(rate=50, burst=1, max_concurrency=5))
+    start = time.monotonic()
+    for _ in range(11):
+        with limiter:
+            pass
+    # The first request uses the burst token, the next 10 wait 1/50 s each
+    assert time.monotonic() - start >= 10 / 50 * 0.9
+
+
+def test_concurrency_cap():
+    limiter = HostLimiter('example.com', RateLimit(rate=1000, burst=1000, max_concurrency=3))
+    max_in_flight = []
+
+    def request():
+        with limiter:
+            max_in_flight.append(limiter.in_flight)
+            time.sleep(0.02)
+
+    threads = [threading.Thread(target=request) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(max_in_flight) <= 3
+    assert limiter.in_flight == 0
+
+
+def test_throttled_backoff():
+    limiter = HostLimiter('example.com', RateLimit(rate=8, burst=8, max_concurrency=5))
+    assert limiter.throttled() == rate_limit.min_backoff
+    assert limiter.rate == 4
+    assert limiter.throttled() == rate_limit.min_backoff * 2
+    assert limiter.throttled('5') == 5
+    assert limiter.status()['throttled'] == 3
+    assert limiter.status()['backoff'] > 0
+
+    for _ in range(100):
+        limiter.succeeded()
+    assert limiter.rate == 8
+    assert limiter.backoff == 0
+
+
+@pytest.mark.parametrize(
+    "retry_after, expect", [
+        (None, None),
+        ('', None),
+        ('120', 120.0),
+        ('not a date', None),
+    ]
+)
+def test_parse_retry_after(retry_after, expect):
+    assert parse_retry_after(retry_after) == expect
+
+
+def test_parse_retry_after_http_date():
+    assert 25 <= parse_retry_after(formatdate(time.time() + 30, usegmt=True)) <= 30
+
+
+def test_http_get_honours_retry_after(throttling_server):
+    ThrottlingHandler.throttled = 1
+    response = http_get(throttling_server, timeout=5)
+    assert response.status_code == 200
+    assert ThrottlingHandler.count == 2
+    assert limiter_status()['127.0.0.1']['throttled'] == 1
+
+
+def test_http_get_gives_up_after_max_retries(monkeypatch, throttling_server):
+    monkeypatch.setattr('oe_find_sds.rate_limit.max_retries', 1)
+    monkeypatch.setattr('oe_find_sds.rate_limit.min_backoff', 0.01)
+    ThrottlingHandler.throttled = 5
+    response = http_get(throttling_server, timeout=5)
+    assert response.status_code == 429
+    assert ThrottlingHandler.count == 2
+
+
+@pytest.mark.parametrize(
+    "value, expect", [
+        ('fisher=2/8', ('fisher', RateLimit(rate=2.0, burst=2, max_concurrency=8))),
+        ('vwr=0.5', ('vwr', RateLimit(rate=0.5, burst=1, max_concurrency=20))),
+        ('default=20/50', ('default', RateLimit(rate=20.0, burst=20, max_concurrency=50))),
+    ]
+)
+def test_parse_rate_limit(value, expect):
+    assert parse_rate_limit(value) == expect
+
+
+@pytest.mark.parametrize("value", ['fisher', 'fisher=0', 'fisher=a/b', 'sigma=2/8'])
+def test_parse_rate_limit_with_error(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_rate_limit(value)
+
+
+def test_apply_supplier_limits(monkeypatch):
+    limit = RateLimit(rate=1, burst=1, max_concurrency=2)
+    monkeypatch.setattr('oe_find_sds.find_sds.supplier_limits', {'chemicalsafety': limit})
+    monkeypatch.setattr('oe_find_sds.rate_limit.host_limits', {})
+    apply_supplier_limits()
+    assert get_limiter('http://sds.chemicalsafety.com/sds/pda/msds/getpdf.ashx').limit == limit
+    assert get_limiter('https://chemicalsafety.com/sds1/retriever.php').limit == limit
+    assert get_limiter('https://www.fishersci.com/').limit == rate_limit.default_limit
+    rate_limit.reset_limiters()
@@ -0,0 +1,117 @@
+import sys, os
+sys.path.append(os.path.realpath('oe_find_sds'))
+
+from pathlib import Path
+
+import pytest
+from conftest import QuietHandler
+from oe_find_sds import find_sds
+from oe_find_sds.find_sds import _conditional_check, _fetch_and_record, refresh_sds
+from oe_find_sds.sds_cache import SdsCache
+
+
+class VersionedSdsHandler(QuietHandler):
+    '''Serve an SDS file with an ETag and a Last-Modified date, answering 304 to the conditional requests
+    if `conditional`'''
+    version = 1
+    conditional = True
+    requests = []
+
+    def do_GET(self):
+        etag = f'"v{self.version}"'
+        VersionedSdsHandler.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.path == '/gone.pdf':
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.conditional and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = f'%PDF-1.4 version {self.version} %%EOF'.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', f'Mon, 0{self.version} Jun 2026 00:00:00 GMT')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def sds_server(serve, tmpdir, monkeypatch):
+    VersionedSdsHandler.version = 1
+    VersionedSdsHandler.conditional = True
+    VersionedSdsHandler.requests = []
+    cache = SdsCache.in_folder(tmpdir)
+    monkeypatch.setattr('oe_find_sds.find_sds.download_path', str(tmpdir))
+    monkeypatch.setattr('oe_find_sds.find_sds.search_cache', cache)
+    # Every SDS downloaded is due for a check
+    monkeypatch.setattr('oe_find_sds.find_sds.refresh_interval', -1)
+    yield serve(VersionedSdsHandler)
+    cache.close()
+
+
+def test_refresh_sds(sds_server, tmpdir, monkeypatch):
+    '''Test only the SDS that changed are downloaded and updated again'''
+    updates = []
+    monkeypatch.setattr('oe_find_sds.find_sds.update_sql_sds_batch',
+                        lambda connection, results, batch_size: updates.append(results) or len(results))
+    download_file = Path(tmpdir) / '64-19-7.pdf'
+    assert _fetch_and_record('64-19-7', 'Fisher', f'{sds_server}/acetic.pdf', download_file)
+    assert find_sds.search_cache.validators('64-19-7') == ('Fisher', f'{sds_server}/acetic.pdf', '"v1"',
+                                                            'Mon, 01 Jun 2026 00:00:00 GMT', 24)
+
+    assert refresh_sds(None) == (1, 0)
+    assert VersionedSdsHandler.requests[-1] == ('/acetic.pdf', '"v1"')
+    assert updates == []
+
+    VersionedSdsHandler.version = 2
+    assert refresh_sds(None) == (1, 1)
+    assert updates == [[('64-19-7', True, 'Fisher')]]
+    assert download_file.read_bytes() == b'%PDF-1.4 version 2 %%EOF'
+    assert find_sds.search_cache.validators('64-19-7')[2] == '"v2"'
+    assert not list(Path(tmpdir).glob('.*.refresh'))
+
+
+def test_refresh_limit(sds_server, tmpdir, monkeypatch):
+    monkeypatch.setattr('oe_find_sds.find_sds.refresh_interval', 3600)
+    find_sds.search_cache.record_validators('64-19-7', 'Fisher', f'{sds_server}/acetic.pdf', '"v1"')
+    assert refresh_sds(None) == (0, 0)
+
+    monkeypatch.setattr('oe_find_sds.find_sds.refresh_interval', -1)
+    for cas_nr in ('64-19-7', '67-56-1', '7647-14-5'):
+        find_sds.search_cache.record_validators(cas_nr, 'Fisher', f'{sds_server}/{cas_nr}.pdf', '"v1"')
+    assert refresh_sds(None, limit=2) == (2, 0)
+    # The SDS checked are the last ones to check next time
+    assert find_sds.search_cache.stale_validators(-1, 1) == ['7647-14-5']
+
+
+@pytest.mark.parametrize(
+    "conditional, etag, last_modified, content_length, expect", [
+        (True, '"v1"', None, None, 'unchanged'),
+        (True, '"v0"', None, None, 'changed'),
+        # Servers ignoring If-None-Match
+        (False, '"v1"', None, None, 'unchanged'),
+        (False, '"v0"', None, None, 'changed'),
+        (False, None, 'Mon, 01 Jun 2026 00:00:00 GMT', None, 'unchanged'),
+        (False, None, None, 24, 'unchanged'),
+        (False, None, None, 23, 'changed'),
+        (False, None, None, None, 'changed'),
+    ]
+)
+def test_conditional_check(sds_server, conditional, etag, last_modified, content_length, expect):
+    VersionedSdsHandler.conditional = conditional
+    assert _conditional_check(f'{sds_server}/acetic.pdf', etag, last_modified, content_length) == expect
+
+
+def test_refresh_gone_url(sds_server, tmpdir, monkeypatch):
+    '''Test the SDS is searched again when its url does not give it anymore'''
+    monkeypatch.setattr('oe_find_sds.find_sds.update_sql_sds_batch',
+                        lambda connection, results, batch_size: len(results))
+    monkeypatch.setattr('oe_find_sds.find_sds.resolve_sds_url', lambda cas_nr, **kwargs: ('VWR', f'{sds_server}/new.pdf'))
+    (Path(tmpdir) / '64-19-7.pdf').write_bytes(b'%PDF-1.4 old %%EOF')
+    find_sds.search_cache.record_validators('64-19-7', 'Fisher', f'{sds_server}/gone.pdf', '"v1"')
+
+    assert refresh_sds(None) == (1, 1)
+    assert find_sds.search_cache.validators('64-19-7')[:2] == ('VWR', f'{sds_server}/new.pdf')
@@ -0,0 +1,221 @@
+import sys, os
+sys.path.append(os.path.realpath('oe_find_sds'))
+
+import pytest
+from oe_find_sds import http_sessions
+from oe_find_sds.find_sds import download_sds, order_suppliers, resolve_sds_url, supplier_order
+from oe_find_sds.sds_cache import SdsCache
+
+
+@pytest.fixture
+def cache(tmpdir):
+    cache = SdsCache.in_folder(tmpdir)
+    yield cache
+    cache.close()
+
+
+def test_record_miss(cache):
+    cache.record_miss('00000-00-0', 'fisher')
+    cache.record_miss('00000-00-0', 'vwr')
+    cache.record_miss('623-51-8', 'tci')
+    assert cache.known_misses('00000-00-0') == {'fisher', 'vwr'}
+    assert cache.known_misses('623-51-8') == {'tci'}
+    assert cache.known_misses('1450-76-6') == set()
+
+
+def test_record_miss_expired(cache):
+    cache.record_miss('00000-00-0', 'fisher', ttl=-1)
+    assert cache.known_misses('00000-00-0') == set()
+
+
+@pytest.mark.parametrize("jitter", [0, 0.25])
+def test_record_miss_jitter(monkeypatch, cache, jitter):
+    monkeypatch.setattr('oe_find_sds.sds_cache.negative_ttl_jitter', jitter)
+    for i in range(50):
+        cache.record_miss(f'{i}-00-0', 'fisher', ttl=1000)
+    expires_at = [row[0] - row[1] for row in
+                  cache._connection.execute('SELECT expires_at, checked_at FROM negative_cache')]
+    assert all(1000 * (1 - jitter) <= ttl <= 1000 * (1 + jitter) for ttl in expires_at)
+
+
+def test_cache_persists(tmpdir):
+    cache = SdsCache.in_folder(tmpdir)
+    cache.record_miss('00000-00-0', 'fisher')
+    cache.close()
+
+    cache = SdsCache.in_folder(tmpdir)
+    assert cache.known_misses('00000-00-0') == {'fisher'}
+    cache.forget_misses('00000-00-0')
+    assert cache.known_misses('00000-00-0') == set()
+    cache.close()
+
+
+def mock_extractors(monkeypatch, answers, calls):
+    '''Replace all extractors with fakes recording their calls'''
+    def make_extractor(supplier):
+        def extractor(cas_nr):
+            calls.append(supplier)
+            answer = answers.get(supplier)
+            if answer == 'error':
+                # Simulate a supplier that cannot be reached
+                http_sessions._failures.count = http_sessions.request_failures() + 1
+                return None
+            return answer
+        return extractor
+
+    for supplier in supplier_order:
+        monkeypatch.setattr(f'oe_find_sds.find_sds.extract_download_url_from_{supplier}', make_extractor(supplier))
+
+
+@pytest.mark.parametrize("race", [False, True])
+def test_resolve_sds_url_skips_known_misses(monkeypatch, cache, race):
+    monkeypatch.setattr('oe_find_sds.find_sds.search_cache', cache)
+    monkeypatch.setattr('oe_find_sds.find_sds.race_suppliers', race)
+    # The suppliers are searched in `supplier_order`, not first the one that had the SDS
+    monkeypatch.setattr('oe_find_sds.find_sds.adaptive_order', False)
+    calls = []
+    mock_extractors(monkeypatch, {'fisher': 'error', 'fluorochem': ('Fluorochem', 'url-fluorochem')}, calls)
+
+    assert resolve_sds_url('28697-53-2') == ('Fluorochem', 'url-fluorochem')
+    assert sorted(calls) == sorted(supplier_order)
+    # The unreachable supplier is not a miss
+    assert cache.known_misses('28697-53-2') == {'chemblink', 'vwr', 'tci', 'chemicalsafety'}
+
+    calls.clear()
+    assert resolve_sds_url('28697-53-2') == ('Fluorochem', 'url-fluorochem')
+    assert sorted(calls) == ['fisher', 'fluorochem']
+
+
+def test_resolve_sds_url_revalidate(monkeypatch, cache):
+    monkeypatch.setattr('oe_find_sds.find_sds.search_cache', cache)
+    for supplier in supplier_order:
+        cache.record_miss('00000-00-0', supplier)
+    calls = []
+    mock_extractors(monkeypatch, {}, calls)
+
+    assert resolve_sds_url('00000-00-0') is None
+    assert calls == []
+
+    monkeypatch.setattr('oe_find_sds.find_sds.revalidate', True)
+    assert resolve_sds_url('00000-00-0') is None
+    assert calls == supplier_order
+
+
+def test_record_url(cache):
+    cache.record_url('623-51-8', 'fisher', 'Fisher', 'url-fisher')
+    assert cache.cached_url('623-51-8') == ('Fisher', 'url-fisher')
+    assert cache.cached_url('1450-76-6') is None
+
+    cache.forget_url('623-51-8')
+    assert cache.cached_url('623-51-8') is None
+
+
+@pytest.mark.parametrize(
+    "supplier, age, expect", [
+        ('fisher', 3600, ('Source', 'url')),
+        ('chemicalsafety', 3600, ('Source', 'url')),
+        ('chemicalsafety', 2 * 24 * 3600, None),
+        ('fisher', 31 * 24 * 3600, None),
+    ]
+)
+def test_cached_url_expiry(cache, supplier, age, expect):
+    cache.record_url('623-51-8', supplier, 'Source', 'url')
+    cache._connection.execute('UPDATE resolved_urls SET resolved_at = resolved_at - ?', (age, ))
+    assert cache.cached_url('623-51-8') == expect
+
+
+@pytest.mark.parametrize(
+    "fetch_ok, expect, expect_calls", [
+        # The cached url still gives the SDS: no supplier is searched
+        (True, ('623-51-8', True, 'Cached'), []),
+        # The cached url is broken: the suppliers are searched again
+        (False, ('623-51-8', False, None), supplier_order),
+    ]
+)
+def test_download_sds_with_cached_url(tmpdir, monkeypatch, cache, fetch_ok, expect, expect_calls):
+    monkeypatch.setattr('oe_find_sds.find_sds.download_path', tmpdir)
+    monkeypatch.setattr('oe_find_sds.find_sds.search_cache', cache)
+    monkeypatch.setattr('oe_find_sds.find_sds.fetch_sds', lambda full_url, download_file, validators=None: fetch_ok)
+    cache.record_url('623-51-8', 'fisher', 'Cached', 'url-cached')
+    calls = []
+    mock_extractors(monkeypatch, {}, calls)
+
+    assert download_sds('623-51-8') == expect
+    assert calls == expect_calls
+    assert (cache.cached_url('623-51-8') is not None) == fetch_ok
+
+
+@pytest.mark.parametrize("race", [False, True])
+def test_resolve_sds_url_records_url(monkeypatch, cache, race):
+    monkeypatch.setattr('oe_find_sds.find_sds.search_cache', cache)
+    monkeypatch.setattr('oe_find_sds.find_sds.race_suppliers', race)
+    mock_extractors(monkeypatch, {'tci': ('TCI', 'url-tci'), 'fluorochem': ('Fluorochem', 'url-fluorochem')}, [])
+
+    assert resolve_sds_url('885051-07-0') == ('TCI', 'url-tci')
+    assert cache.cached_url('885051-07-0') == ('TCI', 'url-tci')
+
+
+def test_supplier_stats(tmpdir, monkeypatch):
+    monkeypatch.setattr('oe_find_sds.sds_cache.stats_window', 10)
+    cache = SdsCache.in_folder(tmpdir)
+    cache.record_search('64-19-7', 'fisher', True, 2.0)
+    cache.record_search('623-51-8', 'fisher', False, 1.0)
+    assert cache.supplier_stats() == {'fisher': (2, 1, 3.0)}
+    assert cache.supplier_stats('2') == {'fisher': (1, 1, 2.0)}
+    cache.close()
+
+    cache = SdsCache.in_folder(tmpdir)
+    assert cache.supplier_stats() == {'fisher': (2, 1, 3.0)}
+    # Only the last stats_window searches are kept, the older ones are scaled down
+    for _ in range(18):
+        cache.record_search('623-51-8', 'fisher', False, 1.0)
+    cache.save_stats()
+    searches, hits, seconds = cache.supplier_stats()['fisher']
+    assert (searches, hits, seconds) == pytest.approx((10, 0.5, 10.5))
+    cache.close()
+
+
+def test_order_suppliers(monkeypatch, cache):
+    monkeypatch.setattr('oe_find_sds.find_sds.search_cache', cache)
+    monkeypatch.setattr('oe_find_sds.find_sds.supplier_order', ['chemblink', 'vwr', 'fisher'])
+    monkeypatch.setattr('oe_find_sds.find_sds.explore_rate', 0)
+    # No statistics yet: the order is kept
+    assert order_suppliers('64-19-7') == ['chemblink', 'vwr', 'fisher']
+
+    for i in range(100):
+        # fisher has most SDS, vwr is fast but rarely has them, chemblink never has them
+        cache.record_search(f'{i}-00-0', 'fisher', i % 2 == 0, 2.0)
+        cache.record_search(f'{i}-00-0', 'vwr', i % 5 == 0, 0.5)
+        cache.record_search(f'{i}-00-0', 'chemblink', False, 0.5)
+    assert order_suppliers('64-19-7') == ['vwr', 'fisher']
+
+    monkeypatch.setattr('oe_find_sds.find_sds.explore_rate', 1)
+    assert order_suppliers('64-19-7') == ['vwr', 'fisher', 'chemblink']
+
+    monkeypatch.setattr('oe_find_sds.find_sds.adaptive_order', False)
+    assert order_suppliers('64-19-7') == ['chemblink', 'vwr', 'fisher']
+
+
+def test_order_suppliers_by_prefix(monkeypatch, cache):
+    monkeypatch.setattr('oe_find_sds.find_sds.search_cache', cache)
+    monkeypatch.setattr('oe_find_sds.find_sds.supplier_order', ['vwr', 'fisher'])
+    monkeypatch.setattr('oe_find_sds.find_sds.stats_by_prefix', True)
+    monkeypatch.setattr('oe_find_sds.find_sds.min_hit_rate', 0)
+    for i in range(100):
+        # fisher has the SDS of the long CAS numbers, vwr of the short ones
+        cache.record_search(f'{10 + i % 90}-00-0', 'vwr', True, 1.0)
+        cache.record_search(f'{10 + i % 90}-00-0', 'fisher', False, 1.0)
+        cache.record_search(f'{100000 + i}-00-0', 'vwr', False, 1.0)
+        cache.record_search(f'{100000 + i}-00-0', 'fisher', True, 1.0)
+    assert order_suppliers('64-19-7') == ['vwr', 'fisher']
+    assert order_suppliers('885051-07-0') == ['fisher', 'vwr']
+
+
+def test_resolve_sds_url_records_searches(monkeypatch, cache):
+    monkeypatch.setattr('oe_find_sds.find_sds.search_cache', cache)
+    mock_extractors(monkeypatch, {'fisher': 'error', 'fluorochem': ('Fluorochem', 'url-fluorochem')}, [])
+
+    resolve_sds_url('28697-53-2')
+    stats = cache.supplier_stats()
+    assert {supplier: value[:2] for supplier, value in stats.items()} == \
+        {'chemblink': (1, 0), 'vwr': (1, 0), 'fisher': (1, 0), 'tci': (1, 0), 'chemicalsafety': (1, 0), 'fluorochem': (1, 1)}
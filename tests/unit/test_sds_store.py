@@ -0,0 +1,49 @@
+import sys, os
+sys.path.append(os.path.realpath('oe_find_sds'))
+
+import hashlib
+from pathlib import Path
+
+import pytest
+from oe_find_sds.sds_store import file_digest, file_sha256, store_file, stored_path, store_folder_name
+
+
+@pytest.mark.parametrize("content", [b'', b'%PDF-1.4', b'%PDF' + b'0' * (3 * 1024 * 1024)])
+def test_file_sha256(tmpdir, content):
+    sds_file = Path(tmpdir) / '64-19-7.pdf'
+    sds_file.write_bytes(content)
+    assert file_sha256(sds_file) == hashlib.sha256(content).hexdigest()
+    assert file_digest(sds_file) == (hashlib.sha256(content).hexdigest(), len(content))
+
+
+def test_store_file(tmpdir):
+    folder = Path(tmpdir)
+    (folder / '7647-14-5.pdf').write_bytes(b'%PDF-generic')
+    (folder / '7440-23-5.pdf').write_bytes(b'%PDF-generic')
+    (folder / '64-19-7.pdf').write_bytes(b'%PDF-acetic-acid')
+
+    hashes = [store_file(folder / f'{cas_nr}.pdf') for cas_nr in ('7647-14-5', '7440-23-5', '64-19-7')]
+    assert hashes[0] == hashes[1] != hashes[2]
+    # One stored file for each content, the CAS files are links to it
+    assert sorted(path.name for path in (folder / store_folder_name).glob('*/*.pdf')) == \
+        sorted([f'{hashes[0]}.pdf', f'{hashes[2]}.pdf'])
+    assert os.path.samefile(str(folder / '7647-14-5.pdf'), str(folder / '7440-23-5.pdf'))
+    assert os.path.samefile(str(folder / '7647-14-5.pdf'), str(stored_path(folder, hashes[0])))
+    assert (folder / '7440-23-5.pdf').read_bytes() == b'%PDF-generic'
+    assert os.stat(str(stored_path(folder, hashes[0]))).st_nlink == 3
+
+    # Storing a file again changes nothing
+    assert store_file(folder / '7440-23-5.pdf') == hashes[0]
+    assert sorted(os.listdir(str(folder))) == ['64-19-7.pdf', '7440-23-5.pdf', '7647-14-5.pdf', store_folder_name]
+
+
+def test_store_file_without_hardlinks(tmpdir, monkeypatch):
+    '''Test the file is kept as it is on a file system without hardlinks'''
+    def link(source, target):
+        raise PermissionError()
+
+    monkeypatch.setattr('os.link', link)
+    sds_file = Path(tmpdir) / '64-19-7.pdf'
+    sds_file.write_bytes(b'%PDF')
+    assert store_file(sds_file) == hashlib.sha256(b'%PDF').hexdigest()
+    assert sds_file.read_bytes() == b'%PDF'
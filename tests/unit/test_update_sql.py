@@ -0,0 +1,438 @@
+import sys, os
+sys.path.append(os.path.realpath('oe_find_sds'))
+sys.path.append(os.path.realpath('benchmarks'))
+
+from pathlib import Path
+
+import mysql.connector as mariadb
+import hashlib
+import threading
+
+import pytest
+from oe_find_sds.find_sds import (_select_missing_query, check_status_query, copy_sds_query, download_and_update_databases,
+                                  download_and_update_sds, get_max_allowed_packet, iter_missing_cas, main_databases,
+                                  max_status_id_query, save_watermarks, select_missing_cas,
+                                  select_missing_status_query, sync_status_query, update_status_query,
+                                  update_sds_blob_query, update_sds_query, update_sql_sds, update_sql_sds_batch)
+from oe_find_sds.sds_cache import SdsCache
+from run_pipeline import SqliteDatabase
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        if self.connection.fail_on and params and params[-1] == self.connection.fail_on:
+            raise mariadb.Error('bad row')
+        if params:
+            # File objects are read like the connector sends them as long data
+            params = tuple(param.read() if hasattr(param, 'read') else param for param in params)
+        self.connection.pending.append((query, params))
+        self.rowcount = 0 if params and params[-1] in self.connection.unmatched else 1
+
+    def fetchone(self):
+        if self.connection.pending and self.connection.pending[-1][0].startswith('SELECT 1'):
+            # The molecules with an SDS blob, see _has_sds_blob()
+            query, (cas_nr, size) = self.connection.pending.pop()
+            return (1, ) if cas_nr in self.connection.stored else None
+        if self.connection.pending and self.connection.pending[-1][0] in self.connection.rows:
+            return self.connection.rows[self.connection.pending[-1][0]]
+        return (self.connection.max_allowed_packet, )
+
+    def executemany(self, query, seq_params):
+        for params in seq_params:
+            self.execute(query, params)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    '''Record the queries committed, in one list for each transaction'''
+    def __init__(self, fail_on=None, max_allowed_packet=16 * 1024 * 1024):
+        self.fail_on = fail_on
+        self.max_allowed_packet = max_allowed_packet
+        self.stored = set()
+        # The CAS numbers whose UPDATE matches no molecule
+        self.unmatched = set()
+        # Row returned by fetchone() for each query
+        self.rows = {}
+        self.pending = []
+        self.transactions = []
+
+    def cursor(self, buffered=False, prepared=False):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.transactions.append(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def download_folder(tmpdir, monkeypatch):
+    monkeypatch.setattr('oe_find_sds.find_sds.download_path', tmpdir)
+    monkeypatch.setattr('oe_find_sds.find_sds.missing_sds', set())
+    return Path(tmpdir)
+
+
+def make_results(download_folder, count, existing=True):
+    results = []
+    for i in range(count):
+        cas_nr = f'{i}-00-0'
+        if existing:
+            (download_folder / f'{cas_nr}.pdf').write_bytes(b'%PDF')
+        results.append((cas_nr, existing, 'Fisher'))
+    return results
+
+
+def test_update_sql_sds_parameterized(download_folder):
+    '''Test a source name with quotes does not break the query'''
+    (download_folder / '623-51-8.pdf').write_bytes(b'%PDF')
+    connection = FakeConnection()
+    assert update_sql_sds(connection, cas_nr='623-51-8', sds_source="Sigma-Aldrich's") == 1
+    [[(query, params)]] = connection.transactions
+    assert "Sigma-Aldrich's" not in query
+    assert params == (str(download_folder / '623-51-8.pdf'), "Sigma-Aldrich's", '623-51-8')
+
+
+@pytest.mark.parametrize(
+    "count, batch_size, expect_transactions", [
+        (0, 10, []),
+        (5, 10, [5]),
+        (10, 10, [10]),
+        (25, 10, [10, 10, 5]),
+        (3, 1, [1, 1, 1]),
+    ]
+)
+def test_update_sql_sds_batch(download_folder, count, batch_size, expect_transactions):
+    connection = FakeConnection()
+    results = make_results(download_folder, count)
+    assert update_sql_sds_batch(connection, results, batch_size=batch_size) == count
+    assert [len(transaction) for transaction in connection.transactions] == expect_transactions
+
+
+def test_update_sql_sds_batch_with_missing_files(download_folder):
+    from oe_find_sds import find_sds
+
+    connection = FakeConnection()
+    results = make_results(download_folder, 3) + [('00000-00-0', False, None)]
+    assert update_sql_sds_batch(connection, results, batch_size=10) == 3
+    assert find_sds.missing_sds == {'00000-00-0'}
+
+
+def test_update_sql_sds_batch_with_error(download_folder):
+    '''Test a failing row does not lose the rest of its batch'''
+    connection = FakeConnection(fail_on='2-00-0')
+    results = make_results(download_folder, 5)
+    assert update_sql_sds_batch(connection, results, batch_size=10) == 4
+    updated = [params[-1] for transaction in connection.transactions for query, params in transaction]
+    assert updated == ['0-00-0', '1-00-0', '3-00-0', '4-00-0']
+
+
+@pytest.mark.parametrize("batch_size", [1, 10])
+def test_update_sql_sds_batch_counts_molecules_updated(download_folder, capsys, batch_size):
+    '''Test a CAS number whose molecules got an SDS since they were selected is not counted as updated'''
+    connection = FakeConnection()
+    connection.unmatched = {'1-00-0'}
+    results = make_results(download_folder, 3)
+    assert update_sql_sds_batch(connection, results, batch_size=batch_size) == 2
+    out = capsys.readouterr().out
+    assert 'CAS# 1-00-0              : \tno molecule missing this SDS anymore' in out
+    assert 'CAS# 1-00-0              : \tSDS uploaded successfully!' not in out
+    assert update_sql_sds(connection, cas_nr='1-00-0') == 0
+
+
+@pytest.mark.parametrize("batch_size", [1, 10])
+def test_update_sql_sds_client_mode(monkeypatch, download_folder, batch_size):
+    '''Test the SDS files are sent as query parameters, the files too big for the server are skipped'''
+    from oe_find_sds import find_sds
+
+    monkeypatch.setattr('oe_find_sds.find_sds.upload_mode', 'client')
+    monkeypatch.setattr('oe_find_sds.find_sds.max_allowed_packet', 10)
+    (download_folder / '623-51-8.pdf').write_bytes(b'%PDF-small')
+    (download_folder / '1450-76-6.pdf').write_bytes(b'%PDF-too-big')
+    connection = FakeConnection()
+    results = [('623-51-8', True, 'Fisher'), ('1450-76-6', True, 'VWR')]
+
+    assert update_sql_sds_batch(connection, results, batch_size=batch_size) == 1
+    assert connection.transactions == [[(update_sds_blob_query, (b'%PDF-small', 'Fisher', '623-51-8'))]]
+    assert find_sds.missing_sds == {'1450-76-6'}
+
+
+def test_get_max_allowed_packet():
+    assert get_max_allowed_packet(FakeConnection(max_allowed_packet=4194304)) == 4194304
+
+
+def mock_download_sds(download_folder, fail_on=()):
+    '''Fake download_sds() creating the SDS file, raising for the CAS numbers in fail_on'''
+    def download_sds(cas_nr):
+        if cas_nr in fail_on:
+            raise RuntimeError()
+        (download_folder / f'{cas_nr}.pdf').write_bytes(b'%PDF')
+        return (cas_nr, True, 'Fisher')
+    return download_sds
+
+
+@pytest.mark.parametrize(
+    "count, batch_size, fail_on, expect", [
+        (6, 2, (), 6),
+        (7, 3, (), 7),
+        (10, 4, ('3-00-0', '7-00-0'), 8),
+        (0, 4, (), 0),
+    ]
+)
+def test_download_and_update_sds(monkeypatch, download_folder, count, batch_size, fail_on, expect):
+    '''Test the SDS stream from the downloads into the database, batch by batch'''
+    from oe_find_sds import find_sds
+
+    monkeypatch.setattr('oe_find_sds.find_sds.download_sds', mock_download_sds(download_folder, fail_on))
+    connection = FakeConnection()
+    cas_list = [f'{i}-00-0' for i in range(count)]
+
+    assert download_and_update_sds(connection, cas_list, max_concurrency=2, batch_size=batch_size) == expect
+    assert all(len(transaction) <= batch_size for transaction in connection.transactions)
+    assert sum(len(transaction) for transaction in connection.transactions) == expect
+    assert find_sds.missing_sds == set(fail_on)
+
+
+def test_update_sql_sds_batch_deduplicate(monkeypatch, download_folder):
+    '''Test an SDS file is uploaded once, the molecules with the same SDS file copy it in the database'''
+    cache = SdsCache.in_folder(download_folder)
+    monkeypatch.setattr('oe_find_sds.find_sds.search_cache', cache)
+    for cas_nr, content in [('7647-14-5', b'%PDF-generic'), ('7440-23-5', b'%PDF-generic'), ('64-19-7', b'%PDF-acetic')]:
+        (download_folder / f'{cas_nr}.pdf').write_bytes(content)
+    connection = FakeConnection()
+    results = [('7647-14-5', True, 'Fisher'), ('7440-23-5', True, 'Fisher'), ('64-19-7', True, 'VWR')]
+
+    assert update_sql_sds_batch(connection, results, batch_size=10) == 3
+    [transaction] = connection.transactions
+    assert [(query, params[-1]) for query, params in transaction] == [
+        (update_sds_query, '7647-14-5'), (update_sds_query, '64-19-7'), (copy_sds_query, '7440-23-5')]
+    size = len(b'%PDF-generic')
+    assert transaction[-1][1] == ('7647-14-5', size, 'Fisher', '7647-14-5', size, '7440-23-5')
+
+    # A later run copies the SDS uploaded before, if the molecule still has it
+    (download_folder / '1310-73-2.pdf').write_bytes(b'%PDF-generic')
+    (download_folder / '67-56-1.pdf').write_bytes(b'%PDF-acetic')
+    connection = FakeConnection()
+    connection.stored = {'7647-14-5'}
+    assert update_sql_sds_batch(connection, [('1310-73-2', True, 'Fisher'), ('67-56-1', True, 'VWR')]) == 2
+    [transaction] = connection.transactions
+    assert [(query, params[-1]) for query, params in transaction] == [
+        (update_sds_query, '67-56-1'), (copy_sds_query, '1310-73-2')]
+    cache.close()
+
+
+def test_update_sql_sds_batch_copy_source_gone(monkeypatch, download_folder):
+    '''Test the SDS file is uploaded if the molecule to copy it from lost it before the copy'''
+    cache = SdsCache.in_folder(download_folder)
+    monkeypatch.setattr('oe_find_sds.find_sds.search_cache', cache)
+    database = SqliteDatabase(['64-19-7', '7647-14-5'])
+    database.connection.execute("UPDATE molecule SET default_safety_sheet_blob = X'25504446', "
+                                "default_safety_sheet_by = 'Fisher' WHERE cas_nr = '64-19-7'")
+    (download_folder / '7647-14-5.pdf').write_bytes(b'%PDF')
+    sha256 = hashlib.sha256(b'%PDF').hexdigest()
+    cache.record_blob('', sha256, 4, '64-19-7')
+
+    def has_sds_blob(connection, cas_nr, size):
+        # The SDS is removed from the source molecule once the copy is planned
+        database.connection.execute("UPDATE molecule SET default_safety_sheet_blob = NULL WHERE cas_nr = '64-19-7'")
+        return True
+
+    monkeypatch.setattr('oe_find_sds.find_sds._has_sds_blob', has_sds_blob)
+    assert update_sql_sds_batch(database, [('7647-14-5', True, 'VWR')], batch_size=10) == 1
+    assert database.connection.execute("SELECT default_safety_sheet_blob, default_safety_sheet_by FROM molecule "
+                                       "WHERE cas_nr = '7647-14-5'").fetchall() == [(b'%PDF', 'VWR')]
+    assert cache.stored_blob('', sha256) == ('7647-14-5', 4)
+    database.close()
+    cache.close()
+
+
+def test_update_sql_sds_batch_no_dedup(monkeypatch, download_folder):
+    monkeypatch.setattr('oe_find_sds.find_sds.deduplicate', False)
+    connection = FakeConnection()
+    results = make_results(download_folder, 3)
+    assert update_sql_sds_batch(connection, results, batch_size=10) == 3
+    assert [query for query, params in connection.transactions[0]] == [update_sds_query] * 3
+
+
+def updated_cas(connection):
+    return sorted(params[-1] for transaction in connection.transactions for query, params in transaction)
+
+
+def test_download_and_update_databases(monkeypatch, download_folder):
+    '''Test each CAS number is downloaded once, and updated in every database missing it'''
+    downloads = []
+    download_sds = mock_download_sds(download_folder, fail_on=('3-00-0', ))
+    monkeypatch.setattr('oe_find_sds.find_sds.download_sds', lambda cas_nr: downloads.append(cas_nr) or download_sds(cas_nr))
+    connections = {'group_a': FakeConnection(), 'group_b': FakeConnection(), 'group_c': FakeConnection()}
+    missing = {'group_a': {'0-00-0', '1-00-0', '3-00-0'}, 'group_b': {'1-00-0', '2-00-0'}, 'group_c': set()}
+
+    assert download_and_update_databases(connections, missing, max_concurrency=2, batch_size=2) == \
+        {'group_a': 2, 'group_b': 2, 'group_c': 0}
+    assert sorted(downloads) == ['0-00-0', '1-00-0', '2-00-0', '3-00-0']
+    assert updated_cas(connections['group_a']) == ['0-00-0', '1-00-0']
+    assert updated_cas(connections['group_b']) == ['1-00-0', '2-00-0']
+    assert connections['group_c'].transactions == []
+
+
+@pytest.mark.parametrize("databases", [['group_a', 'group_b'], None])
+def test_main_databases(monkeypatch, download_folder, databases):
+    connections = {'group_a': FakeConnection(), 'group_b': FakeConnection()}
+    missing = {'group_a': {'0-00-0', '1-00-0'}, 'group_b': {'1-00-0'}}
+    monkeypatch.setattr('oe_find_sds.find_sds.connect_database',
+                        lambda database, password: connections.get(database, FakeConnection()))
+    monkeypatch.setattr('oe_find_sds.find_sds.select_missing_cas',
+                        lambda connection, database: missing[database])
+    monkeypatch.setattr('oe_find_sds.find_sds.discover_databases', lambda connection: ['group_a', 'group_b'])
+    monkeypatch.setattr('oe_find_sds.find_sds.warm_up_sessions', lambda urls: None)
+    monkeypatch.setattr('oe_find_sds.find_sds.download_sds', mock_download_sds(download_folder))
+
+    assert main_databases(databases, 'password') == {'group_a': 2, 'group_b': 1}
+    assert updated_cas(connections['group_b']) == ['1-00-0']
+
+
+def test_select_missing_cas_incremental(monkeypatch, download_folder):
+    '''Test an incremental run only selects the molecules added since the previous run, but for full sweeps'''
+    cache = SdsCache.in_folder(download_folder)
+    monkeypatch.setattr('oe_find_sds.find_sds.search_cache', cache)
+    database = SqliteDatabase(['64-19-7', '67-56-1'])
+    assert select_missing_cas(database, 'group_a') == {'64-19-7', '67-56-1'}
+
+    monkeypatch.setattr('oe_find_sds.find_sds.incremental', True)
+    # No watermark yet: all molecules are looked at
+    assert select_missing_cas(database, 'group_a') == {'64-19-7', '67-56-1'}
+    save_watermarks()
+    assert cache.watermark('group_a')[0] == 2
+
+    database.connection.execute("INSERT INTO molecule (cas_nr) VALUES ('7647-14-5')")
+    assert select_missing_cas(database, 'group_a') == {'7647-14-5'}
+    # The watermark is only moved once the SDS are downloaded
+    assert cache.watermark('group_a')[0] == 2
+    save_watermarks()
+    assert select_missing_cas(database, 'group_a') == set()
+    # Other databases have their own watermark
+    assert select_missing_cas(database, 'group_b') == {'64-19-7', '67-56-1', '7647-14-5'}
+
+    monkeypatch.setattr('oe_find_sds.find_sds.full_sweep', True)
+    assert select_missing_cas(database, 'group_a') == {'64-19-7', '67-56-1', '7647-14-5'}
+    monkeypatch.setattr('oe_find_sds.find_sds.full_sweep', False)
+    monkeypatch.setattr('oe_find_sds.find_sds.full_sweep_interval', 0)
+    assert select_missing_cas(database, 'group_a') == {'64-19-7', '67-56-1', '7647-14-5'}
+    save_watermarks()
+    database.close()
+    cache.close()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 1000])
+def test_iter_missing_cas(monkeypatch, chunk_size):
+    monkeypatch.setattr('oe_find_sds.find_sds.scan_chunk_size', chunk_size)
+    database = SqliteDatabase(['64-19-7', '67-56-1', '64-19-7', '7647-14-5'])
+    database.connection.execute("UPDATE molecule SET default_safety_sheet_blob = 'sds', "
+                                "default_safety_sheet_by = 'Fisher' WHERE cas_nr = '67-56-1'")
+    assert sorted(iter_missing_cas(database)) == ['64-19-7', '7647-14-5']
+    database.close()
+
+
+def test_download_and_update_sds_streams(monkeypatch, download_folder):
+    '''Test the downloads start before the CAS numbers are all read'''
+    monkeypatch.setattr('oe_find_sds.find_sds.scan_chunk_size', 2)
+    first_download = threading.Event()
+    download_sds = mock_download_sds(download_folder)
+
+    def scan():
+        yield from ['0-00-0', '1-00-0']
+        # The rest of the table is only read once the first downloads started
+        assert first_download.wait(timeout=10)
+        yield from ['2-00-0', '3-00-0', '4-00-0']
+
+    monkeypatch.setattr('oe_find_sds.find_sds.download_sds',
+                        lambda cas_nr: first_download.set() or download_sds(cas_nr))
+    connection = FakeConnection()
+    assert download_and_update_sds(connection, scan(), max_concurrency=2, batch_size=10) == 5
+    assert updated_cas(connection) == ['0-00-0', '1-00-0', '2-00-0', '3-00-0', '4-00-0']
+
+
+@pytest.mark.parametrize("full, max_status_id, expect_since", [(False, 1234, 1234), (False, None, 0), (True, 1234, 0)])
+def test_sync_status_table(monkeypatch, full, max_status_id, expect_since):
+    '''Test only the molecules not in the status table yet are read from the molecule table'''
+    monkeypatch.setattr('oe_find_sds.find_sds.use_status_table', True)
+    monkeypatch.setattr('oe_find_sds.find_sds.full_sweep', full)
+    connection = FakeConnection()
+    connection.rows[max_status_id_query] = (max_status_id, )
+    connection.rows[select_missing_status_query] = None
+    assert _select_missing_query(connection, 'group_a') == (select_missing_status_query, ())
+    [transaction] = connection.transactions
+    assert transaction[-1] == (sync_status_query, (expect_since, ))
+    assert 'default_safety_sheet_blob' not in select_missing_status_query
+
+
+def test_sync_status_table_periodic(monkeypatch, download_folder):
+    '''Test the status of all the molecules is copied again once the last full copy is too old'''
+    cache = SdsCache.in_folder(download_folder)
+    monkeypatch.setattr('oe_find_sds.find_sds.search_cache', cache)
+    monkeypatch.setattr('oe_find_sds.find_sds.use_status_table', True)
+    connection = FakeConnection()
+    connection.rows[max_status_id_query] = (1234, )
+    since = []
+    for full_sweep_interval in (3600, 3600, 0):
+        monkeypatch.setattr('oe_find_sds.find_sds.full_sweep_interval', full_sweep_interval)
+        _select_missing_query(connection, 'group_a')
+        since.append(connection.transactions[-1][-1][1][0])
+    # Full copy the first time, and again once full_sweep_interval is over
+    assert since == [0, 1234, 0]
+    cache.close()
+
+
+@pytest.mark.parametrize("replace_sds, expect", [(False, 'oe'), (True, b'%PDF-acetic')])
+def test_update_sql_sds_keeps_existing_sds(monkeypatch, download_folder, replace_sds, expect):
+    '''Test an SDS added in Open Enventory since the molecules were selected is only replaced in the refresh mode'''
+    monkeypatch.setattr('oe_find_sds.find_sds.replace_sds', replace_sds)
+    database = SqliteDatabase(['64-19-7', '64-19-7'])
+    database.connection.execute("UPDATE molecule SET default_safety_sheet_blob = 'oe', "
+                                "default_safety_sheet_by = 'OE' WHERE molecule_id = 1")
+    (download_folder / '64-19-7.pdf').write_bytes(b'%PDF-acetic')
+
+    assert update_sql_sds_batch(database, [('64-19-7', True, 'Fisher')], batch_size=10) == 1
+    assert database.connection.execute('SELECT default_safety_sheet_blob FROM molecule ORDER BY molecule_id'
+                                       ).fetchall() == [(expect, ), (b'%PDF-acetic', )]
+    database.close()
+
+
+def test_update_sql_sds_batch_status_table(monkeypatch, download_folder):
+    '''Test the status table is updated in the same transaction as the SDS'''
+    monkeypatch.setattr('oe_find_sds.find_sds.use_status_table', True)
+    (download_folder / '64-19-7.pdf').write_bytes(b'%PDF-acetic')
+    connection = FakeConnection()
+    results = [('64-19-7', True, 'Fisher'), ('00000-00-0', False, None)]
+
+    assert update_sql_sds_batch(connection, results, batch_size=10) == 1
+    update, check = connection.transactions
+    assert update[-1] == (update_status_query, ('Fisher', hashlib.sha256(b'%PDF-acetic').hexdigest(), 11, '64-19-7'))
+    assert check == [(check_status_query, ('00000-00-0', ))]
+
+
+def test_update_sql_sds_batch_status_not_updated(monkeypatch, download_folder):
+    '''Test the status of a molecule that got an SDS since the sync is only marked as checked'''
+    monkeypatch.setattr('oe_find_sds.find_sds.use_status_table', True)
+    (download_folder / '64-19-7.pdf').write_bytes(b'%PDF-acetic')
+    (download_folder / '67-56-1.pdf').write_bytes(b'%PDF-methanol')
+    connection = FakeConnection()
+    connection.unmatched = {'67-56-1'}
+    results = [('64-19-7', True, 'Fisher'), ('67-56-1', True, 'VWR')]
+
+    assert update_sql_sds_batch(connection, results, batch_size=10) == 1
+    [transaction] = connection.transactions
+    assert [(query, params[-1]) for query, params in transaction if query != update_sds_query] == [
+        (update_status_query, '64-19-7'), (check_status_query, '67-56-1')]
+
+    assert update_sql_sds(connection, cas_nr='67-56-1', sds_source='VWR') == 0
+    assert connection.transactions[-1][-1] == (check_status_query, ('67-56-1', ))